@@ -12,6 +12,23 @@ except Exception:
     Celery = None
 
 
+def declare_queues(celery_app):
+    """Declare the default queue and every routed queue (CELERY_TASK_ROUTES).
+
+    A worker started without `-Q` then consumes all of them, which keeps a single
+    dev worker working; production runs one pool per queue (docker-compose.celery.yml).
+    """
+    from kombu import Queue
+
+    conf = celery_app.conf
+    names = {conf.task_default_queue}
+    routes = conf.task_routes or {}
+    if isinstance(routes, dict):
+        names.update(route['queue'] for route in routes.values() if isinstance(route, dict) and route.get('queue'))
+    conf.task_queues = [Queue(name) for name in sorted(names)]
+    return names
+
+
 def make_celery(app_name: str = 'core'):
     if Celery is None:
         raise ImportError('Celery is not installed. Install celery to use background tasks.')
@@ -19,6 +36,7 @@ def make_celery(app_name: str = 'core'):
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
     celery_app = Celery(app_name)
     celery_app.config_from_object('django.conf:settings', namespace='CELERY')
+    declare_queues(celery_app)
     celery_app.autodiscover_tasks()
     return celery_app
 
@@ -0,0 +1,84 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+
+from core.utils import instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentationMiddleware:
+    """Per-request performance breakdown as `Server-Timing` headers and log lines.
+
+    Behavior:
+    - A sampled request (INSTRUMENTATION_SAMPLE_RATE) is measured in full: DB queries
+      and time, cache hits/misses and outbound HTTP time per upstream (Daraja, Coinbase).
+      It gets a `Server-Timing` header when INSTRUMENTATION_SERVER_TIMING is on and an
+      INFO log line with the breakdown in `extra['perf']`.
+    - Every request is timed. One slower than its view's threshold
+      (INSTRUMENTATION_SLOW_VIEWS, else INSTRUMENTATION_SLOW_MS) is logged at WARNING,
+      with the breakdown when it was sampled.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        instrumentation.install()
+
+    def __call__(self, request):
+        if not getattr(settings, 'INSTRUMENTATION_ENABLED', True):
+            return self.get_response(request)
+
+        sampled = random.random() < getattr(settings, 'INSTRUMENTATION_SAMPLE_RATE', 1.0)
+        started = time.perf_counter()
+        if sampled:
+            with instrumentation.collect() as metrics:
+                response = self.get_response(request)
+        else:
+            metrics = None
+            response = self.get_response(request)
+        total_ms = (time.perf_counter() - started) * 1000
+
+        if metrics is not None and getattr(settings, 'INSTRUMENTATION_SERVER_TIMING', False):
+            response['Server-Timing'] = server_timing(total_ms, metrics)
+        self._log(request, response, total_ms, metrics)
+        return response
+
+    def _log(self, request, response, total_ms, metrics):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else '-'
+        slow = total_ms >= slow_threshold_ms(view)
+        if not (slow or metrics is not None):
+            return
+        perf = {'method': request.method, 'path': request.path, 'view': view,
+                'status': response.status_code, 'total_ms': round(total_ms, 2), 'slow': slow}
+        if metrics is not None:
+            perf.update(metrics.as_dict())
+            upstream = ' '.join(f"{name}={data['calls']}/{data['ms']}ms" for name, data in perf['upstream'].items())
+            logger.log(logging.WARNING if slow else logging.INFO,
+                       'request %s %s view=%s status=%s total_ms=%.1f db_queries=%d db_ms=%.1f '
+                       'cache_hits=%d cache_misses=%d upstream=[%s]%s',
+                       request.method, request.path, view, response.status_code, total_ms,
+                       perf['db_queries'], perf['db_ms'], perf['cache_hits'], perf['cache_misses'],
+                       upstream, ' SLOW' if slow else '', extra={'perf': perf})
+        else:
+            logger.warning('request %s %s view=%s status=%s total_ms=%.1f SLOW (not sampled)',
+                           request.method, request.path, view, response.status_code, total_ms,
+                           extra={'perf': perf})
+
+
+def slow_threshold_ms(view_name):
+    per_view = getattr(settings, 'INSTRUMENTATION_SLOW_VIEWS', None) or {}
+    return float(per_view.get(view_name, getattr(settings, 'INSTRUMENTATION_SLOW_MS', 500)))
+
+
+def server_timing(total_ms, metrics):
+    """Render a `Server-Timing` header value from a request's metrics."""
+    entries = [
+        f'total;dur={total_ms:.1f}',
+        f'db;dur={metrics.db_time * 1000:.1f};desc="{metrics.db_queries} queries"',
+        f'cache;desc="{metrics.cache_hits} hits, {metrics.cache_misses} misses"',
+    ]
+    for name, (calls, seconds) in metrics.upstream.items():
+        entries.append(f'{name};dur={seconds * 1000:.1f};desc="{calls} calls"')
+    return ', '.join(entries)
@@ -3,6 +3,7 @@ Base Django settings for the project. This file contains common settings used
 by both development and production configuration modules.
 """
 from pathlib import Path
+import json
 import os
 
 # Load .env file (simple loader, no external dependency) if present in project root
@@ -49,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.instrumentation_middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -115,6 +117,42 @@ STATICFILES_DIRS = [ BASE_DIR / 'frontend' / 'static' ]
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cache
+# With a Redis URL configured, every process shares one cache: a small per-process
+# LRU (L1) in front of Redis (L2), kept coherent with pub/sub invalidations.
+# Without one, fall back to Django's per-process local-memory cache.
+# Derived from REDIS_URL, the cache gets its own database (CACHE_REDIS_DB, default 1): the
+# Celery broker and results live in REDIS_URL's database, and `cache.clear()` is a FLUSHDB.
+def _redis_url_with_db(url, db):
+    from urllib.parse import urlsplit, urlunsplit
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(path=f'/{db}'))
+
+
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL') or (
+    _redis_url_with_db(os.getenv('REDIS_URL'), os.getenv('CACHE_REDIS_DB', '1')) if os.getenv('REDIS_URL') else None)
+if CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'core.utils.tiered_cache.TieredCache',
+            'LOCATION': CACHE_REDIS_URL,
+            'TIMEOUT': 300,
+            'OPTIONS': {
+                'L1_MAX_ENTRIES': int(os.getenv('CACHE_L1_MAX_ENTRIES', '1024')),
+                'L1_TIMEOUT': float(os.getenv('CACHE_L1_TIMEOUT', '5')),
+                'TTL_JITTER': float(os.getenv('CACHE_TTL_JITTER', '0.1')),
+                # coordination keys read after a lock or another process's decision: Redis only
+                'L2_ONLY_PREFIXES': ('admission:', 'circuit:', 'checkout_filter:', 'checkout:issued:', 'idem:'),
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 # MPESA configuration (read from environment or .env)
 MPESA_CONSUMER_KEY = os.getenv('MPESA_CONSUMER_KEY')
 MPESA_CONSUMER_SECRET = os.getenv('MPESA_CONSUMER_SECRET')
@@ -122,6 +160,8 @@ MPESA_SHORTCODE = os.getenv('MPESA_SHORTCODE')
 MPESA_PASSKEY = os.getenv('MPESA_PASSKEY')
 MPESA_CALLBACK_URL = os.getenv('MPESA_CALLBACK_URL')
 MPESA_ENV = os.getenv('MPESA_ENV', 'sandbox')
+# Overrides the Daraja host picked from MPESA_ENV, e.g. http://127.0.0.1:8090 for `manage.py daraja_simulator`
+MPESA_BASE_URL = os.getenv('MPESA_BASE_URL', '')
 MPESA_SIMULATE = os.getenv('MPESA_SIMULATE', '0').lower() in ('1', 'true', 'yes')
 
 # MPESA polling configuration
@@ -130,8 +170,128 @@ MPESA_SIMULATE = os.getenv('MPESA_SIMULATE', '0').lower() in ('1', 'true', 'yes'
 MPESA_POLL_DELAY_SECONDS = int(os.getenv('MPESA_POLL_DELAY_SECONDS', '12'))
 MPESA_POLL_MAX_ATTEMPTS = int(os.getenv('MPESA_POLL_MAX_ATTEMPTS', '40'))
 
+# Async initiate: queue the STK push to a Celery worker and answer 202 right away
+# (clients follow /payments/status/<payment_id>/). Requires a running worker.
+MPESA_ASYNC_INITIATE = os.getenv('MPESA_ASYNC_INITIATE', '0').lower() in ('1', 'true', 'yes')
+# Async initiate queues pushes at the rate-limit pace and only sheds a request (429)
+# when its wait would exceed the lifetime of the STK prompt on the customer's phone
+MPESA_STK_PROMPT_LIFETIME = int(os.getenv('MPESA_STK_PROMPT_LIFETIME', '60'))
+
+# Idempotency-Key on /payments/initiate/: successful responses are replayed to
+# repeats with the same key for this many seconds (in-flight repeats get 409)
+PAYMENTS_IDEMPOTENCY_TTL = int(os.getenv('PAYMENTS_IDEMPOTENCY_TTL', '900'))
+PAYMENTS_IDEMPOTENCY_LOCK_TTL = int(os.getenv('PAYMENTS_IDEMPOTENCY_LOCK_TTL', '120'))
+
 # MPESA rate limiting (distributed across all workers)
 # M-Pesa sandbox: 5 requests per 60 seconds (with 1 request max burst)
 # Use 1.2x safety factor: allow 4 requests per 60 seconds
 MPESA_RATE_LIMIT_REQUESTS = int(os.getenv('MPESA_RATE_LIMIT_REQUESTS', '4'))
 MPESA_RATE_LIMIT_PERIOD = int(os.getenv('MPESA_RATE_LIMIT_PERIOD', '60'))
+
+# Several Daraja apps, each with its own token and rate-limit budget (pushes go to the
+# one with the most headroom). JSON list of {"name", "consumer_key", "consumer_secret",
+# "shortcode", "passkey"[, "rate_limit_requests", "rate_limit_period"]}; when empty the
+# `mpesa_credentials` list in accounts.json is used, else the single MPESA_* credential above.
+MPESA_CREDENTIALS = json.loads(os.getenv('MPESA_CREDENTIALS') or '[]')
+
+# Daraja circuit breaker (state shared through the cache): after this many consecutive
+# network/5xx failures calls fail fast for MPESA_CIRCUIT_RECOVERY_SECONDS, then one probe is let through
+MPESA_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('MPESA_CIRCUIT_FAILURE_THRESHOLD', '5'))
+MPESA_CIRCUIT_RECOVERY_SECONDS = int(os.getenv('MPESA_CIRCUIT_RECOVERY_SECONDS', '30'))
+
+# Total time budget for one Daraja operation (token fetch + rate-limit wait + retries):
+# from a web request, and from a Celery task without a soft time limit
+MPESA_REQUEST_DEADLINE_SECONDS = int(os.getenv('MPESA_REQUEST_DEADLINE_SECONDS', '25'))
+MPESA_TASK_DEADLINE_SECONDS = int(os.getenv('MPESA_TASK_DEADLINE_SECONDS', '60'))
+
+# Settled payments not updated for this many days are moved to the archive table
+# by `manage.py archive_payments` (history/receipt views read through to it)
+PAYMENT_ARCHIVE_AFTER_DAYS = int(os.getenv('PAYMENT_ARCHIVE_AFTER_DAYS', '180'))
+
+# M-Pesa callback diagnostics: full headers/body of anomalous callbacks and a sample of
+# normal ones go to a shared ring buffer (staff: /payments/callback/diagnostics/)
+# instead of the log. 'sampled' (default), 'all' or 'off'.
+CALLBACK_DIAGNOSTICS = os.getenv('CALLBACK_DIAGNOSTICS', 'sampled')
+CALLBACK_DIAGNOSTICS_SAMPLE_RATE = float(os.getenv('CALLBACK_DIAGNOSTICS_SAMPLE_RATE', '0.01'))
+CALLBACK_DIAGNOSTICS_PER_MINUTE = int(os.getenv('CALLBACK_DIAGNOSTICS_PER_MINUTE', '6'))
+CALLBACK_DIAGNOSTICS_BUFFER = int(os.getenv('CALLBACK_DIAGNOSTICS_BUFFER', '100'))
+
+# Checkout filter: Bloom filter of the checkout ids issued in the last WINDOW_DAYS, shared
+# through the cache, so callbacks for ids we never issued skip the Payment lookup.
+# Rebuilt every REBUILD_SECONDS (beat task `rebuild_checkout_filter`, or lazily when
+# missing); each process re-reads it every REFRESH_SECONDS.
+CHECKOUT_FILTER_ENABLED = os.getenv('CHECKOUT_FILTER_ENABLED', '1').lower() in ('1', 'true', 'yes')
+CHECKOUT_FILTER_FP_RATE = float(os.getenv('CHECKOUT_FILTER_FP_RATE', '0.001'))
+CHECKOUT_FILTER_WINDOW_DAYS = int(os.getenv('CHECKOUT_FILTER_WINDOW_DAYS', '30'))
+CHECKOUT_FILTER_REBUILD_SECONDS = int(os.getenv('CHECKOUT_FILTER_REBUILD_SECONDS', '300'))
+CHECKOUT_FILTER_REFRESH_SECONDS = float(os.getenv('CHECKOUT_FILTER_REFRESH_SECONDS', '30'))
+
+# Celery queue topology: STK dispatch stays on the default queue; status polls (and their
+# countdown retries), notifications and maintenance jobs get their own queues and worker
+# pools (see docker-compose.celery.yml), so a poll backlog never delays a receipt email.
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    'payments.tasks.poll_payment_status': {'queue': 'polls'},
+    'payments.tasks.send_payment_notification': {'queue': 'notifications'},
+    'payments.tasks.rebuild_checkout_filter': {'queue': 'maintenance'},
+    'payments.tasks.reconcile_failed_payments': {'queue': 'maintenance'},
+    'payments.tasks.archive_settled_payments': {'queue': 'maintenance'},
+    'payments.tasks.prune_task_results': {'queue': 'maintenance'},
+}
+# Workers reserve only what they are running; per-pool overrides go on the worker command line
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.getenv('CELERY_WORKER_PREFETCH_MULTIPLIER', '1'))
+
+# Task results: nothing reads them for polls or notifications, so tasks store none unless
+# they opt in (the reconcile/archive maintenance jobs do). Stored results expire after
+# CELERY_RESULT_EXPIRES seconds; with the django-celery-results DB backend the
+# `prune_task_results` beat job deletes them in batches of TASK_RESULT_PRUNE_BATCH_SIZE.
+CELERY_TASK_IGNORE_RESULT = os.getenv('CELERY_TASK_IGNORE_RESULT', '1').lower() in ('1', 'true', 'yes')
+CELERY_RESULT_EXPIRES = int(os.getenv('CELERY_RESULT_EXPIRES', '86400'))
+TASK_RESULT_PRUNE_BATCH_SIZE = int(os.getenv('TASK_RESULT_PRUNE_BATCH_SIZE', '1000'))
+TASK_RESULT_PRUNE_MAX_BATCHES = int(os.getenv('TASK_RESULT_PRUNE_MAX_BATCHES', '100'))
+
+# Success notifications: 'thread' sends them from an in-process batching thread;
+# 'celery' hands them to the `send_payment_notification` task on the notifications queue
+NOTIFICATION_BACKEND = os.getenv('NOTIFICATION_BACKEND', 'thread')
+
+# Periodic jobs for `celery -A core beat`
+CELERY_BEAT_SCHEDULE = {
+    'rebuild-checkout-filter': {
+        'task': 'payments.tasks.rebuild_checkout_filter',
+        'schedule': CHECKOUT_FILTER_REBUILD_SECONDS,
+    },
+    'prune-task-results': {
+        'task': 'payments.tasks.prune_task_results',
+        'schedule': 3600,
+    },
+}
+
+# Payments metrics (/payments/metrics/, Prometheus text format), aggregated in Redis across
+# web and Celery processes (METRICS_REDIS_URL, else the Celery broker). Scrapers send
+# `Authorization: Bearer $METRICS_TOKEN`; staff sessions can read it without the token.
+METRICS_REDIS_URL = os.getenv('METRICS_REDIS_URL', '')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1.0'))
+METRICS_GAUGE_STALE_SECONDS = int(os.getenv('METRICS_GAUGE_STALE_SECONDS', '60'))
+
+# Purchase lifecycle tracing (payments.utils.tracing): W3C trace context through the
+# initiate view, Celery task headers and the callback (matched by checkout id).
+# Spans are exported to a JSONL file or an OTLP/HTTP collector; with '' (the default) finished
+# spans are discarded and only the push-to-settle histogram is kept.
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', '1').lower() in ('1', 'true', 'yes')
+TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', '1.0'))
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', '')  # '', 'jsonl' or 'otlp'
+TRACING_FILE = os.getenv('TRACING_FILE', str(BASE_DIR / 'traces.jsonl'))
+TRACING_OTLP_ENDPOINT = os.getenv('TRACING_OTLP_ENDPOINT', 'http://127.0.0.1:4318/v1/traces')
+TRACING_SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME', 'payments')
+TRACING_CHECKOUT_TTL = int(os.getenv('TRACING_CHECKOUT_TTL', '86400'))
+
+# Per-request instrumentation (core.middleware.instrumentation_middleware): DB, cache and
+# upstream HTTP time for a sample of requests, as Server-Timing headers and log lines.
+# Requests slower than their view's threshold (JSON {"view_name": ms}, else
+# INSTRUMENTATION_SLOW_MS) are always logged at WARNING.
+INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION_ENABLED', '1').lower() in ('1', 'true', 'yes')
+INSTRUMENTATION_SAMPLE_RATE = float(os.getenv('INSTRUMENTATION_SAMPLE_RATE', '0.1'))
+INSTRUMENTATION_SERVER_TIMING = os.getenv('INSTRUMENTATION_SERVER_TIMING', str(DEBUG)).lower() in ('1', 'true', 'yes')
+INSTRUMENTATION_SLOW_MS = int(os.getenv('INSTRUMENTATION_SLOW_MS', '500'))
+INSTRUMENTATION_SLOW_VIEWS = json.loads(os.getenv('INSTRUMENTATION_SLOW_VIEWS') or '{"frontend:api-market-prices": 2000}')
@@ -0,0 +1,163 @@
+import json
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache as default_cache
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from unittest.mock import Mock, patch
+
+from core.middleware.instrumentation_middleware import InstrumentationMiddleware
+from core.utils.instrumentation import upstream_name
+from core.utils.tiered_cache import TieredCache
+
+
+def _cache(**options):
+    # A unique LocMem L2 per test keeps the shared L1 state isolated
+    options.setdefault('L2_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+    return TieredCache(f'tiered-test-{uuid.uuid4().hex}', {'OPTIONS': options, 'TIMEOUT': 300})
+
+
+class TieredCacheTests(SimpleTestCase):
+    def test_second_read_is_served_from_l1(self):
+        cache = _cache()
+        cache.set('price', {'KES': 10})
+        cache._l1.clear()
+        self.assertEqual(cache.get('price'), {'KES': 10})
+        self.assertEqual(cache.get('price'), {'KES': 10})
+        stats = cache.stats()
+        self.assertEqual((stats['l2_hits'], stats['l1_hits']), (1, 1))
+        self.assertIsNone(cache.get('missing'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_l1_returns_copies(self):
+        cache = _cache()
+        cache.set('items', [1, 2])
+        cache.get('items').append(3)
+        self.assertEqual(cache.get('items'), [1, 2])
+
+    def test_invalidation_from_other_process_drops_l1_entry(self):
+        cache = _cache()
+        cache.set('key', 'old')
+        # another process overwrote the value in L2 and published the key
+        cache._l2.set('key', 'new')
+        self.assertEqual(cache.get('key'), 'old')
+        cache.handle_invalidation(json.dumps({'origin': 'other', 'keys': [cache.make_key('key')]}))
+        self.assertEqual(cache.get('key'), 'new')
+        self.assertEqual(cache.stats()['invalidations_received'], 1)
+
+    def test_own_invalidations_are_ignored(self):
+        cache = _cache()
+        cache.set('key', 'value')
+        cache.handle_invalidation(json.dumps({'origin': cache._tier.origin, 'keys': '*'}))
+        self.assertEqual(len(cache._l1), 1)
+
+    def test_incr_is_applied_in_l2(self):
+        cache = _cache()
+        cache.set('hits', 1)
+        self.assertEqual(cache.incr('hits'), 2)
+        self.assertEqual(cache._l2.get('hits'), 2)
+        self.assertEqual(cache.get('hits'), 2)
+        with self.assertRaises(ValueError):
+            cache.incr('unknown')
+
+    def test_l2_only_keys_are_never_served_from_l1(self):
+        cache = _cache(L2_ONLY_PREFIXES=('admission:',))
+        cache.set('admission:stk:tat', 1.0)
+        cache.set('price', 'old')
+        self.assertTrue(cache.add('admission:stk:lock', 'token'))
+        self.assertEqual(len(cache._l1), 1)
+        # another process moved the schedule on; its invalidation has not arrived yet
+        cache._l2.set('admission:stk:tat', 2.0)
+        cache._l2.set('price', 'new')
+        self.assertEqual(cache.get('admission:stk:tat'), 2.0)
+        self.assertEqual(cache.get_many(['admission:stk:tat', 'admission:stk:lock']),
+                         {'admission:stk:tat': 2.0, 'admission:stk:lock': 'token'})
+        self.assertEqual(cache.get('price'), 'old')
+
+    def test_l2_only_keys_fall_back_to_l1_while_l2_is_down(self):
+        cache = _cache(L2_ONLY_PREFIXES=('circuit:',), L2_RETRY_AFTER=60)
+        with patch.object(cache._l2, 'set', side_effect=ConnectionError('down')):
+            cache.set('circuit:daraja:opened_at', 5)
+        self.assertEqual(cache.get('circuit:daraja:opened_at'), 5)
+
+    def test_ttl_jitter_stays_within_bounds(self):
+        cache = _cache(TTL_JITTER=0.2)
+        for _ in range(50):
+            self.assertTrue(80 <= cache._jittered(100) <= 120)
+        self.assertIsNone(cache._jittered(None))
+
+    def test_l1_is_bounded_lru(self):
+        cache = _cache(L1_MAX_ENTRIES=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(set(cache._l1), {cache.make_key('a'), cache.make_key('c')})
+
+    def test_serves_l1_while_l2_is_down(self):
+        cache = _cache(L2_RETRY_AFTER=60)
+        cache.set('key', 'value')
+        with patch.object(cache._l2, 'set', side_effect=ConnectionError('down')):
+            cache.set('other', 'local')
+        self.assertEqual(cache.stats()['l2_errors'], 1)
+        # L2 is skipped until the retry window passes
+        with patch.object(cache._l2, 'get', side_effect=AssertionError('L2 should not be called')):
+            self.assertEqual(cache.get('key'), 'value')
+            self.assertEqual(cache.get('other'), 'local')
+
+
+@override_settings(INSTRUMENTATION_SAMPLE_RATE=1.0, INSTRUMENTATION_SERVER_TIMING=True, INSTRUMENTATION_SLOW_MS=500,
+                   INSTRUMENTATION_SLOW_VIEWS={})
+class InstrumentationMiddlewareTests(TestCase):
+    def _view(self, request):
+        list(get_user_model().objects.all())
+        default_cache.set('instrumented', 1)
+        default_cache.get('instrumented')
+        default_cache.get('absent')
+        import requests
+        upstream = requests.Response()
+        upstream.status_code, upstream._content = 200, b'{}'
+        with patch('requests.adapters.HTTPAdapter.send', return_value=upstream):
+            requests.Session().get('https://sandbox.safaricom.co.ke/oauth/v1/generate')
+        return HttpResponse('ok')
+
+    def _request(self, view=None):
+        middleware = InstrumentationMiddleware(view or self._view)
+        return middleware(RequestFactory().get('/payments/history/'))
+
+    def test_server_timing_breakdown(self):
+        with self.assertLogs('core.middleware.instrumentation_middleware', 'INFO') as logs:
+            response = self._request()
+        header = response['Server-Timing']
+        self.assertIn('db;dur=', header)
+        self.assertIn('desc="1 queries"', header)
+        self.assertIn('cache;desc="1 hits, 1 misses"', header)
+        self.assertIn('daraja;dur=', header)
+        perf = logs.records[0].perf
+        self.assertEqual((perf['db_queries'], perf['cache_hits'], perf['cache_misses']), (1, 1, 1))
+        self.assertEqual(perf['upstream']['daraja']['calls'], 1)
+        self.assertFalse(perf['slow'])
+
+    def test_unsampled_requests_are_only_timed(self):
+        with override_settings(INSTRUMENTATION_SAMPLE_RATE=0.0), self.assertNoLogs('core.middleware', 'INFO'):
+            response = self._request()
+        self.assertNotIn('Server-Timing', response)
+
+    def test_slow_threshold_per_view(self):
+        def slow_view(request):
+            request.resolver_match = Mock(view_name='payments:history')
+            return HttpResponse('ok')
+
+        with override_settings(INSTRUMENTATION_SAMPLE_RATE=0.0, INSTRUMENTATION_SLOW_VIEWS={'payments:history': 0}), \
+                self.assertLogs('core.middleware.instrumentation_middleware', 'WARNING') as logs:
+            self._request(slow_view)
+        self.assertIn('view=payments:history', logs.output[0])
+        self.assertTrue(logs.records[0].perf['slow'])
+
+    def test_upstream_names(self):
+        self.assertEqual(upstream_name('https://api.coinbase.com/v2/currencies'), 'coinbase')
+        self.assertEqual(upstream_name('https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest'), 'daraja')
+        self.assertEqual(upstream_name('https://example.com/'), 'http')
+        with override_settings(MPESA_BASE_URL='http://127.0.0.1:8090'):
+            self.assertEqual(upstream_name('http://127.0.0.1:8090/oauth/v1/generate'), 'daraja')
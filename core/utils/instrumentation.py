@@ -0,0 +1,189 @@
+"""Per-request performance counters.
+
+`collect()` opens a measurement scope for the current request (a ContextVar, so
+threads and async tasks each get their own) and, while it is open, counts:
+
+* database queries and their time, on every configured connection;
+* cache hits and misses on the configured cache backends (outermost call only, so
+  the tiered cache's L2 lookups are not counted twice);
+* outbound HTTP time made with `requests`, grouped by upstream (``daraja``,
+  ``coinbase``, else ``http``).
+
+The cache and HTTP hooks wrap the backend classes and ``requests.Session.send``
+once per process (`install()`); outside a scope they only do a ContextVar lookup.
+Used by `core.middleware.instrumentation_middleware.InstrumentationMiddleware`.
+"""
+import functools
+import logging
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPSTREAMS = {
+    'daraja': ['safaricom.co.ke'],
+    'coinbase': ['coinbase.com'],
+}
+
+_current = ContextVar('request_metrics', default=None)
+_MISSING = object()
+_installed = False
+
+
+class RequestMetrics:
+    __slots__ = ('db_queries', 'db_time', 'cache_hits', 'cache_misses', 'upstream', '_cache_depth')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.upstream = {}  # name -> [calls, seconds]
+        self._cache_depth = 0
+
+    def add_upstream(self, name, seconds):
+        calls = self.upstream.setdefault(name, [0, 0.0])
+        calls[0] += 1
+        calls[1] += seconds
+
+    def as_dict(self):
+        return {
+            'db_queries': self.db_queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'upstream': {name: {'calls': calls, 'ms': round(seconds * 1000, 2)}
+                         for name, (calls, seconds) in self.upstream.items()},
+        }
+
+
+def current_metrics():
+    """The metrics of the enclosing `collect()` scope, or None."""
+    return _current.get()
+
+
+def _db_wrapper(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_queries += 1
+        metrics.db_time += time.perf_counter() - start
+
+
+@contextmanager
+def collect():
+    """Measure everything the current request does until the block exits."""
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(_db_wrapper))
+            yield metrics
+    finally:
+        _current.reset(token)
+
+
+# --- hooks ---
+
+def upstream_name(url):
+    """Map an outbound URL to an upstream name using INSTRUMENTATION_UPSTREAMS."""
+    host = (urlsplit(url).hostname or '').lower()
+    upstreams = getattr(settings, 'INSTRUMENTATION_UPSTREAMS', None) or DEFAULT_UPSTREAMS
+    for name, suffixes in upstreams.items():
+        for suffix in suffixes:
+            if host == suffix or host.endswith('.' + suffix):
+                return name
+    base_url = getattr(settings, 'MPESA_BASE_URL', '')
+    if base_url and host == (urlsplit(base_url).hostname or '').lower():
+        return 'daraja'
+    return 'http'
+
+
+def _wrap_cache_class(cls):
+    if getattr(cls, '_instrumented', False):
+        return
+    original_get, original_get_many = cls.get, cls.get_many
+
+    @functools.wraps(original_get)
+    def get(self, key, default=None, version=None):
+        metrics = _current.get()
+        if metrics is None or metrics._cache_depth:
+            return original_get(self, key, default, version)
+        metrics._cache_depth += 1
+        try:
+            value = original_get(self, key, _MISSING, version)
+        finally:
+            metrics._cache_depth -= 1
+        if value is _MISSING:
+            metrics.cache_misses += 1
+            return default
+        metrics.cache_hits += 1
+        return value
+
+    @functools.wraps(original_get_many)
+    def get_many(self, keys, version=None):
+        metrics = _current.get()
+        if metrics is None or metrics._cache_depth:
+            return original_get_many(self, keys, version)
+        keys = list(keys)
+        metrics._cache_depth += 1
+        try:
+            found = original_get_many(self, keys, version)
+        finally:
+            metrics._cache_depth -= 1
+        metrics.cache_hits += len(found)
+        metrics.cache_misses += len(keys) - len(found)
+        return found
+
+    cls.get, cls.get_many = get, get_many
+    cls._instrumented = True
+
+
+def _wrap_requests():
+    try:
+        import requests
+    except ImportError:  # pragma: no cover - requests is optional for this module
+        return
+    session_cls = requests.Session
+    if getattr(session_cls, '_instrumented', False):
+        return
+    original_send = session_cls.send
+
+    @functools.wraps(original_send)
+    def send(self, request, **kwargs):
+        metrics = _current.get()
+        if metrics is None:
+            return original_send(self, request, **kwargs)
+        start = time.perf_counter()
+        try:
+            return original_send(self, request, **kwargs)
+        finally:
+            metrics.add_upstream(upstream_name(request.url), time.perf_counter() - start)
+
+    session_cls.send = send
+    session_cls._instrumented = True
+
+
+def install():
+    """Install the cache and HTTP hooks (idempotent)."""
+    global _installed
+    if _installed:
+        return
+    for alias, config in settings.CACHES.items():
+        try:
+            _wrap_cache_class(import_string(config['BACKEND']))
+        except Exception as exc:
+            logger.warning('instrumentation: cannot instrument cache %s: %s', alias, exc)
+    _wrap_requests()
+    _installed = True
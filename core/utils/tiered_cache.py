@@ -0,0 +1,433 @@
+"""Two-tier Django cache backend: a bounded in-process LRU (L1) in front of a shared tier (L2).
+
+L2 is normally Redis, so every gunicorn and Celery process sees the same
+values (rate-limit counters, market prices, ...). Reads that hit L1 never leave
+the process. Writes go to L2 first and are then broadcast over Redis pub/sub
+so other processes drop their stale L1 copy; L1 entries also expire after
+`L1_TIMEOUT` seconds, which bounds staleness if an invalidation is missed.
+
+Configuration (settings.CACHES)::
+
+    'default': {
+        'BACKEND': 'core.utils.tiered_cache.TieredCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'OPTIONS': {
+            'L1_MAX_ENTRIES': 1024,     # LRU bound per process
+            'L1_TIMEOUT': 5,            # max seconds a value is served from L1
+            'TTL_JITTER': 0.1,          # +/-10% on L2 timeouts to spread expiries
+            'L2_BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'L2_OPTIONS': {},
+            'INVALIDATION_CHANNEL': 'cache:invalidate',
+            'L2_ONLY_PREFIXES': ('circuit:', 'admission:'),
+        },
+    }
+
+Keys starting with one of `L2_ONLY_PREFIXES` are never served from L1 while L2
+is reachable. Use it for coordination state (locks, breaker state, schedules)
+that is read right after a `cache.add` lock or decision in another process: an
+L1 copy is only dropped once that process's invalidation arrives, which is too
+late for them.
+
+If the L2 tier errors the backend keeps serving from L1 and retries L2 after
+`L2_RETRY_AFTER` seconds instead of failing every request.
+"""
+import json
+import logging
+import os
+import pickle
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.utils.module_loading import import_string
+
+try:
+    import redis
+except Exception:  # redis may not be installed in this environment
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Django creates one cache backend instance per thread; the L1 state (entries,
+# stats, invalidation listener) is shared per process and location instead.
+_local_tiers = {}
+_local_tiers_lock = threading.Lock()
+
+
+class _LocalTier:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.origin = uuid.uuid4().hex
+        self.pid = os.getpid()
+        self.l2_down_until = 0.0
+        self.publisher = None
+        self.subscriber = None
+        self.stats = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'l2_errors': 0, 'invalidations_received': 0}
+
+
+def _get_local_tier(location, channel):
+    key = (location, channel)
+    with _local_tiers_lock:
+        tier = _local_tiers.get(key)
+        if tier is None or tier.pid != os.getpid():
+            # fresh state after a fork: never trust (or share threads with) the parent's L1
+            tier = _local_tiers[key] = _LocalTier()
+        return tier
+
+
+class TieredCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = dict(params.get('OPTIONS') or {})
+        self._location = location
+        self._l1_max = int(options.pop('L1_MAX_ENTRIES', 1024))
+        self._l1_timeout = float(options.pop('L1_TIMEOUT', 5))
+        self._jitter = float(options.pop('TTL_JITTER', 0.1))
+        self._l2_retry_after = float(options.pop('L2_RETRY_AFTER', 5))
+        self._channel = options.pop('INVALIDATION_CHANNEL', 'cache:invalidate')
+        self._l2_only_prefixes = tuple(options.pop('L2_ONLY_PREFIXES', ()))
+        l2_backend = options.pop('L2_BACKEND', 'django.core.cache.backends.redis.RedisCache')
+        l2_options = options.pop('L2_OPTIONS', {})
+
+        # L2 shares key prefix/version/key function with this backend so keys line up
+        l2_params = {k: v for k, v in params.items() if k not in ('BACKEND', 'OPTIONS', 'LOCATION')}
+        l2_params['OPTIONS'] = l2_options
+        self._l2 = import_string(l2_backend)(location, l2_params)
+        self._pubsub_enabled = redis is not None and str(location).startswith(('redis://', 'rediss://', 'unix://'))
+
+        self._tier = _get_local_tier(location, self._channel)
+
+    # Shared per-process state, see _LocalTier
+    _lock = property(lambda self: self._tier.lock)
+    _l1 = property(lambda self: self._tier.entries)
+    _stats = property(lambda self: self._tier.stats)
+
+    # -- L1 helpers -------------------------------------------------------
+
+    def _check_process(self):
+        if self._tier.pid != os.getpid():
+            self._tier = _get_local_tier(self._location, self._channel)
+        if self._pubsub_enabled and self._tier.subscriber is None:
+            with self._lock:
+                if self._tier.subscriber is None:
+                    self._start_subscriber()
+
+    def _l1_get(self, key):
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return _MISSING
+            expires, pickled = entry
+            if expires < time.monotonic():
+                del self._l1[key]
+                return _MISSING
+            self._l1.move_to_end(key)
+        return pickle.loads(pickled)
+
+    def _l1_set(self, key, value, timeout):
+        ttl = self._l1_timeout if timeout is None else min(self._l1_timeout, timeout)
+        if ttl <= 0:
+            self._l1_delete(key)
+            return
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._l1[key] = (time.monotonic() + ttl, pickled)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self._l1_max:
+                self._l1.popitem(last=False)
+
+    def _l1_delete(self, key):
+        with self._lock:
+            self._l1.pop(key, None)
+
+    def _l2_only(self, key):
+        return bool(self._l2_only_prefixes) and str(key).startswith(self._l2_only_prefixes)
+
+    def l2_available(self):
+        """Whether Redis is in use; while it is down, reads and writes only reach this process's L1."""
+        return self._l2_available()
+
+    # -- L2 helpers -------------------------------------------------------
+
+    def _l2_available(self):
+        return time.monotonic() >= self._tier.l2_down_until
+
+    def _l2_failed(self, exc):
+        self._stats['l2_errors'] += 1
+        self._tier.l2_down_until = time.monotonic() + self._l2_retry_after
+        logger.warning('TieredCache: L2 unavailable, serving from L1 for %ss: %s', self._l2_retry_after, exc)
+
+    def _timeout_seconds(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return timeout
+
+    def _jittered(self, timeout):
+        """Spread L2 expiries so keys written together do not all expire together."""
+        if timeout is None or timeout <= 0 or not self._jitter:
+            return timeout
+        return max(1, int(round(timeout * (1 + random.uniform(-self._jitter, self._jitter)))))
+
+    # -- invalidation -----------------------------------------------------
+
+    def _get_publisher(self):
+        if self._tier.publisher is None:
+            self._tier.publisher = redis.from_url(self._location)
+        return self._tier.publisher
+
+    def _publish(self, keys):
+        if not self._pubsub_enabled or not self._l2_available():
+            return
+        try:
+            message = json.dumps({'origin': self._tier.origin, 'keys': keys})
+            self._get_publisher().publish(self._channel, message)
+        except Exception as exc:
+            logger.debug('TieredCache: failed to publish invalidation: %s', exc)
+
+    def handle_invalidation(self, message):
+        """Apply an invalidation message published by another process."""
+        try:
+            payload = json.loads(message)
+        except (TypeError, ValueError):
+            return
+        if payload.get('origin') == self._tier.origin:
+            return
+        self._stats['invalidations_received'] += 1
+        keys = payload.get('keys')
+        if keys == '*':
+            with self._lock:
+                self._l1.clear()
+            return
+        with self._lock:
+            for key in keys or ():
+                self._l1.pop(key, None)
+
+    def _start_subscriber(self):
+        thread = threading.Thread(target=self._listen, name='tiered-cache-invalidation', daemon=True)
+        self._tier.subscriber = thread
+        thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = redis.from_url(self._location).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._channel)
+                for msg in pubsub.listen():
+                    if msg and msg.get('type') == 'message':
+                        data = msg.get('data')
+                        self.handle_invalidation(data.decode() if isinstance(data, bytes) else data)
+            except Exception as exc:
+                # Entries we may have missed invalidations for expire within L1_TIMEOUT anyway
+                with self._lock:
+                    self._l1.clear()
+                logger.debug('TieredCache: invalidation listener error, reconnecting: %s', exc)
+                time.sleep(self._l2_retry_after)
+
+    # -- cache API --------------------------------------------------------
+
+    def get(self, key, default=None, version=None):
+        self._check_process()
+        l1_key = self.make_and_validate_key(key, version=version)
+        l2_only = self._l2_only(key)
+        if not (l2_only and self._l2_available()):
+            value = self._l1_get(l1_key)
+            if value is not _MISSING:
+                self._stats['l1_hits'] += 1
+                return value
+        if self._l2_available():
+            try:
+                value = self._l2.get(key, _MISSING, version=version)
+            except Exception as exc:
+                self._l2_failed(exc)
+                value = _MISSING
+            if value is not _MISSING:
+                self._stats['l2_hits'] += 1
+                if not l2_only:
+                    self._l1_set(l1_key, value, None)
+                return value
+        self._stats['misses'] += 1
+        return default
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._check_process()
+        l1_key = self.make_and_validate_key(key, version=version)
+        timeout = self._jittered(self._timeout_seconds(timeout))
+        if self._l2_available():
+            try:
+                self._l2.set(key, value, timeout, version=version)
+            except Exception as exc:
+                self._l2_failed(exc)
+            else:
+                if self._l2_only(key):
+                    # drop what an L2 outage left behind; L1 is not read for it until the next one
+                    self._l1_delete(l1_key)
+                    return
+        self._l1_set(l1_key, value, timeout)
+        self._publish([l1_key])
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._check_process()
+        l1_key = self.make_and_validate_key(key, version=version)
+        timeout = self._jittered(self._timeout_seconds(timeout))
+        if self._l2_available():
+            try:
+                added = self._l2.add(key, value, timeout, version=version)
+            except Exception as exc:
+                self._l2_failed(exc)
+            else:
+                if added and not self._l2_only(key):
+                    self._l1_set(l1_key, value, timeout)
+                    self._publish([l1_key])
+                return added
+        # L2 down: best effort, local only
+        if self._l1_get(l1_key) is not _MISSING:
+            return False
+        self._l1_set(l1_key, value, timeout)
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self._check_process()
+        l1_key = self.make_and_validate_key(key, version=version)
+        self._l1_delete(l1_key)
+        if not self._l2_available():
+            return False
+        try:
+            return self._l2.touch(key, self._jittered(self._timeout_seconds(timeout)), version=version)
+        except Exception as exc:
+            self._l2_failed(exc)
+            return False
+
+    def delete(self, key, version=None):
+        self._check_process()
+        l1_key = self.make_and_validate_key(key, version=version)
+        self._l1_delete(l1_key)
+        deleted = False
+        if self._l2_available():
+            try:
+                deleted = self._l2.delete(key, version=version)
+            except Exception as exc:
+                self._l2_failed(exc)
+        self._publish([l1_key])
+        return deleted
+
+    def incr(self, key, delta=1, version=None):
+        self._check_process()
+        l1_key = self.make_and_validate_key(key, version=version)
+        if self._l2_available():
+            try:
+                # Counters live in L2 only: the increment must be atomic across processes
+                value = self._l2.incr(key, delta, version=version)
+            except ValueError:
+                raise
+            except Exception as exc:
+                self._l2_failed(exc)
+            else:
+                self._l1_delete(l1_key)
+                self._publish([l1_key])
+                return value
+        value = self._l1_get(l1_key)
+        if value is _MISSING:
+            raise ValueError("Key '%s' not found" % key)
+        value += delta
+        self._l1_set(l1_key, value, None)
+        return value
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version=version) is not _MISSING
+
+    def get_many(self, keys, version=None):
+        self._check_process()
+        found = {}
+        pending = []
+        l2_up = self._l2_available()
+        for key in keys:
+            if l2_up and self._l2_only(key):
+                pending.append(key)
+                continue
+            value = self._l1_get(self.make_and_validate_key(key, version=version))
+            if value is _MISSING:
+                pending.append(key)
+            else:
+                self._stats['l1_hits'] += 1
+                found[key] = value
+        if pending and self._l2_available():
+            try:
+                from_l2 = self._l2.get_many(pending, version=version)
+            except Exception as exc:
+                self._l2_failed(exc)
+                from_l2 = {}
+            for key, value in from_l2.items():
+                if not self._l2_only(key):
+                    self._l1_set(self.make_and_validate_key(key, version=version), value, None)
+            self._stats['l2_hits'] += len(from_l2)
+            found.update(from_l2)
+        self._stats['misses'] += len(keys) - len(found)
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self._check_process()
+        timeout = self._jittered(self._timeout_seconds(timeout))
+        failed = []
+        stored = False
+        if self._l2_available():
+            try:
+                failed = self._l2.set_many(data, timeout, version=version) or []
+                stored = True
+            except Exception as exc:
+                self._l2_failed(exc)
+        l1_keys = []
+        for key, value in data.items():
+            l1_key = self.make_and_validate_key(key, version=version)
+            if stored and self._l2_only(key):
+                self._l1_delete(l1_key)
+                continue
+            self._l1_set(l1_key, value, timeout)
+            l1_keys.append(l1_key)
+        self._publish(l1_keys)
+        return failed
+
+    def delete_many(self, keys, version=None):
+        self._check_process()
+        l1_keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        with self._lock:
+            for l1_key in l1_keys:
+                self._l1.pop(l1_key, None)
+        if self._l2_available():
+            try:
+                self._l2.delete_many(keys, version=version)
+            except Exception as exc:
+                self._l2_failed(exc)
+        self._publish(l1_keys)
+
+    def clear(self):
+        self._check_process()
+        with self._lock:
+            self._l1.clear()
+        if self._l2_available():
+            try:
+                self._l2.clear()
+            except Exception as exc:
+                self._l2_failed(exc)
+        self._publish('*')
+
+    def close(self, **kwargs):
+        try:
+            self._l2.close(**kwargs)
+        except Exception:
+            pass
+
+    def stats(self):
+        """Per-process hit/miss counters and L1 occupancy."""
+        stats = dict(self._stats)
+        lookups = stats['l1_hits'] + stats['l2_hits'] + stats['misses']
+        stats['l1_size'] = len(self._l1)
+        stats['l1_max_entries'] = self._l1_max
+        stats['hit_ratio'] = (stats['l1_hits'] + stats['l2_hits']) / lookups if lookups else 0.0
+        stats['l1_hit_ratio'] = stats['l1_hits'] / lookups if lookups else 0.0
+        return stats
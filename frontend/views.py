@@ -1,7 +1,7 @@
 from django.shortcuts import render
 from django.core.cache import cache
 from django.http import JsonResponse
-from django.db.models import Sum, Count, Q, Avg
+from django.db.models import Sum, Count, Q
 import requests
 import concurrent.futures
 import json
@@ -13,7 +13,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 from django.contrib.auth.decorators import login_required
-from payments.models import Payment
+from payments.models import Payment, PaymentArchive
 from trades.models import CryptoTrade, TradeRate
 
 
@@ -42,20 +42,24 @@ def dashboard(request):
     # Recent payments (last 5)
     recent_payments = Payment.objects.filter(user=user).order_by('-created_at')[:5]
 
-    # Payment aggregates
-    payment_qs = Payment.objects.filter(user=user)
-    payment_agg = payment_qs.aggregate(
-        total_spent=Sum('amount'),
-        avg_amount=Avg('amount'),
-        total_count=Count('id'),
-    )
-    payment_total_spent = payment_agg.get('total_spent') or 0
-    payment_avg_amount = payment_agg.get('avg_amount') or 0
-    payment_total_count = payment_agg.get('total_count') or 0
-
-    payment_success = payment_qs.filter(status='success').count()
-    payment_failed = payment_qs.filter(status='failed').count()
-    payment_pending = payment_qs.filter(status='pending').count()
+    # Payment aggregates, over both the hot table and the archive (one query each)
+    payment_total_spent = 0
+    payment_total_count = 0
+    payment_success = payment_failed = payment_pending = 0
+    for model in (Payment, PaymentArchive):
+        agg = model.objects.filter(user=user).aggregate(
+            total_spent=Sum('amount'),
+            total_count=Count('id'),
+            success=Count('id', filter=Q(status='success')),
+            failed=Count('id', filter=Q(status='failed')),
+            pending=Count('id', filter=Q(status='pending')),
+        )
+        payment_total_spent += agg.get('total_spent') or 0
+        payment_total_count += agg.get('total_count') or 0
+        payment_success += agg.get('success') or 0
+        payment_failed += agg.get('failed') or 0
+        payment_pending += agg.get('pending') or 0
+    payment_avg_amount = (payment_total_spent / payment_total_count) if payment_total_count else 0
 
     payment_success_rate = (payment_success / payment_total_count * 100) if payment_total_count else 0
 
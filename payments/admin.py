@@ -3,7 +3,8 @@ from django.http import HttpResponse
 from django.urls import path
 from django.shortcuts import redirect
 import csv
-from .models import Payment, PaymentAccessLog
+import json
+from .models import Payment, PaymentAccessLog, PaymentArchive, PaymentPayload
 
 
 class PaymentAccessLogInline(admin.TabularInline):
@@ -14,15 +15,34 @@ class PaymentAccessLogInline(admin.TabularInline):
     can_delete = False
     show_change_link = False
 
+class PaymentPayloadInline(admin.TabularInline):
+    """Raw upstream payloads; only loaded on the payment change page."""
+    model = PaymentPayload
+    fields = ('created_at', 'kind', 'payload')
+    readonly_fields = ('created_at', 'kind', 'payload')
+    extra = 0
+    can_delete = False
+    show_change_link = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def payload(self, obj):
+        try:
+            return json.dumps(obj.data, indent=2)[:5000]
+        except Exception:
+            return '-'
+
+
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'amount', 'status', 'checkout_request_id', 'mpesa_receipt_number', 'created_at')
     list_editable = ('status',)
     readonly_fields = ('created_at', 'updated_at')
     search_fields = ('checkout_request_id', 'mpesa_receipt_number', 'user__username')
-    list_filter = ('status', 'created_at')
+    list_filter = ('status', 'credential_name', 'created_at')
     ordering = ('-created_at',)
-    inlines = [PaymentAccessLogInline]
+    inlines = [PaymentPayloadInline, PaymentAccessLogInline]
     actions = ['admin_download_receipt']
 
     def get_urls(self):
@@ -86,9 +106,31 @@ def export_access_logs_csv(modeladmin, request, queryset):
 
 @admin.register(PaymentAccessLog)
 class PaymentAccessLogAdmin(admin.ModelAdmin):
-    list_display = ('id', 'payment', 'user', 'username', 'action', 'ip_address', 'created_at')
+    # payment_id, not the FK: rendering `payment` costs a query per row, and fails once it is archived
+    list_display = ('id', 'payment_id', 'user', 'username', 'action', 'ip_address', 'created_at')
+    list_select_related = ('user',)
     readonly_fields = ('payment', 'user', 'username', 'action', 'ip_address', 'user_agent', 'note', 'created_at')
-    search_fields = ('payment__id', 'user__username', 'username', 'ip_address')
+    search_fields = ('payment_id__exact', 'user__username', 'username', 'ip_address')
     list_filter = ('action', 'created_at')
     ordering = ('-created_at',)
     actions = [export_access_logs_csv]
+
+
+@admin.register(PaymentArchive)
+class PaymentArchiveAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'amount', 'status', 'checkout_request_id', 'mpesa_receipt_number', 'created_at', 'archived_at')
+    search_fields = ('id', 'checkout_request_id', 'mpesa_receipt_number', 'user__username')
+    list_filter = ('status', 'created_at')
+    ordering = ('-created_at',)
+    exclude = ('payloads_blob',)
+    readonly_fields = ('payloads_json',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def payloads_json(self, obj):
+        return json.dumps(obj.payloads, indent=2)[:10000] if obj else '-'
+    payloads_json.short_description = 'Payloads'
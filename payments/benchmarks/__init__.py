@@ -0,0 +1 @@
+"""Performance benchmarks (run through management commands, not the test suite)."""
@@ -0,0 +1,84 @@
+"""Microbenchmark of callback decoding: the single-pass decoder vs the old view parsing.
+
+Payloads are generated with the Daraja simulator's callback shape (successes
+with the full `CallbackMetadata`, failures without) and decoded from raw bytes,
+the way they reach the view. `legacy_decode` reproduces the parsing the callback
+view did before `callback_decoder` (stdlib `json`, one scan of the items per
+field) so the two can be compared on the same machine.
+"""
+import json
+import random
+import time
+
+from payments.benchmarks.purchase_flow import percentile
+from payments.utils import callback_decoder
+
+RECEIPT_NAMES = ('mpesa_receipt_number', 'receiptnumber', 'transactionreceipt', 'mpesareceiptnumber')
+
+
+def sample_payloads(count, success_rate=0.85, seed=1):
+    """`count` callback bodies as JSON bytes."""
+    rng = random.Random(seed)
+    payloads = []
+    for i in range(count):
+        stk = {'MerchantRequestID': f'29115-{i}', 'CheckoutRequestID': f'ws_CO_{i:012d}'}
+        if rng.random() < success_rate:
+            stk.update(ResultCode=0, ResultDesc='The service request is processed successfully.',
+                       CallbackMetadata={'Item': [
+                           {'Name': 'Amount', 'Value': rng.randint(1, 5000)},
+                           {'Name': 'MpesaReceiptNumber', 'Value': f'NLJ7RT{i:05d}'},
+                           {'Name': 'TransactionDate', 'Value': 20261019101500},
+                           {'Name': 'PhoneNumber', 'Value': 254712000000 + i},
+                       ]})
+        else:
+            stk.update(ResultCode=1032, ResultDesc='Request cancelled by user')
+        payloads.append(json.dumps({'Body': {'stkCallback': stk}}).encode('utf-8'))
+    return payloads
+
+
+def legacy_decode(raw):
+    """The pre-decoder view parsing, kept only as the benchmark baseline."""
+    data = json.loads(raw.decode('utf-8'))
+    stk = data.get('Body', {}).get('stkCallback')
+    fields = {'checkout_id': stk.get('CheckoutRequestID'), 'result_code': int(stk.get('ResultCode')),
+              'receipt': None, 'amount': None, 'phone': None}
+    items = stk.get('CallbackMetadata', {}).get('Item')
+    if isinstance(items, list):
+        for it in items:
+            if (it.get('Name') or '').lower() in RECEIPT_NAMES:
+                fields['receipt'] = it.get('Value')
+                break
+        for it in items:
+            if (it.get('Name') or '').lower() == 'amount':
+                fields['amount'] = it.get('Value')
+                break
+        for it in items:
+            if (it.get('Name') or '').lower() == 'phonenumber':
+                fields['phone'] = it.get('Value')
+                break
+    return fields
+
+
+def _time(fn, payloads, rounds):
+    per_call_us = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for raw in payloads:
+            fn(raw)
+        per_call_us.append((time.perf_counter() - started) * 1e6 / len(payloads))
+    return {'p50_us': round(percentile(per_call_us, 50), 3), 'min_us': round(min(per_call_us), 3)}
+
+
+def run(count=2000, rounds=7):
+    """Decode `count` payloads `rounds` times with each implementation; per-callback microseconds."""
+    payloads = sample_payloads(count)
+    results = {
+        'payloads': count,
+        'rounds': rounds,
+        'backend': callback_decoder.BACKEND,
+        'legacy': _time(legacy_decode, payloads, rounds),
+        'decoder': _time(callback_decoder.decode, payloads, rounds),
+    }
+    results['speedup'] = round(results['legacy']['p50_us'] / results['decoder']['p50_us'], 2) \
+        if results['decoder']['p50_us'] else None
+    return results
@@ -0,0 +1,273 @@
+"""End-to-end purchase-flow benchmark.
+
+Drives the full lifecycle through the real views, at a configurable concurrency,
+against the local Daraja simulator (`payments.utils.daraja_simulator`):
+
+    initiate (POST /payments/initiate/, STK push to the simulator)
+      -> settle (simulator callback into /payments/callback/, or status polls
+         with `_poll_payment_status_sync` when settle='poll')
+      -> status (GET /payments/status/<id>/ until SUCCESS/FAILED, like the frontend)
+      -> receipt (GET /payments/receipt/<id>/download/, successful payments only)
+
+and reports throughput, p50/p95/p99 latency per stage, database queries per
+purchase and Daraja calls per purchase. The benchmark stands in for the Celery
+worker: the poll task the initiate view enqueues is recorded, not sent to a broker.
+"""
+import json
+import logging
+import math
+import platform
+import subprocess
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from payments import tasks as payment_tasks
+from payments.models import Payment
+from payments.utils import mpesa_api
+from payments.utils.daraja_simulator import DarajaSimulator, SimulatorConfig
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('initiate', 'settle', 'status', 'receipt', 'total')
+SETTLED = ('SUCCESS', 'FAILED')
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    return {
+        'count': len(samples),
+        'mean_ms': round(1000 * sum(samples) / len(samples), 2) if samples else 0.0,
+        'p50_ms': round(1000 * percentile(samples, 50), 2),
+        'p95_ms': round(1000 * percentile(samples, 95), 2),
+        'p99_ms': round(1000 * percentile(samples, 99), 2),
+        'max_ms': round(1000 * max(samples), 2) if samples else 0.0,
+    }
+
+
+def compare(current, baseline):
+    """Relative change of throughput and per-stage p50/p95 between two result dicts."""
+    def delta(new, old):
+        return round(100.0 * (new - old) / old, 1) if old else None
+
+    diff = {'throughput_per_sec': delta(current['throughput_per_sec'], baseline.get('throughput_per_sec', 0))}
+    for stage, stats in current['stages'].items():
+        old = baseline.get('stages', {}).get(stage)
+        if old:
+            diff[stage] = {k: delta(stats[k], old.get(k, 0)) for k in ('p50_ms', 'p95_ms')}
+    return diff
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+class _QueryCounter:
+    """Counts SQL statements on every connection it is installed on (one per thread)."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+class PurchaseFlowBenchmark:
+    def __init__(self, purchases=50, concurrency=8, settle='callback', simulator_config=None,
+                 status_interval=0.05, settle_timeout=30.0, progress=None):
+        """
+        Args:
+            purchases: Number of purchases to run
+            concurrency: Purchases in flight at once (worker threads)
+            settle: 'callback' (simulator callbacks) or 'poll' (status queries, no callbacks)
+            simulator_config: `SimulatorConfig` for the Daraja stand-in
+            status_interval: Seconds between status polls, as the frontend would
+            settle_timeout: Give up on a purchase that has not settled after this long
+        """
+        if settle not in ('callback', 'poll'):
+            raise ValueError("settle must be 'callback' or 'poll'")
+        self.purchases = int(purchases)
+        self.concurrency = max(1, int(concurrency))
+        self.settle = settle
+        self.config = simulator_config or SimulatorConfig(latency='uniform:20,80', rate_limit=0,
+                                                          callback_delay=(0.05, 0.3))
+        self.status_interval = status_interval
+        self.settle_timeout = settle_timeout
+        self.progress = progress
+        self.queries = _QueryCounter()
+        self._samples = defaultdict(list)
+        self._outcomes = Counter()
+        self._errors = Counter()
+        self._lock = threading.Lock()
+        self._done = 0
+
+    # --- plumbing ---
+
+    def _record(self, stage, seconds):
+        with self._lock:
+            self._samples[stage].append(seconds)
+
+    def _error(self, stage, detail):
+        with self._lock:
+            self._errors[stage] += 1
+        logger.warning('benchmark: %s failed: %s', stage, detail)
+
+    def _deliver_callback(self, url, payload):
+        # the simulator's callback, delivered in-process to the real callback view
+        with connection.execute_wrapper(self.queries):
+            try:
+                Client().post(reverse('payments:mpesa-callback'), data=json.dumps(payload),
+                              content_type='application/json')
+            finally:
+                connections.close_all()
+
+    # --- one purchase ---
+
+    def _purchase(self, index, user):
+        client = Client()
+        client.force_login(user)
+        started = time.perf_counter()
+        with connection.execute_wrapper(self.queries):
+            try:
+                self._run_purchase(index, client, started)
+            finally:
+                connections.close_all()
+        with self._lock:
+            self._done += 1
+            done = self._done
+        if self.progress and (done % max(1, self.purchases // 10) == 0 or done == self.purchases):
+            self.progress(f'  ... {done}/{self.purchases} purchases')
+
+    def _run_purchase(self, index, client, started):
+        t0 = time.perf_counter()
+        resp = client.post(reverse('payments:payments-initiate'), data=json.dumps({
+            'phone_number': f'2547{index % 100000000:08d}',
+            'amount': 10,
+            'account_ref': f'BENCH{index}',
+        }), content_type='application/json', REMOTE_ADDR=f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}')
+        self._record('initiate', time.perf_counter() - t0)
+        body = resp.json() if resp.get('Content-Type', '').startswith('application/json') else {}
+        payment_id = body.get('payment_id')
+        if resp.status_code != 200 or not payment_id:
+            self._error('initiate', f'{resp.status_code} {body}')
+            return
+
+        t0 = time.perf_counter()
+        status_url = reverse('payments:payments-status-api', args=[payment_id])
+        deadline = t0 + self.settle_timeout
+        status = None
+        status_times = []
+        while time.perf_counter() < deadline:
+            if self.settle == 'poll':
+                payment_tasks._poll_payment_status_sync(payment_id)
+            s0 = time.perf_counter()
+            status = client.get(status_url).json().get('status')
+            status_times.append(time.perf_counter() - s0)
+            if status in SETTLED:
+                break
+            time.sleep(self.status_interval)
+        for seconds in status_times:
+            self._record('status', seconds)
+        if status not in SETTLED:
+            self._error('settle', f'payment {payment_id} not settled after {self.settle_timeout}s')
+            return
+        self._record('settle', time.perf_counter() - t0)
+        with self._lock:
+            self._outcomes[status.lower()] += 1
+
+        if status == 'SUCCESS':
+            t0 = time.perf_counter()
+            resp = client.get(reverse('payments:receipt_download', args=[payment_id]))
+            self._record('receipt', time.perf_counter() - t0)
+            if resp.status_code != 200:
+                self._error('receipt', resp.status_code)
+        self._record('total', time.perf_counter() - started)
+
+    # --- run ---
+
+    def run(self):
+        deliver = self._deliver_callback if self.settle == 'callback' else (lambda url, payload: None)
+        simulator = DarajaSimulator(self.config, deliver=deliver)
+        base_url = simulator.start()
+        user, _ = get_user_model().objects.get_or_create(username='bench_purchase_flow')
+        overrides = override_settings(
+            MPESA_BASE_URL=base_url, MPESA_SIMULATE=False, MPESA_ASYNC_INITIATE=False,
+            MPESA_CONSUMER_KEY='bench-key', MPESA_CONSUMER_SECRET='bench-secret', MPESA_SHORTCODE='174379',
+            MPESA_PASSKEY='bench-pass', MPESA_CALLBACK_URL='http://127.0.0.1/payments/callback/',
+            MPESA_CREDENTIALS=[], MPESA_RATE_LIMIT_REQUESTS=1000000, MPESA_RATE_LIMIT_PERIOD=60,
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+        )
+        try:
+            with overrides, \
+                 mock.patch.object(mpesa_api, '_credential_pool', None), \
+                 mock.patch.object(mpesa_api, '_token_cache', {'token': None, 'expiry': 0.0}), \
+                 mock.patch('payments.utils.rate_limit._mpesa_rate_limiter', None), \
+                 mock.patch.object(payment_tasks.poll_payment_status, 'delay', create=True):
+                mpesa_api.get_daraja_breaker().reset()
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                    for future in [pool.submit(self._purchase, i, user) for i in range(self.purchases)]:
+                        future.result()
+                elapsed = time.perf_counter() - started
+        finally:
+            simulator.stop()
+
+        completed = len(self._samples['total'])
+        upstream = sum(simulator.stats[k] for k in ('token_requests', 'stk_push_requests', 'query_requests'))
+        return {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'git_revision': _git_revision(),
+                'python': platform.python_version(),
+                'database': connection.vendor,
+            },
+            'config': {
+                'purchases': self.purchases,
+                'concurrency': self.concurrency,
+                'settle': self.settle,
+                'status_interval': self.status_interval,
+                'simulator': {
+                    'error_rate': self.config.error_rate,
+                    'timeout_rate': self.config.timeout_rate,
+                    'rate_limit': self.config.rate_limit,
+                    'callback_delay': list(self.config.callback_delay),
+                    'outcomes': {str(k): v for k, v in self.config.outcomes.items()},
+                },
+            },
+            'elapsed_sec': round(elapsed, 3),
+            'completed': completed,
+            'throughput_per_sec': round(completed / elapsed, 2) if elapsed else 0.0,
+            'stages': {stage: summarize(self._samples[stage]) for stage in STAGES},
+            'db_queries_per_purchase': round(self.queries.count / completed, 2) if completed else None,
+            'upstream_calls_per_purchase': round(upstream / completed, 2) if completed else None,
+            'upstream': dict(simulator.stats),
+            'outcomes': dict(self._outcomes),
+            'errors': dict(self._errors),
+            'payments_created': Payment.objects.filter(user=user).count(),
+        }
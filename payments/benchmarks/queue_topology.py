@@ -0,0 +1,110 @@
+"""Celery queue-topology benchmark: does a poll backlog delay notifications?
+
+Runs a throwaway Celery app on the in-memory broker with solo-pool workers in
+threads, so no Redis is needed. Stand-in tasks are routed like the real
+`payments.tasks.poll_payment_status` and `payments.tasks.send_payment_notification`
+and sleep for the configured work time. A backlog of polls is published first,
+then notifications, and the time from publish to start of each notification is
+measured under two topologies:
+
+* shared — every task on the default queue, served by all workers;
+* routed — CELERY_TASK_ROUTES from settings, with the same workers split into a
+  polls pool and a notifications pool.
+"""
+import multiprocessing
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+
+from payments.benchmarks.purchase_flow import summarize
+
+POLL_TASK = 'payments.tasks.poll_payment_status'
+NOTIFY_TASK = 'payments.tasks.send_payment_notification'
+TOPOLOGIES = ('shared', 'routed')
+
+
+def _queue_for(task_name, routes, default):
+    route = routes.get(task_name) if routes else None
+    return route['queue'] if route else default
+
+
+def run_topology(topology, polls=300, notifications=20, poll_ms=20.0, notify_ms=5.0,
+                 poll_workers=4, notification_workers=2, timeout=120.0):
+    """Publish `polls` then `notifications` tasks and time the notifications under one topology."""
+    from celery import Celery
+    from celery.contrib.testing.worker import start_worker
+
+    if topology not in TOPOLOGIES:
+        raise ValueError(f'unknown topology {topology!r}')
+    default = getattr(settings, 'CELERY_TASK_DEFAULT_QUEUE', 'default')
+    configured = dict(getattr(settings, 'CELERY_TASK_ROUTES', {}) or {}) if topology == 'routed' else {}
+    # stand-ins get their own names: shared tasks of the real names register on every app
+    routes = {f'bench.{name}': configured[name] for name in (POLL_TASK, NOTIFY_TASK) if name in configured}
+
+    app = Celery(f'bench-{topology}', broker='memory://', backend='cache+memory://', set_as_current=False)
+    app.conf.update(task_default_queue=default, task_routes=routes, worker_prefetch_multiplier=1,
+                    task_ignore_result=True, broker_transport_options={'polling_interval': 0.005})
+    lock = threading.Lock()
+    waits = []
+    polls_done = []
+
+    @app.task(name=f'bench.{POLL_TASK}')
+    def poll(published):
+        time.sleep(poll_ms / 1000.0)
+        with lock:
+            polls_done.append(time.time())
+
+    @app.task(name=f'bench.{NOTIFY_TASK}')
+    def notify(published):
+        with lock:
+            waits.append(time.time() - published)
+        time.sleep(notify_ms / 1000.0)
+
+    poll_queue = _queue_for(f'bench.{POLL_TASK}', routes, default)
+    notify_queue = _queue_for(f'bench.{NOTIFY_TASK}', routes, default)
+    workers = [poll_queue] * poll_workers + [notify_queue] * notification_workers
+
+    with ExitStack() as stack:
+        for i, queue in enumerate(workers):
+            stack.enter_context(start_worker(app, pool='solo', queues=[queue], hostname=f'{queue}-{i}@bench',
+                                             perform_ping_check=False, loglevel='ERROR', shutdown_timeout=10))
+        started = time.time()
+        for _ in range(polls):
+            poll.delay(time.time())
+        for _ in range(notifications):
+            notify.delay(time.time())
+        deadline = time.monotonic() + timeout
+        while (len(waits) < notifications or len(polls_done) < polls) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    return {
+        'topology': topology,
+        'queues': {'polls': poll_queue, 'notifications': notify_queue},
+        'notification_wait': summarize(waits),
+        'notifications_done': len(waits),
+        'polls_done': len(polls_done),
+        'poll_drain_s': round(max(polls_done) - started, 3) if polls_done else None,
+    }
+
+
+def _run_in_child(topology, options):
+    return run_topology(topology, **options)
+
+
+def run(topologies=TOPOLOGIES, **options):
+    """Run each topology with the same load; results keyed by topology.
+
+    Each run gets a forked process of its own: the in-memory broker and Celery's
+    worker machinery keep process-wide state that a second run would trip over.
+    """
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:  # no fork (Windows): a single topology per invocation
+        return {topology: run_topology(topology, **options) for topology in topologies}
+    results = {}
+    for topology in topologies:
+        with context.Pool(1) as pool:
+            results[topology] = pool.apply(_run_in_child, (topology, options))
+    return results
@@ -1,8 +1,14 @@
+import hashlib
+import logging
 from functools import wraps
-from django.http import HttpResponseForbidden
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse
 from django.contrib.auth.decorators import login_required
-from payments.models import PaymentAccessLog, Payment
-from django.shortcuts import get_object_or_404
+from payments.models import PaymentAccessLog
+from payments.utils.archive import get_payment
+
+logger = logging.getLogger(__name__)
 
 
 def support_required(view_func):
@@ -53,7 +59,10 @@ def audit_and_require_payment_view(param_name='pk'):
                 except Exception:
                     return HttpResponseForbidden('Missing payment identifier')
 
-            payment = get_object_or_404(Payment, pk=pid)
+            # archived payments keep their id, so detail links stay valid after archiving
+            payment = get_payment(pid)
+            if payment is None:
+                raise Http404('Payment not found')
 
             is_owner = (payment.user_id == request.user.id)
             is_staff = getattr(request.user, 'is_staff', False) or getattr(request.user, 'is_superuser', False)
@@ -63,7 +72,7 @@ def audit_and_require_payment_view(param_name='pk'):
                 # log unauthorized attempt
                 try:
                     PaymentAccessLog.objects.create(
-                        payment=payment,
+                        payment_id=payment.pk,
                         user=request.user if request.user.is_authenticated else None,
                         username=request.user.get_username() if request.user.is_authenticated else None,
                         action='view',
@@ -78,7 +87,7 @@ def audit_and_require_payment_view(param_name='pk'):
             # authorized -> log access
             try:
                 PaymentAccessLog.objects.create(
-                    payment=payment,
+                    payment_id=payment.pk,
                     user=request.user if request.user.is_authenticated else None,
                     username=request.user.get_username() if request.user.is_authenticated else None,
                     action='view',
@@ -94,3 +103,78 @@ def audit_and_require_payment_view(param_name='pk'):
         return _wrapped
 
     return decorator
+
+
+def idempotent(key_prefix, ttl=None, lock_ttl=None):
+    """Decorator factory: collapse repeated requests that carry the same `Idempotency-Key` header.
+
+    Usage:
+        @idempotent('payments_initiate')
+        def initiate_payment(request):
+            ...
+
+    The first request with a key runs the view; a successful (2xx) response is kept
+    in the cache for `ttl` seconds (PAYMENTS_IDEMPOTENCY_TTL, default 900) and replayed
+    to repeats without running the view again. While the first request is still
+    running, repeats get 409. A repeat whose body differs from the original gets 422.
+    Other responses are not kept, so the client may retry with the same key.
+    Keys are scoped to the user (or client IP for anonymous requests).
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped(request, *args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if not key:
+                return view_func(request, *args, **kwargs)
+            if len(key) > 255:
+                return JsonResponse({'success': False, 'message': 'Idempotency-Key is too long'}, status=400)
+
+            user = getattr(request, 'user', None)
+            scope = f'u{user.pk}' if getattr(user, 'is_authenticated', False) else request.META.get('REMOTE_ADDR', 'anon')
+            cache_key = f"idem:{key_prefix}:{scope}:{hashlib.sha256(key.encode('utf-8')).hexdigest()}"
+            fingerprint = hashlib.sha256(request.body or b'').hexdigest()
+            keep_for = ttl if ttl is not None else int(getattr(settings, 'PAYMENTS_IDEMPOTENCY_TTL', 900))
+            in_flight_for = lock_ttl if lock_ttl is not None else int(getattr(settings, 'PAYMENTS_IDEMPOTENCY_LOCK_TTL', 120))
+
+            try:
+                claimed = cache.add(cache_key, {'state': 'in_flight', 'fingerprint': fingerprint}, timeout=in_flight_for)
+                entry = None if claimed else cache.get(cache_key)
+            except Exception:
+                logger.exception('Idempotency cache failure; processing request without it')
+                return view_func(request, *args, **kwargs)
+
+            if not claimed:
+                if entry is None:
+                    # expired between add() and get(): treat as in flight, the client retries
+                    entry = {'state': 'in_flight', 'fingerprint': fingerprint}
+                if entry.get('fingerprint') != fingerprint:
+                    return JsonResponse({'success': False, 'message': 'Idempotency-Key was already used with a different request body'}, status=422)
+                if entry.get('state') != 'done':
+                    return JsonResponse({'success': False, 'message': 'A request with this Idempotency-Key is still being processed'}, status=409)
+                replay = HttpResponse(entry['content'], status=entry['status'], content_type=entry['content_type'])
+                replay['Idempotent-Replayed'] = 'true'
+                return replay
+
+            try:
+                response = view_func(request, *args, **kwargs)
+            except Exception:
+                cache.delete(cache_key)
+                raise
+            try:
+                if 200 <= response.status_code < 300 and not getattr(response, 'streaming', False):
+                    cache.set(cache_key, {
+                        'state': 'done',
+                        'fingerprint': fingerprint,
+                        'status': response.status_code,
+                        'content': response.content,
+                        'content_type': response.get('Content-Type'),
+                    }, timeout=keep_for)
+                else:
+                    cache.delete(cache_key)
+            except Exception:
+                logger.exception('Idempotency cache failure while storing response')
+            return response
+
+        return _wrapped
+
+    return decorator
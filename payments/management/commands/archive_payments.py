@@ -0,0 +1,66 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.utils.archive import archive_batch, archive_candidates, archive_cutoff, newest_payment_pk
+
+
+class Command(BaseCommand):
+    help = ('Move settled payments older than PAYMENT_ARCHIVE_AFTER_DAYS into the archive table, '
+            'in bounded batches (one transaction each). Safe to interrupt and re-run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, dest='days', default=None,
+                            help='Archive settled payments not updated for this many days '
+                                 '(default: settings.PAYMENT_ARCHIVE_AFTER_DAYS, 180).')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Payments moved per transaction (default: 500).')
+        parser.add_argument('--max-batches', type=int, default=0,
+                            help='Stop after this many batches (default: 0, until nothing is left).')
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help='Seconds to sleep between batches to limit load on the database.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many payments would be archived.')
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = int(getattr(settings, 'PAYMENT_ARCHIVE_AFTER_DAYS', 180))
+        batch_size = options['batch_size']
+        if days < 0:
+            raise CommandError('--older-than-days must not be negative')
+        if batch_size <= 0:
+            raise CommandError('--batch-size must be a positive number')
+
+        cutoff = archive_cutoff(days)
+        top = newest_payment_pk()
+        if top is None:
+            self.stdout.write('No payments to archive.')
+            return
+        pending = archive_candidates(cutoff, below_pk=top).count()
+        self.stdout.write(self.style.NOTICE(
+            f'{pending} settled payments last updated before {cutoff:%Y-%m-%d %H:%M} can be archived'))
+        if options['dry_run'] or not pending:
+            return
+
+        archived = 0
+        batches = 0
+        started = time.monotonic()
+        while True:
+            ids = archive_batch(cutoff, batch_size=batch_size, below_pk=top)
+            if not ids:
+                break
+            archived += len(ids)
+            batches += 1
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'  ... archived {archived}/{pending} (last id={ids[-1]}, '
+                              f'{archived / elapsed if elapsed > 0 else 0:.0f} rows/sec)')
+            if options['max_batches'] and batches >= options['max_batches']:
+                self.stdout.write(self.style.WARNING(
+                    f'Stopped after {batches} batches; run again to continue.'))
+                break
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} payments in {time.monotonic() - started:.2f}s'))
@@ -0,0 +1,26 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.benchmarks.callback_decoder import run
+
+
+class Command(BaseCommand):
+    help = 'Microbenchmark callback decoding: the single-pass decoder against the old view parsing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payloads', type=int, default=2000)
+        parser.add_argument('--rounds', type=int, default=7)
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        if options['payloads'] <= 0 or options['rounds'] <= 0:
+            raise CommandError('--payloads and --rounds must be positive')
+        results = run(count=options['payloads'], rounds=options['rounds'])
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{results['payloads']} payloads x {results['rounds']} rounds (backend: {results['backend']})")
+        for name in ('legacy', 'decoder'):
+            self.stdout.write(f"  {name:<8} p50={results[name]['p50_us']}us  min={results[name]['min_us']}us per callback")
+        self.stdout.write(f"  speedup x{results['speedup']}")
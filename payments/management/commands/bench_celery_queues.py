@@ -0,0 +1,40 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.benchmarks.queue_topology import TOPOLOGIES, run
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the Celery queue topology on an in-memory broker: notification latency behind '
+            'a backlog of status polls, with everything on one queue vs routed to per-queue pools.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--polls', type=int, default=300, help='Poll tasks published first (the backlog)')
+        parser.add_argument('--notifications', type=int, default=20)
+        parser.add_argument('--poll-ms', type=float, default=20.0, help='Simulated work per poll')
+        parser.add_argument('--notify-ms', type=float, default=5.0, help='Simulated work per notification')
+        parser.add_argument('--poll-workers', type=int, default=4)
+        parser.add_argument('--notification-workers', type=int, default=2)
+        parser.add_argument('--topology', choices=TOPOLOGIES, action='append',
+                            help='Run only this topology (repeatable; default: all)')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        if min(options['polls'], options['poll_workers'], options['notification_workers']) < 0 \
+                or options['notifications'] <= 0:
+            raise CommandError('counts must not be negative and --notifications must be positive')
+        results = run(topologies=options['topology'] or TOPOLOGIES, polls=options['polls'],
+                      notifications=options['notifications'], poll_ms=options['poll_ms'],
+                      notify_ms=options['notify_ms'], poll_workers=options['poll_workers'],
+                      notification_workers=options['notification_workers'])
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{options['polls']} polls then {options['notifications']} notifications, "
+                          f"{options['poll_workers']}+{options['notification_workers']} workers")
+        for topology, result in results.items():
+            wait = result['notification_wait']
+            self.stdout.write(f"  {topology:<7} notification wait p50={wait['p50_ms']}ms p95={wait['p95_ms']}ms "
+                              f"max={wait['max_ms']}ms  polls drained in {result['poll_drain_s']}s "
+                              f"(queues: {result['queues']['polls']}/{result['queues']['notifications']})")
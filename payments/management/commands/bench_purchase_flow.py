@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from payments.benchmarks.purchase_flow import STAGES, PurchaseFlowBenchmark, compare
+from payments.utils.daraja_simulator import SimulatorConfig, parse_latency, parse_outcomes
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the whole purchase flow (initiate -> STK push -> callback/poll -> status -> receipt) '
+            'against the local Daraja simulator and save the results as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--purchases', type=int, default=50)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--settle', choices=('callback', 'poll'), default='callback',
+                            help='How payments settle: simulator callbacks or status queries (default: callback)')
+        parser.add_argument('--latency', default='uniform:20,80', help='Simulated Daraja latency (see daraja_simulator)')
+        parser.add_argument('--error-rate', type=float, default=0.0)
+        parser.add_argument('--callback-delay', default='0.05,0.3', help='MIN,MAX seconds before the callback')
+        parser.add_argument('--outcomes', default='0=0.85,1032=0.08,1037=0.05,1=0.02')
+        parser.add_argument('--status-interval', type=float, default=0.05,
+                            help='Seconds between status polls by the simulated frontend')
+        parser.add_argument('--output', default=None, help='Write the results JSON here')
+        parser.add_argument('--baseline', default=None, help='Results JSON of an earlier run to compare against')
+        parser.add_argument('--use-current-db', action='store_true',
+                            help='Run against the configured database instead of a throwaway test database')
+
+    def handle(self, *args, **options):
+        if options['purchases'] <= 0 or options['concurrency'] <= 0:
+            raise CommandError('--purchases and --concurrency must be positive')
+        try:
+            low, high = (float(v) for v in options['callback_delay'].split(','))
+            config = SimulatorConfig(latency=parse_latency(options['latency']), error_rate=options['error_rate'],
+                                     rate_limit=0, callback_delay=(low, high),
+                                     outcomes=parse_outcomes(options['outcomes']))
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = json.loads(Path(options['baseline']).read_text())
+            except (OSError, ValueError) as exc:
+                raise CommandError(f'cannot read baseline: {exc}')
+
+        benchmark = PurchaseFlowBenchmark(
+            purchases=options['purchases'],
+            concurrency=options['concurrency'],
+            settle=options['settle'],
+            simulator_config=config,
+            status_interval=options['status_interval'],
+            progress=self.stdout.write,
+        )
+        old_name = None
+        if not options['use_current_db']:
+            if connection.vendor == 'sqlite' and not connection.settings_dict['TEST'].get('NAME'):
+                # the shared-cache in-memory test database locks whole tables across threads
+                connection.settings_dict['TEST']['NAME'] = str(
+                    Path(tempfile.gettempdir()) / f'bench_purchase_flow_{os.getpid()}.sqlite3')
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.stdout.write(f"Running {options['purchases']} purchases at concurrency {options['concurrency']} "
+                              f"(settle={options['settle']}) ...")
+            results = benchmark.run()
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if baseline:
+            results['compared_to'] = {'baseline': options['baseline'], 'change_pct': compare(results, baseline)}
+        self._report(results)
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2))
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def _report(self, results):
+        self.stdout.write(self.style.SUCCESS(
+            f"{results['completed']}/{results['config']['purchases']} purchases in {results['elapsed_sec']}s "
+            f"-> {results['throughput_per_sec']} purchases/sec"))
+        self.stdout.write(f"{'stage':<10}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for stage in STAGES:
+            s = results['stages'][stage]
+            self.stdout.write(f"{stage:<10}{s['count']:>7}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}")
+        self.stdout.write(f"DB queries/purchase: {results['db_queries_per_purchase']}   "
+                          f"Daraja calls/purchase: {results['upstream_calls_per_purchase']}")
+        self.stdout.write(f"Outcomes: {results['outcomes']}   Errors: {results['errors'] or 'none'}")
+        if 'compared_to' in results:
+            self.stdout.write(f"Change vs baseline (%): {results['compared_to']['change_pct']}")
@@ -1,9 +1,17 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 from django.db import transaction
+from django.db.models import Count, Q
 from datetime import timedelta
 from payments.models import Payment
 
+# Payments that carry an M-Pesa receipt (the money actually moved)
+HAS_RECEIPT = Q(mpesa_receipt_number__isnull=False) & ~Q(mpesa_receipt_number='')
+NO_RECEIPT = Q(mpesa_receipt_number__isnull=True) | Q(mpesa_receipt_number='')
+
+# Number of example ids listed per category at verbosity >= 2
+SAMPLE_SIZE = 10
+
 
 class Command(BaseCommand):
     help = 'Cleans up failed payments in testing/development environments.'
@@ -19,6 +27,9 @@ class Command(BaseCommand):
                             help='Only operate on payments older than this many days (default: 0, no age filter).')
         parser.add_argument('--mark-success', action='store_true', dest='mark_success', default=True,
                             help='Mark failed payments that have a mpesa_receipt_number as success (default behavior).')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=0,
+                            help='Apply changes in batches of this many rows, one transaction each '
+                                 '(default: 0, a single UPDATE/DELETE statement).')
 
     def handle(self, *args, **options):
         dry_run = options.get('dry_run') and not options.get('apply')
@@ -26,6 +37,11 @@ class Command(BaseCommand):
         delete_tests = options.get('delete_tests')
         age_days = options.get('age_days') or 0
         mark_success = options.get('mark_success')
+        batch_size = options.get('batch_size') or 0
+        verbosity = options.get('verbosity', 1)
+
+        if batch_size < 0:
+            raise CommandError('--batch-size must be zero or a positive number')
 
         cutoff = None
         if age_days > 0:
@@ -35,48 +51,39 @@ class Command(BaseCommand):
         if cutoff is not None:
             qs = qs.filter(created_at__lt=cutoff)
 
-        total = qs.count()
+        # Heuristic: payments with a receipt succeeded; the rest are probably test data
+        to_mark = qs.filter(HAS_RECEIPT) if mark_success else qs.none()
+        to_delete = qs.filter(NO_RECEIPT) if mark_success else qs
+
+        counts = qs.aggregate(total=Count('pk'), with_receipt=Count('pk', filter=HAS_RECEIPT))
+        total = counts['total']
         self.stdout.write(self.style.NOTICE(f'Found {total} failed payments (age_days={age_days})'))
 
         if total == 0:
             return
 
         summary = {
-            'to_mark_success': 0,
+            'to_mark_success': counts['with_receipt'] if mark_success else 0,
             'to_delete': 0,
             'skipped': 0,
         }
+        candidates_for_delete = total - summary['to_mark_success']
+        if delete_tests:
+            summary['to_delete'] = candidates_for_delete
+        else:
+            summary['skipped'] = candidates_for_delete
+
+        if verbosity >= 2:
+            self._write_sample('MARK', to_mark, summary['to_mark_success'])
+            self._write_sample('DELETE' if delete_tests else 'SKIP', to_delete, candidates_for_delete)
 
-        for p in qs.order_by('created_at'):
-            has_receipt = bool(p.mpesa_receipt_number)
-            # Heuristic: test payments probably have small amounts and no receipt
-            if has_receipt and mark_success:
-                summary['to_mark_success'] += 1
-                self.stdout.write(f'[MARK] Payment id={p.id} checkout={p.checkout_request_id} receipt={p.mpesa_receipt_number} amount={p.amount}')
-                if apply_changes:
-                    try:
-                        with transaction.atomic():
-                            p.status = 'success'
-                            p.error_code = None
-                            p.error_message = None
-                            p.updated_at = timezone.now()
-                            p.save()
-                    except Exception as e:
-                        self.stderr.write(self.style.ERROR(f'Failed to mark payment {p.id}: {e}'))
-            else:
-                # No receipt -> candidate for deletion if --delete-tests used
-                if delete_tests:
-                    summary['to_delete'] += 1
-                    self.stdout.write(f'[DELETE] Payment id={p.id} checkout={p.checkout_request_id} amount={p.amount}')
-                    if apply_changes:
-                        try:
-                            with transaction.atomic():
-                                p.delete()
-                        except Exception as e:
-                            self.stderr.write(self.style.ERROR(f'Failed to delete payment {p.id}: {e}'))
-                else:
-                    summary['skipped'] += 1
-                    self.stdout.write(f'[SKIP] Payment id={p.id} (no receipt)')
+        if apply_changes:
+            if summary['to_mark_success']:
+                marked = self._mark_success(to_mark, batch_size)
+                self.stdout.write(f'Marked {marked} payments as success')
+            if delete_tests and summary['to_delete']:
+                deleted = self._delete(to_delete, batch_size)
+                self.stdout.write(f'Deleted {deleted} payments')
 
         # Summary
         self.stdout.write('\nSummary:')
@@ -89,3 +96,59 @@ class Command(BaseCommand):
         else:
             self.stdout.write(self.style.SUCCESS('\nCleanup complete.'))
 
+    def _write_sample(self, label, queryset, count):
+        if not count:
+            return
+        ids = list(queryset.order_by('created_at').values_list('pk', flat=True)[:SAMPLE_SIZE])
+        more = f' (+{count - len(ids)} more)' if count > len(ids) else ''
+        self.stdout.write(f"[{label}] {count} payments, e.g. ids {', '.join(str(i) for i in ids)}{more}")
+
+    def _batches(self, queryset, batch_size):
+        """Yield primary-key lists of at most `batch_size` rows, walking the table in id order."""
+        last_pk = 0
+        while True:
+            ids = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return
+            last_pk = ids[-1]
+            yield ids
+
+    def _mark_success(self, queryset, batch_size):
+        values = {
+            'status': 'success',
+            'error_code': None,
+            'error_message': None,
+            # QuerySet.update() bypasses auto_now, so stamp it explicitly
+            'updated_at': timezone.now(),
+        }
+        try:
+            if not batch_size:
+                # a single UPDATE statement is atomic on its own
+                return queryset.update(**values)
+            marked = 0
+            for ids in self._batches(queryset, batch_size):
+                with transaction.atomic():
+                    marked += Payment.objects.filter(pk__in=ids, status='failed').update(**values)
+                self.stdout.write(f'  ... marked {marked}')
+            return marked
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f'Failed to mark payments as success: {e}'))
+            return 0
+
+    def _delete(self, queryset, batch_size):
+        try:
+            if not batch_size:
+                with transaction.atomic():
+                    _, per_model = queryset.delete()
+                return per_model.get(Payment._meta.label, 0)
+            deleted_total = 0
+            for ids in self._batches(queryset, batch_size):
+                with transaction.atomic():
+                    # Re-check the status so rows updated since the batch was read are left alone
+                    _, per_model = Payment.objects.filter(pk__in=ids, status='failed').delete()
+                deleted_total += per_model.get(Payment._meta.label, 0)
+                self.stdout.write(f'  ... deleted {deleted_total}')
+            return deleted_total
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f'Failed to delete payments: {e}'))
+            return 0
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.utils.daraja_simulator import DarajaSimulator, SimulatorConfig, parse_latency, parse_outcomes
+
+
+class Command(BaseCommand):
+    help = ('Run a local Daraja stand-in (OAuth, STK push, status query, delayed callbacks) for offline '
+            'load and failure testing. Point MPESA_BASE_URL at it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8090)
+        parser.add_argument('--latency', default='uniform:50,200',
+                            help='Response latency: fixed:MS, uniform:MIN_MS,MAX_MS, lognormal:MEDIAN_MS,SIGMA or none '
+                                 '(default: uniform:50,200)')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of calls answered with a 500')
+        parser.add_argument('--timeout-rate', type=float, default=0.0,
+                            help='Fraction of calls held for --timeout-seconds so the client times out')
+        parser.add_argument('--timeout-seconds', type=float, default=30.0)
+        parser.add_argument('--rate-limit', type=int, default=5,
+                            help='Requests per consumer key per --rate-period seconds; 0 disables (default: 5)')
+        parser.add_argument('--rate-period', type=float, default=60.0)
+        parser.add_argument('--callback-delay', default='2,8',
+                            help='MIN,MAX seconds before the STK callback is delivered (default: 2,8)')
+        parser.add_argument('--outcomes', default='0=0.85,1032=0.08,1037=0.05,1=0.02',
+                            help='ResultCode weights for STK pushes (default: 0=0.85,1032=0.08,1037=0.05,1=0.02)')
+        parser.add_argument('--callback-url', default=None,
+                            help="Deliver callbacks here instead of the request's CallBackURL "
+                                 '(e.g. http://127.0.0.1:8000/payments/callback/)')
+
+    def handle(self, *args, **options):
+        try:
+            low, high = (float(v) for v in options['callback_delay'].split(','))
+            config = SimulatorConfig(
+                latency=parse_latency(options['latency']),
+                error_rate=options['error_rate'],
+                timeout_rate=options['timeout_rate'],
+                timeout_seconds=options['timeout_seconds'],
+                rate_limit=options['rate_limit'],
+                rate_period=options['rate_period'],
+                callback_delay=(low, high),
+                outcomes=parse_outcomes(options['outcomes']),
+                callback_url=options['callback_url'],
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        simulator = DarajaSimulator(config)
+        server = simulator.serve(options['host'], options['port'])
+        host, port = server.server_address[:2]
+        self.stdout.write(self.style.SUCCESS(f'Daraja simulator listening on http://{host}:{port}'))
+        self.stdout.write(f'Set MPESA_BASE_URL=http://{host}:{port} for the web and Celery processes. Ctrl+C to stop.')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            simulator.stop()
+            self.stdout.write(f'Stats: {dict(simulator.stats)}')
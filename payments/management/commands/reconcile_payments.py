@@ -1,92 +1,81 @@
 from django.core.management.base import BaseCommand
-from payments.models import Payment
-from django.utils import timezone
-import json
+from payments.utils.reconcile import ReconcileEngine, UpstreamVerifier
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Cap on the per-payment listing printed at the end of a run
+MAX_LISTED = 50
+
+
 class Command(BaseCommand):
     help = 'Reconcile failed payments using stored callback_raw_data and update statuses where callback shows success.'
 
     def add_arguments(self, parser):
         parser.add_argument('--dry-run', action='store_true', help='Show changes without applying')
         parser.add_argument('--limit', type=int, default=0, help='Limit number of payments to process (0 = all)')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Payments read and bulk-updated per chunk (default: 500)')
+        parser.add_argument('--workers', type=int, default=4, help='Callback parsing pool size; 1 parses inline (default: 4)')
+        parser.add_argument('--checkpoint', default=None,
+                            help='Path of a checkpoint file; an interrupted run resumes after the last processed id')
+        parser.add_argument('--verify-upstream', action='store_true',
+                            help='Also query Daraja for pending payments and failed payments without a stored callback')
+        parser.add_argument('--verify-workers', type=int, default=4,
+                            help='Concurrent upstream status queries; all share the M-Pesa rate limiter (default: 4)')
 
     def handle(self, *args, **options):
         dry = options['dry_run']
-        limit = options['limit']
-
-        qs = Payment.objects.filter(status='failed').order_by('-created_at')
-        total = qs.count()
-        self.stdout.write(f'Found {total} failed payments to inspect')
-
-        if limit and limit > 0:
-            qs = qs[:limit]
-
-        fixed = []
-        for p in qs:
-            data = p.callback_raw_data
-            if not data:
-                continue
-            try:
-                # Normalize to dict if JSON string
-                if isinstance(data, str):
-                    data = json.loads(data)
-            except Exception:
-                # skip unparsable
-                continue
 
-            # Look for common success indicators
-            success = False
-            receipt = None
+        engine = ReconcileEngine(
+            chunk_size=options['chunk_size'],
+            workers=options['workers'],
+            dry_run=dry,
+            limit=options['limit'],
+            checkpoint=options['checkpoint'],
+            progress=self.stdout.write,
+        )
 
-            # Case 1: MPESA new style Body->stkCallback with ResultCode
-            try:
-                body = data.get('Body') if isinstance(data, dict) else None
-                stk = body.get('stkCallback') if isinstance(body, dict) else None
-                if isinstance(stk, dict):
-                    rc = stk.get('ResultCode')
-                    # coerce and check
-                    if rc is not None:
-                        try:
-                            if int(rc) == 0:
-                                success = True
-                                # extract receipt metadata
-                                items = stk.get('CallbackMetadata', {}).get('Item')
-                                if isinstance(items, list):
-                                    for it in items:
-                                        name = (it.get('Name') or '').lower()
-                                        if 'receipt' in name or 'mpesa_receipt' in name:
-                                            receipt = it.get('Value')
-                                            break
-                        except Exception:
-                            # unable to coerce rc to int; ignore
-                            pass
-                # Case 2: older style top-level ResponseCode / ResponseDescription
-                if not success and isinstance(data, dict):
-                    resp_code = data.get('ResponseCode') or data.get('responseCode')
-                    if resp_code is not None and str(resp_code).strip() == '0':
-                        success = True
-                        receipt = receipt or data.get('MpesaReceiptNumber') or data.get('ReceiptNumber')
-            except Exception:
-                logger.exception('Error while parsing callback for payment %s', p.id)
+        resume_from = engine.load_checkpoint()
+        if resume_from:
+            self.stdout.write(f'Resuming from checkpoint after payment id={resume_from}')
+        total = engine.queryset().filter(pk__gt=resume_from).count()
+        self.stdout.write(f'Found {total} failed payments to inspect')
 
-            if success:
-                fixed.append((p.id, receipt))
-                if not dry:
-                    p.status = 'success'
-                    if receipt:
-                        p.mpesa_receipt_number = receipt
-                    p.error_code = None
-                    p.error_message = None
-                    p.updated_at = timezone.now()
-                    p.save()
+        result = engine.run()
+        fixed = result['fixed']
 
-        self.stdout.write(f'Processed {qs.count()} payments; marked {len(fixed)} as success')
+        self.stdout.write(f"Processed {result['inspected']} payments; marked {len(fixed)} as success "
+                          f"({result['rows_per_sec']:.0f} rows/sec, {result['elapsed']:.2f}s)")
         if fixed:
-            self.stdout.write('Updated payments:')
-            for pid, rec in fixed:
+            self.stdout.write('Updated payments:' if not dry else 'Would update payments:')
+            for pid, rec in fixed[:MAX_LISTED]:
                 self.stdout.write(f' - id={pid} receipt={rec}')
+            if len(fixed) > MAX_LISTED:
+                self.stdout.write(f' ... and {len(fixed) - MAX_LISTED} more')
         else:
             self.stdout.write('No payments needed updating')
+
+        if not result['complete'] and options['checkpoint'] and not dry:
+            self.stdout.write(f"Stopped at --limit; re-run with --checkpoint {options['checkpoint']} to continue")
+
+        if options['verify_upstream']:
+            self.verify_upstream(options)
+
+    def verify_upstream(self, options):
+        dry = options['dry_run']
+        verifier = UpstreamVerifier(
+            workers=options['verify_workers'],
+            dry_run=dry,
+            limit=options['limit'],
+            progress=self.stdout.write,
+        )
+        self.stdout.write('Verifying payments without a usable callback against Daraja...')
+        result = verifier.run()
+        self.stdout.write(f"Verified {result['verified']}/{result['total']} payments in {result['elapsed']:.1f}s: "
+                          f"{result['success']} success, {result['failed']} failed, "
+                          f"{result['unchanged']} unchanged, {result['errors']} not definitive")
+        for pid, status, rec in result['changed'][:MAX_LISTED]:
+            prefix = 'Would mark' if dry else 'Marked'
+            self.stdout.write(f' - {prefix} id={pid} {status} receipt={rec}')
+        if len(result['changed']) > MAX_LISTED:
+            self.stdout.write(f" ... and {len(result['changed']) - MAX_LISTED} more")
@@ -0,0 +1,66 @@
+import json
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.benchmarks.purchase_flow import percentile
+
+
+def summarize_traces(spans):
+    """Group exported spans by trace: duration, push-to-settle and time per span name."""
+    traces = defaultdict(list)
+    for span in spans:
+        traces[span['trace_id']].append(span)
+    summaries = []
+    for trace_id, members in traces.items():
+        start = min(s['start'] for s in members)
+        end = max(s['start'] + (s['duration_ms'] or 0) / 1000 for s in members)
+        by_name = defaultdict(float)
+        settle = None
+        checkout = None
+        for s in members:
+            by_name[s['name']] += s['duration_ms'] or 0
+            attrs = s.get('attributes') or {}
+            settle = attrs.get('payment.push_to_settle_ms', settle)
+            checkout = attrs.get('mpesa.checkout_id', checkout)
+        summaries.append({
+            'trace_id': trace_id,
+            'checkout_id': checkout,
+            'spans': len(members),
+            'duration_ms': round((end - start) * 1000, 1),
+            'push_to_settle_ms': settle,
+            'errors': sum(1 for s in members if s.get('status') == 'error'),
+            'by_name_ms': {k: round(v, 1) for k, v in sorted(by_name.items(), key=lambda kv: -kv[1])},
+        })
+    return summaries
+
+
+class Command(BaseCommand):
+    help = 'Summarise purchase traces exported to a JSONL file (TRACING_EXPORTER=jsonl): slowest purchases and push-to-settle latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=None, help='Trace file (default: settings.TRACING_FILE)')
+        parser.add_argument('--top', type=int, default=10, help='Show this many of the slowest purchases')
+
+    def handle(self, *args, **options):
+        path = Path(options['file'] or getattr(settings, 'TRACING_FILE', '') or Path(settings.BASE_DIR) / 'traces.jsonl')
+        try:
+            with path.open(encoding='utf-8') as fh:
+                spans = [json.loads(line) for line in fh if line.strip()]
+        except (OSError, ValueError) as exc:
+            raise CommandError(f'cannot read {path}: {exc}')
+
+        summaries = summarize_traces(spans)
+        settled = [s['push_to_settle_ms'] for s in summaries if s['push_to_settle_ms'] is not None]
+        self.stdout.write(f'{len(spans)} spans in {len(summaries)} traces from {path}')
+        if settled:
+            self.stdout.write('push-to-settle ms: p50={} p95={} p99={} (n={})'.format(
+                percentile(settled, 50), percentile(settled, 95), percentile(settled, 99), len(settled)))
+        key = lambda s: s['push_to_settle_ms'] if s['push_to_settle_ms'] is not None else s['duration_ms']
+        for s in sorted(summaries, key=key, reverse=True)[:options['top']]:
+            self.stdout.write(f"{s['trace_id']} checkout={s['checkout_id']} total={s['duration_ms']}ms "
+                              f"push_to_settle={s['push_to_settle_ms']}ms spans={s['spans']} errors={s['errors']}")
+            for name, ms in s['by_name_ms'].items():
+                self.stdout.write(f'    {name:<32}{ms:>10} ms')
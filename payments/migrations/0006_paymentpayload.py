@@ -0,0 +1,73 @@
+# Generated by Django 5.2.9 on 2026-10-19 00:07
+
+import json
+import zlib
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def _kind(data):
+    # Initiate responses carry ResponseCode; callbacks carry Body.stkCallback / ResultCode
+    if isinstance(data, dict) and 'ResponseCode' in data and 'Body' not in data:
+        return 'initiate'
+    return 'callback'
+
+
+def copy_payloads(apps, schema_editor):
+    Payment = apps.get_model('payments', 'Payment')
+    PaymentPayload = apps.get_model('payments', 'PaymentPayload')
+    rows = (Payment.objects.filter(callback_raw_data__isnull=False)
+            .order_by('pk').values_list('pk', 'callback_raw_data', 'updated_at'))
+    batch = []
+    for pk, data, updated_at in rows.iterator(chunk_size=BATCH_SIZE):
+        blob = zlib.compress(json.dumps(data, separators=(',', ':'), default=str).encode('utf-8'))
+        batch.append(PaymentPayload(payment_id=pk, kind=_kind(data), blob=blob, created_at=updated_at))
+        if len(batch) >= BATCH_SIZE:
+            PaymentPayload.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        PaymentPayload.objects.bulk_create(batch)
+
+
+def restore_payloads(apps, schema_editor):
+    Payment = apps.get_model('payments', 'Payment')
+    PaymentPayload = apps.get_model('payments', 'PaymentPayload')
+    latest = {}
+    for payment_id, blob in PaymentPayload.objects.order_by('payment_id', '-id').values_list('payment_id', 'blob'):
+        latest.setdefault(payment_id, blob)
+    for payment_id, blob in latest.items():
+        data = json.loads(zlib.decompress(bytes(blob)).decode('utf-8'))
+        Payment.objects.filter(pk=payment_id).update(callback_raw_data=data)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0005_paymentaccesslog_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentPayload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('initiate', 'Initiate response'), ('callback', 'Callback')], default='callback', max_length=20)),
+                ('blob', models.BinaryField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payloads', to='payments.payment')),
+            ],
+            options={
+                'ordering': ('-id',),
+                'indexes': [models.Index(fields=['payment', 'kind'], name='payments_pa_payment_1d0a18_idx')],
+            },
+        ),
+        migrations.RunPython(copy_payloads, restore_payloads),
+        migrations.RemoveField(
+            model_name='payment',
+            name='callback_raw_data',
+        ),
+    ]
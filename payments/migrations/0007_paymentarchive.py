@@ -0,0 +1,46 @@
+# Generated by Django 5.2.9 on 2026-10-19 00:11
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_paymentpayload'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='paymentaccesslog',
+            name='payment',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='access_logs', to='payments.payment'),
+        ),
+        migrations.CreateModel(
+            name='PaymentArchive',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('phone_number', models.CharField(max_length=13)),
+                ('account_ref', models.CharField(blank=True, max_length=100, null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('merchant_request_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('checkout_request_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('mpesa_receipt_number', models.CharField(blank=True, max_length=100, null=True)),
+                ('error_code', models.CharField(blank=True, max_length=50, null=True)),
+                ('error_message', models.TextField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('success', 'Success'), ('failed', 'Failed')], max_length=20)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('payloads_blob', models.BinaryField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_payments', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'created_at'], name='payments_pa_user_id_e04972_idx'), models.Index(fields=['checkout_request_id'], name='payments_pa_checkou_49a301_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.9 on 2026-10-19 00:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0007_paymentarchive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='credential_name',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='paymentarchive',
+            name='credential_name',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+    ]
@@ -1,7 +1,18 @@
+import json
+import zlib
+
 from django.db import models
 from django.conf import settings
 from django.utils import timezone
 
+_UNLOADED = object()
+
+
+def _mark_checkout_issued(checkout_id):
+    # lets callbacks for this id past the checkout filter before its next rebuild
+    from payments.utils.checkout_filter import mark_issued
+    mark_issued(checkout_id)
+
 
 class Payment(models.Model):
     STATUS_CHOICES = [
@@ -10,6 +21,15 @@ class Payment(models.Model):
         ("failed", "Failed"),
     ]
 
+    # Statuses a payment may move *from* to reach each target status. A success
+    # is final; "pending" -> "pending" lets pollers record a note on a payment
+    # that is still waiting without clobbering a callback that already landed.
+    TRANSITIONS = {
+        "pending": ("pending",),
+        "failed": ("pending",),
+        "success": ("pending", "failed"),
+    }
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     phone_number = models.CharField(max_length=13)
@@ -22,8 +42,9 @@ class Payment(models.Model):
     error_code = models.CharField(max_length=50, blank=True, null=True)
     error_message = models.TextField(blank=True, null=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    # Daraja credential set the STK push went out with (status queries must use the same one)
+    credential_name = models.CharField(max_length=50, blank=True, null=True)
 
-    callback_raw_data = models.JSONField(blank=True, null=True)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -34,9 +55,195 @@ class Payment(models.Model):
             models.Index(fields=["phone_number"]),
         ]
 
+    archived = False
+
     def __str__(self):
         return f"{self.user} - {self.amount} - {self.status}"
 
+    # --- raw upstream payloads (stored in PaymentPayload, off the hot row) ---
+
+    @property
+    def callback_raw_data(self):
+        """Latest raw upstream payload for this payment, loaded on first access."""
+        pending = self.__dict__.get("_payload_pending")
+        if pending is not None:
+            return pending[1]
+        cached = self.__dict__.get("_payload_cache", _UNLOADED)
+        if cached is _UNLOADED:
+            cached = None
+            if self.pk is not None:
+                blob = self.payloads.order_by("-id").values_list("blob", flat=True).first()
+                cached = PaymentPayload.decode(blob) if blob is not None else None
+            self.__dict__["_payload_cache"] = cached
+        return cached
+
+    @callback_raw_data.setter
+    def callback_raw_data(self, value):
+        # Appended as a "callback" payload on the next save()
+        self.__dict__["_payload_pending"] = ("callback", value)
+
+    def record_payload(self, data, kind="callback"):
+        """Append a raw upstream payload for this (saved) payment."""
+        self.__dict__.pop("_payload_pending", None)
+        if data is None:
+            return None
+        payload = PaymentPayload.record(self.pk, data, kind)
+        self.__dict__["_payload_cache"] = data
+        return payload
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if self.checkout_request_id and (update_fields is None or "checkout_request_id" in update_fields):
+            _mark_checkout_issued(self.checkout_request_id)
+        pending = self.__dict__.pop("_payload_pending", None)
+        if pending is not None:
+            self.record_payload(pending[1], kind=pending[0])
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        if kwargs.get("fields") is None and not args:
+            self.__dict__.pop("_payload_cache", None)
+
+    @classmethod
+    def transition(cls, pk, to_status, allowed_from=None, **fields):
+        """Move payment `pk` to `to_status` and write `fields`, in one statement.
+
+        Issues ``UPDATE ... WHERE id = pk AND status IN (allowed_from)`` touching
+        only the given columns, so a late poll result cannot overwrite a payment
+        that another writer already settled. `allowed_from` defaults to
+        ``TRANSITIONS[to_status]``. Returns True if the row was updated.
+        """
+        if allowed_from is None:
+            allowed_from = cls.TRANSITIONS[to_status]
+        fields["status"] = to_status
+        # QuerySet.update() bypasses auto_now
+        fields.setdefault("updated_at", timezone.now())
+        applied = cls.objects.filter(pk=pk, status__in=allowed_from).update(**fields) == 1
+        if applied and fields.get("checkout_request_id"):
+            _mark_checkout_issued(fields["checkout_request_id"])
+        return applied
+
+    def transition_to(self, to_status, allowed_from=None, **fields):
+        """Instance form of `transition`; mirrors the written fields on self when it applies."""
+        fields.setdefault("updated_at", timezone.now())
+        applied = type(self).transition(self.pk, to_status, allowed_from, **fields)
+        if applied:
+            self.status = to_status
+            for name, value in fields.items():
+                setattr(self, name, value)
+        return applied
+
+
+class PaymentPayload(models.Model):
+    """Append-only store of raw upstream payloads (initiate responses, callbacks).
+
+    Kept out of the `Payment` table so list queries never drag JSON blobs
+    through the ORM. The JSON is stored zlib-compressed; use `data` (or
+    `Payment.callback_raw_data` for the latest one) to read it back.
+    """
+
+    KIND_CHOICES = [
+        ("initiate", "Initiate response"),
+        ("callback", "Callback"),
+    ]
+
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name="payloads")
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default="callback")
+    blob = models.BinaryField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ("-id",)
+        indexes = [models.Index(fields=["payment", "kind"])]
+
+    def __str__(self):
+        return f"{self.kind} payload for payment:{self.payment_id} at {self.created_at.isoformat()}"
+
+    @staticmethod
+    def encode(data):
+        return zlib.compress(json.dumps(data, separators=(",", ":"), default=str).encode("utf-8"))
+
+    @staticmethod
+    def decompress(blob):
+        """The stored JSON document as raw UTF-8 bytes (for parsers that read bytes directly)."""
+        return zlib.decompress(bytes(blob))
+
+    @staticmethod
+    def decode(blob):
+        return json.loads(PaymentPayload.decompress(blob).decode("utf-8"))
+
+    @property
+    def data(self):
+        return self.decode(self.blob)
+
+    @classmethod
+    def record(cls, payment_id, data, kind="callback"):
+        return cls.objects.create(payment_id=payment_id, kind=kind, blob=cls.encode(data))
+
+    @classmethod
+    def latest_blobs(cls, payment_ids, kind=None):
+        """Map payment id -> compressed blob of its most recent payload, in one query."""
+        qs = cls.objects.filter(payment_id__in=payment_ids)
+        if kind is not None:
+            qs = qs.filter(kind=kind)
+        latest = {}
+        for payment_id, blob in qs.order_by("payment_id", "-id").values_list("payment_id", "blob"):
+            latest.setdefault(payment_id, blob)
+        return latest
+
+
+class PaymentArchive(models.Model):
+    """Settled payments moved out of the hot `Payment` table by `archive_payments`.
+
+    Rows keep their original id, so history, export and receipt views can fall
+    back to this table when a payment is no longer in `Payment`. The payment's
+    raw payloads are kept as one zlib-compressed JSON list, newest first.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="archived_payments")
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    phone_number = models.CharField(max_length=13)
+    account_ref = models.CharField(max_length=100, blank=True, null=True)
+    description = models.TextField(blank=True, null=True)
+
+    merchant_request_id = models.CharField(max_length=100, blank=True, null=True)
+    checkout_request_id = models.CharField(max_length=100, blank=True, null=True)
+    mpesa_receipt_number = models.CharField(max_length=100, blank=True, null=True)
+    error_code = models.CharField(max_length=50, blank=True, null=True)
+    error_message = models.TextField(blank=True, null=True)
+    status = models.CharField(max_length=20, choices=Payment.STATUS_CHOICES)
+    credential_name = models.CharField(max_length=50, blank=True, null=True)
+
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+    payloads_blob = models.BinaryField(blank=True, null=True)
+
+    archived = True
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_at"]),
+            models.Index(fields=["checkout_request_id"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.amount} - {self.status} (archived)"
+
+    @property
+    def payloads(self):
+        """Archived raw payloads as a list of {"kind", "created_at", "data"} dicts, newest first."""
+        if "_payloads" not in self.__dict__:
+            self.__dict__["_payloads"] = PaymentPayload.decode(self.payloads_blob) if self.payloads_blob else []
+        return self.__dict__["_payloads"]
+
+    @property
+    def callback_raw_data(self):
+        payloads = self.payloads
+        return payloads[0]["data"] if payloads else None
+
 
 # --- Audit log for access to sensitive payment details ---
 class PaymentAccessLog(models.Model):
@@ -44,7 +251,7 @@ class PaymentAccessLog(models.Model):
 
     This is intentionally simple: it stores a reference to the Payment, the
     actor (optional, null for anonymous/system), IP address, user agent and a
-    short action/note. Use this for auditing access to `callback_raw_data` and
+    short action/note. Use this for auditing access to raw payloads and
     other sensitive fields.
     """
 
@@ -55,7 +262,8 @@ class PaymentAccessLog(models.Model):
         ("other", "Other"),
     ]
 
-    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name="access_logs")
+    # No database constraint: audit entries outlive the row when a payment is archived
+    payment = models.ForeignKey(Payment, on_delete=models.DO_NOTHING, db_constraint=False, related_name="access_logs")
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
     username = models.CharField(max_length=150, blank=True, null=True)
     action = models.CharField(max_length=20, choices=ACTION_CHOICES, default="view")
@@ -1,5 +1,5 @@
 from payments.models import Payment
-from django.utils import timezone
+from payments.utils.reconcile import parse_callback
 import json
 
 matches = []
@@ -7,12 +7,12 @@ for p in Payment.objects.filter(status='failed').order_by('-created_at'):
     raw = p.callback_raw_data
     if not raw:
         continue
-    s = json.dumps(raw) if not isinstance(raw, str) else raw
-    # look for common success indicators
-    if '"ResultCode": 0' in s or '"ResultCode": 0' in s or '"ResponseCode": "0"' in s or '"ResponseCode": 0' in s:
-        matches.append((p.id, s[:300]))
+    # decoded the same way as the callback view and reconcile_payments
+    success, receipt = parse_callback(raw)
+    if success:
+        s = json.dumps(raw) if not isinstance(raw, str) else raw
+        matches.append((p.id, receipt, s[:300]))
 
 print('found', len(matches), 'candidates')
-for pid, snippet in matches[:50]:
-    print(pid, snippet)
-
+for pid, receipt, snippet in matches[:50]:
+    print(pid, receipt, snippet)
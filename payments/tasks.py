@@ -1,10 +1,15 @@
 # Placeholder for background tasks (e.g., Celery tasks)
-from django.utils import timezone
 import logging
 from django.conf import settings
 
-from payments.utils.mpesa_api import query_transaction_status  # may raise if requests missing
+from payments.utils.mpesa_api import initiate_stk_push, pick_credential, query_transaction_status  # may raise if requests missing
 from payments.models import Payment
+from payments.utils.metrics import POLL_ATTEMPTS
+from payments.utils import checkout_filter, task_results, tracing
+from payments.utils.archive import archive_batch, archive_cutoff, newest_payment_pk
+from payments.utils.notifications import notify_payment_success
+from payments.utils.reconcile import ReconcileEngine
+from payments.utils.retry import deadline_scope
 
 # Try to import Celery task decorator if available
 try:
@@ -16,47 +21,161 @@ except Exception:
 
 logger = logging.getLogger(__name__)
 
+# Columns the pollers need; status changes are written with Payment.transition
+_POLL_FIELDS = ('id', 'status', 'checkout_request_id', 'merchant_request_id', 'credential_name')
+
+
+def _task_time_budget(task=None):
+    """Seconds an upstream call may take inside the current task.
+
+    The task's soft time limit (per task or CELERY_TASK_SOFT_TIME_LIMIT) less a margin
+    to record the outcome, else MPESA_TASK_DEADLINE_SECONDS.
+    """
+    soft = None
+    try:
+        limits = getattr(getattr(task, 'request', None), 'timelimit', None) or ()
+        soft = limits[1] if len(limits) > 1 else None
+    except Exception:
+        soft = None
+    soft = soft or getattr(task, 'soft_time_limit', None) or getattr(settings, 'CELERY_TASK_SOFT_TIME_LIMIT', None)
+    if soft:
+        return max(1.0, float(soft) - 2.0)
+    return float(getattr(settings, 'MPESA_TASK_DEADLINE_SECONDS', 60))
+
 
 def _poll_payment_status_sync(payment_id: int):
     """Synchronous fallback that queries MPESA for status and updates the Payment."""
-    payment = Payment.objects.filter(pk=payment_id).first()
+    payment = Payment.objects.filter(pk=payment_id).only(*_POLL_FIELDS).first()
     if not payment:
         logger.debug('sync_poll: payment not found: %s', payment_id)
         return None
 
     try:
-        result = query_transaction_status(payment.checkout_request_id or payment.merchant_request_id)
+        with deadline_scope(_task_time_budget()):
+            result = query_transaction_status(payment.checkout_request_id or payment.merchant_request_id,
+                                              credential=payment.credential_name)
     except Exception as exc:
         logger.exception('sync_poll: error querying transaction status for payment %s: %s', payment_id, exc)
-        payment.error_message = str(exc)
-        payment.updated_at = timezone.now()
-        payment.save()
+        payment.transition_to('pending', error_message=str(exc))
         return None
 
     if not isinstance(result, dict):
         logger.warning('sync_poll: unexpected query result type for payment %s: %s', payment_id, type(result))
-        payment.error_message = f'Unexpected query result: {result}'
-        payment.updated_at = timezone.now()
-        payment.save()
+        payment.transition_to('pending', error_message=f'Unexpected query result: {result}')
         return None
 
-    # Example result parsing (depends on MPESA response shape)
+    # Daraja's query API returns ResultCode as a string ("0"); coerce like the Celery task does
     result_code = result.get('ResultCode')
+    try:
+        result_code = int(result_code) if result_code is not None else None
+    except (TypeError, ValueError):
+        pass
     if result_code == 0:
-        payment.status = 'success'
-        payment.mpesa_receipt_number = result.get('MpesaReceiptNumber') or result.get('ReceiptNumber')
+        applied = payment.transition_to(
+            'success',
+            mpesa_receipt_number=result.get('MpesaReceiptNumber') or result.get('ReceiptNumber'),
+        )
+    else:
+        applied = payment.transition_to(
+            'failed',
+            error_code=str(result_code),
+            error_message=result.get('ResultDesc'),
+        )
+    if not applied:
+        logger.info('sync_poll: payment %s already settled; poll result ignored', payment_id)
     else:
-        payment.status = 'failed'
-        payment.error_code = str(result_code)
-        payment.error_message = result.get('ResultDesc')
+        tracing.record_settled(payment.checkout_request_id, payment.status, via='poll')
+    return payment
+
+
+def _dispatch_stk_push_sync(payment_id: int, task=None):
+    """Send the STK push for a payment accepted by the async initiate flow, then schedule polling.
 
-    payment.updated_at = timezone.now()
-    payment.save()
+    Safe to run twice for the same payment: once a payment has a checkout id (or
+    is no longer pending) it is left alone, so the customer is never prompted twice.
+    """
+    payment = Payment.objects.filter(pk=payment_id).only(
+        'id', 'status', 'amount', 'phone_number', 'account_ref', 'description', 'checkout_request_id').first()
+    if not payment:
+        logger.warning('dispatch_stk_push: payment not found: %s', payment_id)
+        return None
+    if payment.status != 'pending' or payment.checkout_request_id:
+        logger.info('dispatch_stk_push: payment %s already dispatched or settled; skipping', payment_id)
+        return payment
+
+    try:
+        with deadline_scope(_task_time_budget(task)):
+            credential = pick_credential()
+            resp = initiate_stk_push(payment.phone_number, payment.amount, payment.account_ref, payment.description,
+                                     credential=credential)
+    except Exception as exc:
+        logger.exception('dispatch_stk_push: STK push failed for payment %s: %s', payment_id, exc)
+        payment.transition_to('failed', error_message=f'STK push failed: {exc}'[:1000])
+        return payment
+
+    checkout_id = merchant_req_id = None
+    if isinstance(resp, dict):
+        checkout_id = resp.get('CheckoutRequestID') or resp.get('checkout_request_id') or resp.get('CheckoutRequestId')
+        merchant_req_id = resp.get('MerchantRequestID') or resp.get('MerchantRequestId') or resp.get('merchant_request_id')
+    payment.record_payload(resp if isinstance(resp, dict) else None, kind='initiate')
+    if not (checkout_id or merchant_req_id):
+        message = resp.get('errorMessage') or resp.get('ResponseDescription') if isinstance(resp, dict) else None
+        payment.transition_to('failed', error_message=f'STK push not accepted: {message or resp}'[:1000])
+        return payment
+
+    payment.transition_to('pending', checkout_request_id=checkout_id, merchant_request_id=merchant_req_id,
+                          credential_name=credential.name)
+    tracing.bind_checkout(checkout_id, payment.id)
+    configured_delay = int(getattr(settings, 'MPESA_POLL_DELAY_SECONDS', 12))
+    try:
+        if hasattr(poll_payment_status, 'delay'):
+            poll_payment_status.delay(payment.id, attempts=0, max_attempts=40, delay=configured_delay)
+        else:
+            poll_payment_status(payment.id)
+    except Exception:
+        logger.exception('dispatch_stk_push: failed to enqueue poll for payment %s; relying on the callback', payment_id)
     return payment
 
 
+def _send_payment_notification_sync(payment_id: int, via=('email',)):
+    payment = Payment.objects.select_related('user').filter(pk=payment_id).first()
+    if payment is None or payment.status != 'success':
+        logger.warning('send_payment_notification: payment %s not found or not successful; skipping', payment_id)
+        return None
+    return notify_payment_success(payment, via=tuple(via))
+
+
+def _reconcile_failed_payments_sync(chunk_size: int = 500):
+    summary = ReconcileEngine(chunk_size=chunk_size, workers=0).run()
+    return {'inspected': summary['inspected'], 'fixed': len(summary['fixed']), 'complete': summary['complete']}
+
+
+def _archive_settled_payments_sync(batch_size: int = 500, max_batches: int = 20):
+    """Archive settled payments in bounded batches (see `archive_payments`); returns how many moved."""
+    top = newest_payment_pk()
+    if top is None:
+        return 0
+    cutoff = archive_cutoff()
+    archived = 0
+    for _ in range(max(1, int(max_batches))):
+        ids = archive_batch(cutoff, batch_size=batch_size, below_pk=top)
+        if not ids:
+            break
+        archived += len(ids)
+    return archived
+
+
 if shared_task is not None:
-    @shared_task(bind=True, max_retries=None)
+    # No acks_late/retries: re-running a push that may already have reached Daraja would
+    # prompt the customer twice. At-most-once it is; a lost dispatch leaves the payment
+    # pending without a checkout id.
+    @shared_task(bind=True, ignore_result=True)
+    def dispatch_stk_push(self, payment_id: int):
+        """Celery task: send the STK push for a payment created by the async initiate flow."""
+        return getattr(_dispatch_stk_push_sync(payment_id, task=self), 'id', None)
+
+    # Nobody reads poll results; without ignore_result every retry would store one
+    @shared_task(bind=True, max_retries=None, ignore_result=True)
     def poll_payment_status(self, payment_id: int, attempts: int = 0, max_attempts: int = 40, delay: int = 12):
         """Celery task that polls MPESA transaction status, retrying with a countdown until success or max attempts.
 
@@ -76,13 +195,15 @@ if shared_task is not None:
 
         logger.info('poll_payment_status: task=%s starting attempt %s/%s for payment_id=%s', task_id, current_attempt, configured_max, payment_id)
 
-        payment = Payment.objects.filter(pk=payment_id).first()
+        payment = Payment.objects.filter(pk=payment_id).only(*_POLL_FIELDS).first()
         if not payment:
             logger.warning('poll_payment_status: task=%s payment not found: %s', task_id, payment_id)
             return None
 
         try:
-            result = query_transaction_status(payment.checkout_request_id or payment.merchant_request_id)
+            with deadline_scope(_task_time_budget(self)):
+                result = query_transaction_status(payment.checkout_request_id or payment.merchant_request_id,
+                                              credential=payment.credential_name)
             logger.debug('poll_payment_status: task=%s query result for payment_id=%s attempt=%s: %s', task_id, payment_id, current_attempt, result)
         except Exception as exc:
             logger.exception('poll_payment_status: task=%s error querying transaction status for payment %s (attempt %s/%s): %s', task_id, payment_id, current_attempt, configured_max, str(exc))
@@ -94,11 +215,9 @@ if shared_task is not None:
                     'max_attempts': configured_max,
                     'delay': configured_delay,
                 })
-            # mark as pending after exhausting retries due to transient errors so callback can still update
-            payment.status = 'pending'
-            payment.error_message = f'Exhausted polling retries due to upstream error: {str(exc)[:500]}'
-            payment.updated_at = timezone.now()
-            payment.save()
+            # leave as pending after exhausting retries due to transient errors so callback can still update
+            payment.transition_to('pending', error_message=f'Exhausted polling retries due to upstream error: {str(exc)[:500]}')
+            POLL_ATTEMPTS.observe(current_attempt, outcome='exhausted')
             logger.error('poll_payment_status: task=%s exhausted retries for payment_id=%s due to errors; left as pending for webhook', task_id, payment_id)
             return None
 
@@ -114,10 +233,8 @@ if shared_task is not None:
                 })
             else:
                 # Keep payment as pending when result is unexpected, allow webhook/callback to determine final state
-                payment.status = 'pending'
-                payment.error_message = f'Unexpected query result after retries: {result}'
-                payment.updated_at = timezone.now()
-                payment.save()
+                payment.transition_to('pending', error_message=f'Unexpected query result after retries: {result}')
+                POLL_ATTEMPTS.observe(current_attempt, outcome='exhausted')
                 logger.error('poll_payment_status: task=%s exhausted attempts for payment_id=%s; unexpected result retained as pending', task_id, payment_id)
                 return payment
 
@@ -130,12 +247,12 @@ if shared_task is not None:
             result_code = None
         if result_code == 0:
             receipt = result.get('MpesaReceiptNumber') or result.get('ReceiptNumber')
-            payment.status = 'success'
-            payment.mpesa_receipt_number = receipt
-            payment.error_code = None
-            payment.error_message = None
-            payment.updated_at = timezone.now()
-            payment.save()
+            applied = payment.transition_to('success', mpesa_receipt_number=receipt, error_code=None, error_message=None)
+            POLL_ATTEMPTS.observe(current_attempt, outcome='success' if applied else 'superseded')
+            if not applied:
+                logger.info('poll_payment_status: task=%s payment %s was settled by another writer; poll result ignored', task_id, payment_id)
+                return payment
+            tracing.record_settled(payment.checkout_request_id, 'success', via='poll')
             logger.info('poll_payment_status: task=%s payment %s succeeded on attempt %s; receipt=%s', task_id, payment_id, current_attempt, receipt)
             return payment
 
@@ -152,18 +269,67 @@ if shared_task is not None:
 
         # exhausted attempts -> mark failed with details from response
         # Only mark as failed here because we have a definitive response (non-zero ResultCode) after retries
-        payment.status = 'failed'
-        payment.error_code = str(result_code) if result_code is not None else str(result_code_raw)
-        payment.error_message = result.get('ResultDesc') if isinstance(result, dict) else str(result)
-        payment.updated_at = timezone.now()
-        payment.save()
+        applied = payment.transition_to(
+            'failed',
+            error_code=str(result_code) if result_code is not None else str(result_code_raw),
+            error_message=result.get('ResultDesc') if isinstance(result, dict) else str(result),
+        )
+        POLL_ATTEMPTS.observe(current_attempt, outcome='failed' if applied else 'superseded')
+        if not applied:
+            logger.info('poll_payment_status: task=%s payment %s was settled by another writer; poll result ignored', task_id, payment_id)
+            return payment
+        tracing.record_settled(payment.checkout_request_id, 'failed', via='poll')
         logger.error('poll_payment_status: task=%s exhausted attempts for payment_id=%s; final ResultCode=%s; error=%s', task_id, payment_id, result_code, payment.error_message)
         return payment
 
+    @shared_task(ignore_result=True)
+    def send_payment_notification(payment_id: int, via=('email',)):
+        """Celery task (notifications queue): send the success notification for a payment."""
+        return _send_payment_notification_sync(payment_id, via)
+
+    @shared_task(ignore_result=True)
+    def rebuild_checkout_filter():
+        """Celery beat task: rebuild the shared filter of issued checkout ids (see checkout_filter)."""
+        return checkout_filter.rebuild()
+
+    # Maintenance jobs keep their summary as the task result for operators
+    @shared_task(ignore_result=False)
+    def reconcile_failed_payments(chunk_size: int = 500):
+        """Celery task (maintenance queue): the `reconcile_payments` run, without a checkpoint."""
+        return _reconcile_failed_payments_sync(chunk_size)
+
+    @shared_task(ignore_result=False)
+    def archive_settled_payments(batch_size: int = 500, max_batches: int = 20):
+        """Celery task (maintenance queue): archive up to `max_batches` batches of settled payments."""
+        return _archive_settled_payments_sync(batch_size, max_batches)
+
+    @shared_task(ignore_result=True)
+    def prune_task_results():
+        """Celery beat task: trim stored task results in batches (see task_results)."""
+        return task_results.prune()
+
 else:
     def poll_payment_status(payment_id: int):
         return _poll_payment_status_sync(payment_id)
 
+    def send_payment_notification(payment_id: int, via=('email',)):
+        return _send_payment_notification_sync(payment_id, via)
+
+    def rebuild_checkout_filter():
+        return checkout_filter.rebuild()
+
+    def reconcile_failed_payments(chunk_size: int = 500):
+        return _reconcile_failed_payments_sync(chunk_size)
+
+    def archive_settled_payments(batch_size: int = 500, max_batches: int = 20):
+        return _archive_settled_payments_sync(batch_size, max_batches)
+
+    def prune_task_results():
+        return task_results.prune()
+
+    def dispatch_stk_push(payment_id: int):
+        return _dispatch_stk_push_sync(payment_id)
+
     # Compatibility alias: older code or external callers may expect `poll_stk_status` task name.
     # Re-export the same task so either name works. When Celery is enabled, both refer to the
     # same shared task implementation defined above.
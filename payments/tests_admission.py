@@ -0,0 +1,35 @@
+from django.test import TestCase
+from django.core.cache import cache
+from payments.utils.admission import AdmissionQueue, AdmissionRejected
+
+
+class AdmissionQueueTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.queue = AdmissionQueue(name='test', interval=15, max_wait=60)
+
+    def test_admits_at_exact_rate(self):
+        waits = [self.queue.admit(now=1000.0) for _ in range(5)]
+        self.assertEqual(waits, [0, 15, 30, 45, 60])
+        self.assertEqual(self.queue.depth(now=1000.0), 4)
+
+    def test_sheds_only_past_max_wait(self):
+        for _ in range(5):
+            self.queue.admit(now=1000.0)
+        with self.assertRaises(AdmissionRejected) as ctx:
+            self.queue.admit(now=1000.0)
+        self.assertEqual(ctx.exception.retry_after, 15)
+        # once the virtual clock has moved on there is room again
+        self.assertEqual(self.queue.admit(now=1016.0), 59)
+
+    def test_idle_queue_dispatches_immediately(self):
+        self.queue.admit(now=1000.0)
+        self.assertEqual(self.queue.admit(now=2000.0), 0)
+
+    def test_position_and_eta(self):
+        for ticket in range(3):
+            self.queue.record(ticket, self.queue.admit(now=1000.0), now=1000.0)
+        self.assertIsNone(self.queue.position(0, now=1000.0))
+        self.assertEqual(self.queue.position(2, now=1000.0), (2, 30.0))
+        self.assertEqual(self.queue.position(2, now=1020.0), (1, 10.0))
+        self.assertIsNone(self.queue.position(2, now=1031.0))
@@ -0,0 +1,96 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.db import IntegrityError
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.paginator import Paginator
+from django.urls import reverse
+from django.utils import timezone
+from payments.models import Payment, PaymentAccessLog, PaymentArchive
+from payments.utils.archive import PaymentHistory, archive_batch, get_payment
+
+
+class ArchivePaymentsTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username='archive', password='pw')
+        old = timezone.now() - timedelta(days=400)
+        self.old = [self._payment(status, old, receipt=f'R{i}') for i, status in enumerate(['success', 'failed', 'success'])]
+        self.old[0].record_payload({'Body': {'stkCallback': {'ResultCode': 0}}})
+        PaymentAccessLog.objects.create(payment=self.old[0], username='archive')
+        self.old_pending = self._payment('pending', old)
+        self.recent = self._payment('success', timezone.now())
+        # the newest row is never archived, however old it is
+        self.newest = self._payment('success', old)
+
+    def _payment(self, status, when, receipt=None):
+        payment = Payment.objects.create(user=self.user, amount=10, phone_number='254712345678', status=status,
+                                         mpesa_receipt_number=receipt, created_at=when)
+        Payment.objects.filter(pk=payment.pk).update(updated_at=when)
+        return payment
+
+    def test_moves_only_old_settled_payments(self):
+        out = StringIO()
+        call_command('archive_payments', '--batch-size', '2', stdout=out)
+        self.assertIn('Archived 3 payments', out.getvalue())
+
+        archived_ids = {p.pk for p in self.old}
+        self.assertEqual(set(PaymentArchive.objects.values_list('pk', flat=True)), archived_ids)
+        self.assertFalse(Payment.objects.filter(pk__in=archived_ids).exists())
+        self.assertEqual(set(Payment.objects.values_list('pk', flat=True)),
+                         {self.old_pending.pk, self.recent.pk, self.newest.pk})
+
+        archived = PaymentArchive.objects.get(pk=self.old[0].pk)
+        self.assertEqual((archived.status, archived.mpesa_receipt_number), ('success', 'R0'))
+        self.assertEqual(archived.callback_raw_data, {'Body': {'stkCallback': {'ResultCode': 0}}})
+        # the audit trail survives archiving
+        self.assertEqual(PaymentAccessLog.objects.filter(payment_id=self.old[0].pk).count(), 1)
+
+    def test_bounded_run_resumes(self):
+        call_command('archive_payments', '--batch-size', '2', '--max-batches', '1', stdout=StringIO())
+        self.assertEqual(PaymentArchive.objects.count(), 2)
+        call_command('archive_payments', '--batch-size', '2', stdout=StringIO())
+        self.assertEqual(PaymentArchive.objects.count(), 3)
+
+    def test_conflicting_archive_row_keeps_the_batch(self):
+        taken = self.old[1]
+        PaymentArchive.objects.create(id=taken.pk, user=self.user, amount=99, phone_number='254700000000',
+                                      status='success', created_at=taken.created_at, updated_at=taken.updated_at)
+        with self.assertRaises(IntegrityError):
+            archive_batch(timezone.now() - timedelta(days=180), batch_size=10, below_pk=self.newest.pk)
+        # nothing was deleted from the hot table
+        self.assertEqual(Payment.objects.filter(pk__in=[p.pk for p in self.old]).count(), 3)
+        self.assertEqual(PaymentArchive.objects.get(pk=taken.pk).amount, 99)
+
+    def test_dry_run_moves_nothing(self):
+        out = StringIO()
+        call_command('archive_payments', '--dry-run', stdout=out)
+        self.assertIn('3 settled payments', out.getvalue())
+        self.assertEqual(PaymentArchive.objects.count(), 0)
+
+    def test_views_read_through_to_archive(self):
+        call_command('archive_payments', stdout=StringIO())
+        self.assertIsInstance(get_payment(self.old[1].pk, user=self.user), PaymentArchive)
+        self.assertIsInstance(get_payment(self.recent.pk), Payment)
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('payments:history'), {'export': 'csv', 'sort': 'date'})
+        ids = [line.split(',')[0] for line in response.content.decode().strip().splitlines()[1:]]
+        # hot and archived rows, oldest first
+        everything = [*self.old, self.old_pending, self.recent, self.newest]
+        self.assertEqual(sorted(ids), sorted(str(p.pk) for p in everything))
+        self.assertEqual(ids[-1], str(self.recent.pk))
+
+        response = self.client.get(reverse('payments:history'), {'export': 'csv', 'status': 'failed'})
+        self.assertIn(f'{self.old[1].pk},', response.content.decode())
+
+    def test_combined_history_paginates(self):
+        call_command('archive_payments', stdout=StringIO())
+        history = PaymentHistory(Payment.objects.filter(user=self.user),
+                                 PaymentArchive.objects.filter(user=self.user), ('-created_at', '-id'))
+        page = Paginator(history, 4).page(2)
+        self.assertEqual(page.paginator.count, 6)
+        self.assertEqual([row.id for row in page], [self.old[1].pk, self.old[0].pk])
+        self.assertEqual(page[0].get_status_display(), 'Failed')
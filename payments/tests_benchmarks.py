@@ -0,0 +1,20 @@
+from django.test import SimpleTestCase
+
+from payments.benchmarks.purchase_flow import compare, percentile, summarize
+
+
+class PurchaseFlowStatsTests(SimpleTestCase):
+    def test_nearest_rank_percentiles(self):
+        values = [i / 1000 for i in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 0.05)
+        self.assertEqual(percentile(values, 99), 0.099)
+        self.assertEqual(percentile([0.2], 95), 0.2)
+        self.assertEqual(percentile([], 50), 0.0)
+        self.assertEqual(summarize([0.1, 0.3])['p50_ms'], 100.0)
+
+    def test_compare_against_baseline(self):
+        baseline = {'throughput_per_sec': 10.0, 'stages': {'initiate': {'p50_ms': 100.0, 'p95_ms': 200.0}}}
+        current = {'throughput_per_sec': 12.0, 'stages': {'initiate': {'p50_ms': 80.0, 'p95_ms': 200.0},
+                                                          'receipt': {'p50_ms': 5.0, 'p95_ms': 9.0}}}
+        self.assertEqual(compare(current, baseline),
+                         {'throughput_per_sec': 20.0, 'initiate': {'p50_ms': -20.0, 'p95_ms': 0.0}})
@@ -0,0 +1,94 @@
+import json
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+
+from payments.benchmarks.callback_decoder import legacy_decode, sample_payloads
+from payments.models import Payment
+from payments.utils import callback_decoder
+
+
+def _stk(result_code=0, items=None):
+    stk = {'MerchantRequestID': 'm-1', 'CheckoutRequestID': 'ws_CO_D1', 'ResultCode': result_code, 'ResultDesc': 'desc'}
+    if items is not None:
+        stk['CallbackMetadata'] = {'Item': items}
+    return {'Body': {'stkCallback': stk}}
+
+
+SUCCESS_ITEMS = [{'Name': 'Amount', 'Value': 150.5}, {'Name': 'MpesaReceiptNumber', 'Value': 'R1'},
+                 {'Name': 'TransactionDate', 'Value': 20261019101500}, {'Name': 'PhoneNumber', 'Value': 254712345678}]
+
+
+class CallbackDecoderTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_stk_success_fields_in_one_record(self):
+        record = callback_decoder.decode(json.dumps(_stk(0, SUCCESS_ITEMS)).encode())
+        self.assertTrue(record.success)
+        self.assertEqual((record.checkout_id, record.merchant_request_id, record.receipt, record.amount, record.phone,
+                          record.transaction_date), ('ws_CO_D1', 'm-1', 'R1', Decimal('150.5'), '254712345678',
+                                                     20261019101500))
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_string_result_code_and_failure(self):
+        self.assertTrue(callback_decoder.decode(_stk(' 0 ', SUCCESS_ITEMS)).success)
+        record = callback_decoder.decode(_stk('1032'))
+        self.assertEqual((record.success, record.result_code, record.receipt), (False, 1032, None))
+
+    def test_renamed_receipt_items(self):
+        record = callback_decoder.decode(_stk(0, [{'Name': 'Amount', 'Value': 1}, {'Name': 'TransactionReceipt', 'Value': 'R2'}]))
+        self.assertEqual(record.receipt, 'R2')
+        record = callback_decoder.decode(_stk(0, [{'Name': 'Amount', 'Value': 1}, {'Name': 'Ref', 'Value': 'R3'}]))
+        self.assertEqual(record.receipt, 'R3')
+
+    def test_unparsable_payloads(self):
+        for payload in (b'', b'{not json', '[1, 2]', None):
+            self.assertIsNone(callback_decoder.decode(payload).data)
+
+    def test_form_encodings(self):
+        body = json.dumps(_stk(0, SUCCESS_ITEMS))
+        for form in ({'Body': body}, {'payload': body}):
+            record = callback_decoder.decode_request(self.factory.post('/cb', data=form))
+            self.assertEqual((record.checkout_id, record.receipt), ('ws_CO_D1', 'R1'))
+        record = callback_decoder.decode_request(self.factory.post('/cb', data={'CheckoutRequestID': 'ws_CO_F', 'ResultCode': '0'}))
+        self.assertEqual((record.checkout_id, record.result_code), ('ws_CO_F', 0))
+
+    def test_json_body_labelled_as_form(self):
+        body = json.dumps(_stk(0, SUCCESS_ITEMS))
+        for content_type in ('application/x-www-form-urlencoded', 'application/x-www-form-urlencoded; charset=utf-8'):
+            request = self.factory.post('/cb', data=' ' + body, content_type=content_type)
+            record = callback_decoder.decode_request(request)
+            self.assertEqual((record.checkout_id, record.result_code, record.receipt), ('ws_CO_D1', 0, 'R1'))
+
+    def test_stdlib_fallback(self):
+        with patch.object(callback_decoder, 'orjson', None):
+            self.assertEqual(callback_decoder.decode(json.dumps(_stk(0, SUCCESS_ITEMS))).receipt, 'R1')
+
+    def test_agrees_with_the_legacy_parsing(self):
+        for raw in sample_payloads(50):
+            legacy = legacy_decode(raw)
+            record = callback_decoder.decode(raw)
+            self.assertEqual((record.checkout_id, record.result_code, record.receipt),
+                             (legacy['checkout_id'], legacy['result_code'], legacy['receipt']))
+
+    def test_form_callback_settles_payment(self):
+        user = get_user_model().objects.create_user(username='dec', password='pw')
+        payment = Payment.objects.create(user=user, amount=Decimal('10.00'), phone_number='254712345678',
+                                         checkout_request_id='ws_CO_D1')
+        self.client.post(reverse('payments:mpesa-callback'), data={'Body': json.dumps(_stk(0, SUCCESS_ITEMS))})
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.mpesa_receipt_number), ('success', 'R1'))
+        self.assertEqual(payment.callback_raw_data['Body']['stkCallback']['CheckoutRequestID'], 'ws_CO_D1')
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('bench_callback_decoder', payloads=20, rounds=1, json=True, stdout=out)
+        results = json.loads(out.getvalue())
+        self.assertEqual(results['backend'], callback_decoder.BACKEND)
+        self.assertGreater(results['decoder']['p50_us'], 0)
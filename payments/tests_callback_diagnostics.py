@@ -0,0 +1,62 @@
+import json
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from payments.models import Payment
+from payments.utils import callback_diagnostics
+
+
+def _callback(checkout_id, result_code=0):
+    return json.dumps({'Body': {'stkCallback': {'CheckoutRequestID': checkout_id, 'ResultCode': result_code,
+                                                'ResultDesc': 'ok'}}})
+
+
+@override_settings(CALLBACK_DIAGNOSTICS='sampled', CALLBACK_DIAGNOSTICS_SAMPLE_RATE=0.0,
+                   CALLBACK_DIAGNOSTICS_PER_MINUTE=2, CALLBACK_DIAGNOSTICS_BUFFER=3)
+class CallbackDiagnosticsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = patch.object(callback_diagnostics, '_budget', callback_diagnostics._Budget())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = get_user_model().objects.create_user(username='diag', password='pw')
+
+    def _post(self, body, **extra):
+        return self.client.post(reverse('payments:mpesa-callback'), data=body, content_type='application/json', **extra)
+
+    def test_normal_callbacks_are_not_logged_or_captured(self):
+        Payment.objects.create(user=self.user, amount=Decimal('10.00'), phone_number='254712345678',
+                               checkout_request_id='ws_CO_OK')
+        with self.assertNoLogs('payments.views.callback', 'INFO'):
+            self._post(_callback('ws_CO_OK'))
+        self.assertEqual(callback_diagnostics.recent(), [])
+
+    def test_anomalies_are_captured_within_budget(self):
+        self._post(_callback('ws_CO_UNKNOWN'), HTTP_AUTHORIZATION='Bearer secret', HTTP_X_FORWARDED_FOR='196.201.214.200')
+        self._post('not json at all')
+        self._post(_callback('ws_CO_UNKNOWN_2'))  # over the per-minute budget
+        entries = callback_diagnostics.recent()
+        self.assertEqual([e['outcome'] for e in entries], ['no_payload', 'not_found'])
+        self.assertEqual(entries[1]['headers']['Authorization'], '<redacted>')
+        self.assertEqual(entries[1]['x_forwarded_for'], '196.201.214.200')
+        self.assertEqual(entries[1]['checkout_id'], 'ws_CO_UNKNOWN')
+
+    def test_ring_buffer_keeps_the_newest(self):
+        with override_settings(CALLBACK_DIAGNOSTICS='all'):
+            for i in range(5):
+                self._post(_callback(f'ws_CO_{i}'))
+        self.assertEqual([e['checkout_id'] for e in callback_diagnostics.recent()], ['ws_CO_4', 'ws_CO_3', 'ws_CO_2'])
+
+    def test_staff_endpoint(self):
+        self._post(_callback('ws_CO_UNKNOWN'))
+        url = reverse('payments:callback-diagnostics')
+        staff = get_user_model().objects.create_user(username='ops', password='pw', is_staff=True)
+        self.client.force_login(staff)
+        body = self.client.get(url, {'limit': 10}).json()
+        self.assertEqual((body['count'], body['mode']), (1, 'sampled'))
+        self.assertEqual(body['entries'][0]['outcome'], 'not_found')
@@ -0,0 +1,91 @@
+import json
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.celery import app as celery_app
+from payments import tasks
+from payments.models import Payment, PaymentArchive
+from payments.utils import task_results
+from payments.utils.notifications import enqueue_payment_success
+
+
+class QueueRoutingTests(TestCase):
+    def _queue(self, name):
+        return celery_app.amqp.router.route({}, name)['queue'].name
+
+    def test_tasks_are_routed_to_their_pools(self):
+        self.assertEqual({q.name for q in celery_app.conf.task_queues},
+                         {'default', 'polls', 'notifications', 'maintenance'})
+        self.assertEqual(self._queue('payments.tasks.dispatch_stk_push'), 'default')
+        self.assertEqual(self._queue('payments.tasks.poll_payment_status'), 'polls')
+        self.assertEqual(self._queue('payments.tasks.send_payment_notification'), 'notifications')
+        self.assertEqual(self._queue('payments.tasks.reconcile_failed_payments'), 'maintenance')
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('bench_celery_queues', polls=10, notifications=2, poll_workers=1, notification_workers=1,
+                     topology=['routed'], json=True, stdout=out)
+        result = json.loads(out.getvalue())['routed']
+        self.assertEqual(result['queues'], {'polls': 'polls', 'notifications': 'notifications'})
+        self.assertEqual((result['notifications_done'], result['polls_done']), (2, 10))
+
+
+class NotificationTaskTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='queued', email='queued@example.com', password='pw')
+        self.payment = Payment.objects.create(user=self.user, amount=Decimal('25.00'), phone_number='254712345678',
+                                              status='success', mpesa_receipt_number='RQ1')
+
+    @override_settings(NOTIFICATION_BACKEND='celery')
+    def test_celery_backend_queues_the_task(self):
+        with patch.object(tasks.send_payment_notification, 'delay') as delay:
+            self.assertTrue(enqueue_payment_success(self.payment, via=('email',)))
+        delay.assert_called_once_with(self.payment.pk, ['email'])
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                       DEFAULT_FROM_EMAIL='noreply@example.com')
+    def test_task_sends_only_for_successful_payments(self):
+        tasks._send_payment_notification_sync(self.payment.pk, ['email'])
+        self.assertEqual(len(mail.outbox), 1)
+        Payment.objects.filter(pk=self.payment.pk).update(status='failed')
+        self.assertIsNone(tasks._send_payment_notification_sync(self.payment.pk, ['email']))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_archive_task_moves_old_settled_payments(self):
+        newest = Payment.objects.create(user=self.user, amount=Decimal('1.00'), phone_number='254712345678',
+                                        status='success')
+        Payment.objects.filter(pk__in=[self.payment.pk, newest.pk]).update(
+            updated_at=timezone.now() - timedelta(days=400))
+        self.assertEqual(tasks._archive_settled_payments_sync(batch_size=10, max_batches=1), 1)
+        self.assertTrue(PaymentArchive.objects.filter(pk=self.payment.pk).exists())
+
+
+class TaskResultTests(TestCase):
+    def test_only_maintenance_jobs_store_results(self):
+        self.assertTrue(celery_app.conf.task_ignore_result)
+        self.assertTrue(tasks.poll_payment_status.ignore_result)
+        self.assertTrue(tasks.send_payment_notification.ignore_result)
+        self.assertFalse(tasks.reconcile_failed_payments.ignore_result)
+        self.assertEqual(celery_app.conf.beat_schedule['prune-task-results']['task'], 'payments.tasks.prune_task_results')
+        self.assertEqual(celery_app.amqp.router.route({}, 'payments.tasks.prune_task_results')['queue'].name, 'maintenance')
+
+    def test_delete_in_batches(self):
+        user = get_user_model().objects.create_user(username='prune', password='pw')
+        for _ in range(5):
+            Payment.objects.create(user=user, amount=Decimal('1.00'), phone_number='254712345678', status='failed')
+        with self.assertNumQueries(4):
+            deleted = task_results.delete_in_batches(Payment.objects.filter(status='failed'), batch_size=2, max_batches=1)
+        self.assertEqual(deleted, 2)
+        self.assertEqual(task_results.delete_in_batches(Payment.objects.all(), batch_size=2), 3)
+
+    def test_prune_is_a_no_op_without_the_database_backend(self):
+        with patch.object(task_results, 'result_model', return_value=None):
+            self.assertIsNone(task_results.prune())
@@ -0,0 +1,126 @@
+import json
+import time
+import uuid
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from payments.models import Payment
+from payments.utils import checkout_filter
+from payments.utils.metrics import REGISTRY
+
+
+def _callback(checkout_id):
+    return json.dumps({'Body': {'stkCallback': {'CheckoutRequestID': checkout_id, 'ResultCode': 0, 'ResultDesc': 'ok',
+                                                'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'R1'}]}}}})
+
+
+class BloomFilterTests(TestCase):
+    def test_no_false_negatives_and_bounded_false_positives(self):
+        bloom = checkout_filter.BloomFilter.for_capacity(2000, 0.01)
+        issued = [f'ws_CO_{i}' for i in range(2000)]
+        for checkout_id in issued:
+            bloom.add(checkout_id)
+        self.assertTrue(all(checkout_id in bloom for checkout_id in issued))
+        false_positives = sum(1 for _ in range(5000) if uuid.uuid4().hex in bloom)
+        self.assertLess(false_positives, 5000 * 0.03)
+
+
+# a shared cache, as in production (TieredCache over one L2 store)
+SHARED_CACHE = {'default': {'BACKEND': 'core.utils.tiered_cache.TieredCache', 'LOCATION': 'checkout-filter-tests',
+                            'OPTIONS': {'L2_BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                        'L2_ONLY_PREFIXES': ('checkout_filter:', 'checkout:issued:')}}}
+
+
+@override_settings(METRICS_REDIS_URL='', CELERY_BROKER_URL=None, CACHES=SHARED_CACHE)
+class CheckoutFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        REGISTRY.reset()
+        checkout_filter._local.reset()
+        self.addCleanup(checkout_filter._local.reset)
+        self.user = get_user_model().objects.create_user(username='bloom', password='pw')
+
+    def _payment(self, checkout_id, **kwargs):
+        return Payment.objects.create(user=self.user, amount=Decimal('10.00'), phone_number='254712345678',
+                                      checkout_request_id=checkout_id, **kwargs)
+
+    def _post(self, checkout_id):
+        return self.client.post(reverse('payments:mpesa-callback'), data=_callback(checkout_id),
+                                content_type='application/json')
+
+    def test_unknown_checkout_is_acknowledged_without_a_query(self):
+        self._payment('ws_CO_KNOWN')
+        self.assertEqual(checkout_filter.rebuild(), 1)
+        with self.assertNumQueries(0):
+            response = self._post('ws_CO_NEVER_ISSUED')
+        self.assertEqual(response.json(), {'success': True})
+        self.assertEqual(REGISTRY.snapshot()[0]['payments_callback_unknown_checkout_total'], 1)
+
+    def test_ids_issued_after_the_build_still_settle(self):
+        checkout_filter.rebuild()
+        # written with a single UPDATE, as the async dispatch task does
+        payment = self._payment(None)
+        Payment.transition(payment.pk, 'pending', checkout_request_id='ws_CO_LATE')
+        self._post('ws_CO_LATE')
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'success')
+
+    def test_missing_filter_is_rebuilt_off_the_request_path(self):
+        self._payment('ws_CO_A')
+        with patch('payments.tasks.rebuild_checkout_filter.delay') as delay, \
+                patch.object(checkout_filter, 'rebuild') as rebuild:
+            self.assertTrue(checkout_filter.might_exist('ws_CO_B'))
+            checkout_filter._local.reset()
+            self.assertTrue(checkout_filter.might_exist('ws_CO_B'))
+        rebuild.assert_not_called()
+        # queued once; the second caller found the build already requested
+        delay.assert_called_once_with()
+
+        # the maintenance worker runs it and every process picks it up
+        checkout_filter.rebuild()
+        self.assertIsNone(cache.get('checkout_filter:rebuild_lock'))
+        checkout_filter._local.reset()
+        with patch('payments.tasks.rebuild_checkout_filter.delay') as delay:
+            self.assertTrue(checkout_filter.might_exist('ws_CO_A'))
+            self.assertFalse(checkout_filter.might_exist('ws_CO_B'))
+        delay.assert_not_called()
+
+    def test_l2_outage_means_maybe(self):
+        checkout_filter.rebuild()
+        tier = caches['default']._tier
+        tier.l2_down_until = time.monotonic() + 60
+        self.addCleanup(setattr, tier, 'l2_down_until', 0.0)
+        self.assertTrue(checkout_filter.might_exist('ws_CO_NEVER_ISSUED'))
+
+    def test_fails_open_without_a_usable_filter(self):
+        cache.add('checkout_filter:rebuild_lock', 1)  # another process is rebuilding
+        self.assertTrue(checkout_filter.might_exist('ws_CO_ANYTHING'))
+        with self.settings(CHECKOUT_FILTER_ENABLED=False):
+            checkout_filter._local.reset()
+            cache.delete('checkout_filter:rebuild_lock')
+            self.assertTrue(checkout_filter.might_exist('ws_CO_ANYTHING'))
+
+
+@override_settings(METRICS_REDIS_URL='', CELERY_BROKER_URL=None,
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class UnsharedCacheTests(TestCase):
+    def setUp(self):
+        checkout_filter._local.reset()
+        self.addCleanup(checkout_filter._local.reset)
+
+    def test_id_issued_elsewhere_still_settles(self):
+        user = get_user_model().objects.create_user(username='percache', password='pw')
+        payment = Payment.objects.create(user=user, amount=Decimal('10.00'), phone_number='254712345678')
+        checkout_filter.rebuild()
+        # issued by another process: neither in this process's filter nor under its issued key
+        Payment.objects.filter(pk=payment.pk).update(checkout_request_id='ws_CO_WORKER')
+        self.assertFalse(checkout_filter.cache_is_shared())
+        self.client.post(reverse('payments:mpesa-callback'), data=_callback('ws_CO_WORKER'),
+                         content_type='application/json')
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'success')
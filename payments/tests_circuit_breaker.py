@@ -0,0 +1,128 @@
+import json
+import time
+from unittest.mock import patch, Mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from payments.models import Payment
+from payments.utils import mpesa_api
+from payments.utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker('test', failure_threshold=3, recovery_timeout=30,
+                                      is_failure=lambda exc: not isinstance(exc, ValueError))
+
+    def _fail(self, exc=RuntimeError('down')):
+        with self.assertRaises(type(exc)):
+            with self.breaker.guard():
+                raise exc
+
+    def test_opens_after_consecutive_failures(self):
+        self._fail()
+        self._fail()
+        with self.breaker.guard():
+            pass
+        # a success resets the streak
+        self._fail()
+        self._fail()
+        self.assertEqual(self.breaker.state(), 'closed')
+        self._fail()
+        self.assertEqual(self.breaker.state(), 'open')
+        with self.assertRaises(CircuitOpenError) as ctx:
+            self.breaker.before_call()
+        self.assertEqual(ctx.exception.retry_after, 30)
+
+    def test_ignored_exceptions_do_not_count(self):
+        for _ in range(5):
+            self._fail(ValueError('bad input'))
+        self.assertEqual(self.breaker.state(), 'closed')
+
+    def test_half_open_lets_one_probe_through(self):
+        for _ in range(3):
+            self._fail()
+        opened_at = cache.get(self.breaker._opened_key)
+        later = opened_at + 31
+        self.assertEqual(self.breaker.state(now=later), 'half_open')
+        self.assertTrue(self.breaker.before_call(now=later))
+        # everyone else keeps failing fast while the probe is out
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call(now=later)
+        self.breaker.record_failure(probe=True)
+        self.assertEqual(self.breaker.state(), 'open')
+
+        cache.set(self.breaker._opened_key, opened_at)
+        self.assertTrue(self.breaker.before_call(now=later))
+        self.breaker.record_success(probe=True)
+        self.assertEqual(self.breaker.state(), 'closed')
+        self.assertEqual(self.breaker.stats()['transitions'], {'closed': 1, 'open': 2, 'half_open': 2})
+
+    def test_probe_without_an_upstream_answer_stays_half_open(self):
+        for _ in range(3):
+            self._fail()
+        cache.set(self.breaker._opened_key, time.time() - 31)
+        # e.g. the token request or the deadline failed before Daraja was called
+        self._fail(ValueError('no credential'))
+        self.assertEqual(self.breaker.state(), 'half_open')
+        # the probe marker was released: the next caller probes
+        self.assertTrue(self.breaker.before_call())
+        self.breaker.release_probe()
+
+        answered = ValueError('400 Bad Request')
+        answered.status_code = 400
+        self._fail(answered)
+        self.assertEqual(self.breaker.state(), 'closed')
+
+
+@override_settings(MPESA_CIRCUIT_FAILURE_THRESHOLD=2, MPESA_CIRCUIT_RECOVERY_SECONDS=60)
+class DarajaCircuitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = patch.object(mpesa_api, '_daraja_breaker', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_open_circuit_skips_http_and_retries(self):
+        with patch('payments.utils.mpesa_api.requests') as mock_requests, \
+             patch('payments.utils.mpesa_api.wait_for_rate_limit') as mock_wait:
+            mock_requests.post.return_value = Mock(status_code=503, raise_for_status=Mock(side_effect=mpesa_api._HTTPError('503')), text='down')
+            for _ in range(2):
+                with self.assertRaises(mpesa_api.MPesaHTTPError):
+                    mpesa_api._http_post('https://example.invalid/stk', payload={})
+            with self.assertRaises(CircuitOpenError):
+                mpesa_api._http_post('https://example.invalid/stk', payload={})
+        self.assertEqual(mock_requests.post.call_count, 2)
+        self.assertEqual(mock_wait.call_count, 2)
+
+    def test_client_errors_do_not_open_circuit(self):
+        with patch('payments.utils.mpesa_api.requests') as mock_requests, \
+             patch('payments.utils.mpesa_api.wait_for_rate_limit'):
+            mock_requests.post.return_value = Mock(status_code=400, raise_for_status=Mock(side_effect=mpesa_api._HTTPError('400')), text='bad phone')
+            for _ in range(3):
+                with self.assertRaises(mpesa_api.MPesaHTTPError):
+                    mpesa_api._http_post('https://example.invalid/stk', payload={})
+        self.assertEqual(mpesa_api.get_daraja_breaker().state(), 'closed')
+
+    def test_initiate_fails_fast_and_staff_can_see_state(self):
+        breaker = mpesa_api.get_daraja_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        with patch('payments.views.initiate._mpesa_api._simulate_enabled', return_value=False), \
+             patch('payments.views.initiate.initiate_stk_push') as mock_stk:
+            resp = self.client.post(reverse('payments:payments-initiate'), data=json.dumps({
+                'phone_number': '254712345678', 'amount': 100,
+            }), content_type='application/json')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp['Retry-After'], '60')
+        self.assertFalse(mock_stk.called)
+        self.assertFalse(Payment.objects.exists())
+
+        staff = get_user_model().objects.create_user(username='ops', password='pw', is_staff=True)
+        self.client.force_login(staff)
+        stats = self.client.get(reverse('payments:circuit-status')).json()
+        self.assertEqual((stats['state'], stats['transitions']['open']), ('open', 1))
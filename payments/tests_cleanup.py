@@ -0,0 +1,49 @@
+from io import StringIO
+
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from payments.models import Payment
+
+
+class CleanupFailedPaymentsTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username='cleanup', password='pw')
+        for i in range(3):
+            Payment.objects.create(user=self.user, amount=10, phone_number='254712345678', status='failed',
+                                   mpesa_receipt_number=f'R{i}', error_message='timeout')
+        for _ in range(4):
+            Payment.objects.create(user=self.user, amount=1, phone_number='254712345678', status='failed')
+        Payment.objects.create(user=self.user, amount=1, phone_number='254712345678', status='failed',
+                               mpesa_receipt_number='')
+        self.pending = Payment.objects.create(user=self.user, amount=1, phone_number='254712345678', status='pending')
+
+    def _run(self, *args):
+        out = StringIO()
+        call_command('cleanup_failed_payments', *args, stdout=out)
+        return out.getvalue()
+
+    def test_dry_run_summarizes_without_writing(self):
+        out = self._run('--delete-tests')
+        self.assertIn('Would mark as success: 3', out)
+        self.assertIn('Would delete (if --delete-tests): 5', out)
+        self.assertNotIn('[MARK]', out)
+        self.assertEqual(Payment.objects.filter(status='failed').count(), 8)
+
+    def test_apply_marks_and_deletes_in_single_statements(self):
+        with self.assertNumQueries(2):
+            # one aggregate for the summary plus one UPDATE, however many rows match
+            self._run('--apply')
+        self.assertEqual(Payment.objects.filter(status='success', error_message__isnull=True).count(), 3)
+
+        self._run('--apply', '--delete-tests')
+        self.assertEqual(Payment.objects.filter(status='failed').count(), 0)
+        self.assertTrue(Payment.objects.filter(pk=self.pending.pk).exists())
+
+    def test_batched_apply(self):
+        out = self._run('--apply', '--delete-tests', '--batch-size', '2')
+        self.assertIn('Marked 3 payments as success', out)
+        self.assertIn('Deleted 5 payments', out)
+        self.assertEqual(Payment.objects.filter(status='success').count(), 3)
+        self.assertEqual(Payment.objects.count(), 4)
@@ -0,0 +1,96 @@
+from decimal import Decimal
+from unittest.mock import patch, Mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from payments.models import Payment
+from payments.utils import mpesa_api
+from payments.utils.credentials import DEFAULT_CREDENTIAL, build_pool
+
+CREDENTIALS = [
+    {'name': 'app1', 'consumer_key': 'k1', 'consumer_secret': 's1', 'shortcode': '111', 'passkey': 'p1'},
+    {'name': 'app2', 'consumer_key': 'k2', 'consumer_secret': 's2', 'shortcode': '222', 'passkey': 'p2',
+     'rate_limit_requests': 2},
+]
+
+
+@override_settings(MPESA_RATE_LIMIT_REQUESTS=4, MPESA_RATE_LIMIT_PERIOD=60, CELERY_BROKER_URL=None)
+class CredentialPoolTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.pool = build_pool(CREDENTIALS)
+        app1, app2 = self.pool.credentials
+        app1.limiter.use_redis = app2.limiter.use_redis = False
+
+    def test_pick_prefers_headroom(self):
+        app1, app2 = self.pool.credentials
+        self.assertEqual((app1.headroom(), app2.headroom()), (4, 2))
+        picked = []
+        for _ in range(6):
+            picked.append(self.pool.pick())
+            picked[-1].limiter.acquire()
+        # each push went to whichever app had the most budget left, using all of it
+        self.assertEqual(sorted(c.name for c in picked), ['app1'] * 4 + ['app2'] * 2)
+        self.assertEqual((app1.headroom(), app2.headroom()), (0, 0))
+        self.assertAlmostEqual(self.pool.rate_per_second(), 6 / 60)
+
+    def test_unknown_names_use_settings_credential(self):
+        self.assertEqual(self.pool.get('app2').shortcode, '222')
+        with override_settings(MPESA_SHORTCODE='999'):
+            self.assertEqual(self.pool.get(None).name, DEFAULT_CREDENTIAL)
+            self.assertEqual(self.pool.get('retired-app').shortcode, '999')
+
+    def test_each_credential_has_its_own_token(self):
+        with patch.object(mpesa_api, '_credential_pool', self.pool), \
+             patch('payments.utils.mpesa_api.requests', new=Mock()) as mock_requests, \
+             patch('payments.utils.mpesa_api.wait_for_rate_limit') as mock_wait:
+            mock_requests.get.side_effect = lambda url, headers=None, timeout=None: Mock(
+                status_code=200, json=Mock(return_value={'access_token': 'tok-' + headers['Authorization'][-4:]}))
+            mock_requests.post.return_value = Mock(status_code=200, json=Mock(return_value={'ResultCode': 0}))
+            mpesa_api.query_transaction_status('ws_CO_1', credential='app2')
+            mpesa_api.query_transaction_status('ws_CO_2', credential='app2')
+            mpesa_api.query_transaction_status('ws_CO_3', credential='app1')
+
+        # one token fetch per credential, then served from that credential's cache
+        self.assertEqual(mock_requests.get.call_count, 2)
+        shortcodes = [call.kwargs['json']['BusinessShortCode'] for call in mock_requests.post.call_args_list]
+        self.assertEqual(shortcodes, ['222', '222', '111'])
+        app1, app2 = self.pool.credentials
+        self.assertEqual([call.args[0] for call in mock_wait.call_args_list], [app2.limiter, app2.limiter, app1.limiter])
+        self.assertNotEqual(app1.token_cache['token'], app2.token_cache['token'])
+
+    def test_dispatch_records_credential_for_polling(self):
+        from payments import tasks as payments_tasks
+        user = get_user_model().objects.create_user(username='creds', password='pw')
+        payment = Payment.objects.create(user=user, amount=Decimal('10.00'), phone_number='254712345678')
+        app2 = self.pool.get('app2')
+        with patch.object(payments_tasks, 'pick_credential', return_value=app2), \
+             patch.object(payments_tasks, 'initiate_stk_push',
+                          return_value={'CheckoutRequestID': 'ws_CO_9', 'MerchantRequestID': 'm9'}) as mock_stk, \
+             patch.object(payments_tasks.poll_payment_status, 'delay'):
+            payments_tasks._dispatch_stk_push_sync(payment.pk)
+        self.assertIs(mock_stk.call_args.kwargs['credential'], app2)
+        payment.refresh_from_db()
+        self.assertEqual(payment.credential_name, 'app2')
+
+        with patch.object(payments_tasks, 'query_transaction_status', return_value={'ResultCode': 0}) as mock_query:
+            payments_tasks._poll_payment_status_sync(payment.pk)
+        mock_query.assert_called_once_with('ws_CO_9', credential='app2')
+
+    def test_initiate_checks_the_token_of_the_picked_credential(self):
+        from payments import tasks as payments_tasks
+        user = get_user_model().objects.create_user(username='creds-initiate', password='pw')
+        self.client.force_login(user)
+        app2 = self.pool.get('app2')
+        with patch('payments.views.initiate._mpesa_api._simulate_enabled', return_value=False), \
+             patch('payments.views.initiate._mpesa_api.pick_credential', return_value=app2), \
+             patch('payments.views.initiate.initiate_stk_push',
+                   return_value={'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_10', 'MerchantRequestID': 'm10'}), \
+             patch('payments.views.initiate.get_access_token', return_value='tok') as mock_token, \
+             patch.object(payments_tasks.poll_payment_status, 'delay'):
+            resp = self.client.post('/payments/initiate/', data={'phone_number': '254712345678', 'amount': 10},
+                                    content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        mock_token.assert_called_once_with(app2)
@@ -0,0 +1,91 @@
+import json
+import threading
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from payments.models import Payment
+from payments.utils import mpesa_api
+from payments.utils.daraja_simulator import DarajaSimulator, SimulatorConfig, parse_latency
+
+
+class DarajaSimulatorTests(TestCase):
+    """The unmodified Daraja client against the local simulator (real HTTP on localhost)."""
+
+    def _start(self, **config):
+        self.delivered = []
+        self.callback_ready = threading.Event()
+
+        def deliver(url, payload):
+            self.delivered.append((url, payload))
+            self.callback_ready.set()
+
+        config.setdefault('latency', 'none')
+        config.setdefault('callback_delay', (0.2, 0.2))
+        simulator = DarajaSimulator(SimulatorConfig(**config), deliver=deliver)
+        base_url = simulator.start()
+        self.addCleanup(simulator.stop)
+        settings_override = override_settings(
+            MPESA_BASE_URL=base_url, MPESA_SIMULATE=False, MPESA_CONSUMER_KEY='sim-key', MPESA_CONSUMER_SECRET='sim-secret',
+            MPESA_SHORTCODE='174379', MPESA_PASSKEY='pass', MPESA_CALLBACK_URL='https://example.com/payments/callback/')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        return simulator
+
+    def setUp(self):
+        cache.clear()
+        mpesa_api._token_cache['token'] = None
+        mpesa_api._token_cache['expiry'] = 0.0
+        self.addCleanup(mpesa_api._token_cache.update, {'token': None, 'expiry': 0.0})
+        patcher = patch('payments.utils.mpesa_api.wait_for_rate_limit')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_push_query_and_callback(self):
+        simulator = self._start(outcomes={0: 1.0})
+        user = get_user_model().objects.create_user(username='sim', password='pw')
+        resp = mpesa_api.initiate_stk_push('0712345678', 10, 'ref', 'desc')
+        payment = Payment.objects.create(user=user, amount=Decimal('10.00'), phone_number='254712345678',
+                                         checkout_request_id=resp['CheckoutRequestID'])
+
+        # before the customer answers Daraja reports "being processed"; that is not an outage
+        with self.assertRaises(mpesa_api.MPesaHTTPError) as ctx:
+            mpesa_api.query_transaction_status(resp['CheckoutRequestID'])
+        self.assertIn('500.001.1001', str(ctx.exception))
+        self.assertEqual(mpesa_api.get_daraja_breaker().state(), 'closed')
+
+        self.assertTrue(self.callback_ready.wait(5))
+        url, callback = self.delivered[0]
+        self.assertEqual(url, 'https://example.com/payments/callback/')
+        self.client.post(reverse('payments:mpesa-callback'), data=json.dumps(callback), content_type='application/json')
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'success')
+        self.assertTrue(payment.mpesa_receipt_number.startswith('SIM'))
+
+        result = mpesa_api.query_transaction_status(resp['CheckoutRequestID'])
+        self.assertEqual(result['ResultCode'], '0')
+        self.assertEqual((simulator.stats['token_requests'], simulator.stats['stk_push_requests']), (1, 1))
+
+    def test_rate_limit_per_consumer_key(self):
+        self._start(rate_limit=1, rate_period=60)
+        mpesa_api.initiate_stk_push('0712345678', 10, 'ref', 'desc')
+        with self.assertRaises(mpesa_api.MPesaHTTPError) as ctx:
+            mpesa_api.initiate_stk_push('0712345678', 10, 'ref', 'desc')
+        self.assertEqual(ctx.exception.status_code, 429)
+
+    def test_injected_errors(self):
+        simulator = self._start(error_rate=1.0)
+        with self.assertRaises(mpesa_api.MPesaAuthError):
+            mpesa_api.get_access_token()
+        self.assertEqual(simulator.stats['errors'], 1)
+
+    def test_latency_specs(self):
+        self.assertEqual(parse_latency('fixed:250')(), 0.25)
+        self.assertTrue(0.1 <= parse_latency('uniform:100,200')() <= 0.2)
+        self.assertGreater(parse_latency('lognormal:300,0.5')(), 0)
+        with self.assertRaises(ValueError):
+            parse_latency('gamma:1')
@@ -0,0 +1,105 @@
+import json
+import threading
+from unittest.mock import patch
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+
+from payments.decorators import idempotent
+from payments.models import Payment
+
+
+class IdempotentDecoratorTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.calls = 0
+
+    def _view(self, status=200):
+        @idempotent('test')
+        def view(request):
+            self.calls += 1
+            return JsonResponse({'call': self.calls}, status=status)
+        return view
+
+    def _post(self, view, key='abc', body='{"amount": 10}', ip='10.0.0.1'):
+        request = self.factory.post('/x/', data=body, content_type='application/json',
+                                    HTTP_IDEMPOTENCY_KEY=key, REMOTE_ADDR=ip)
+        request.user = AnonymousUser()
+        return view(request)
+
+    def test_repeat_replays_original_response(self):
+        view = self._view()
+        first = self._post(view)
+        second = self._post(view)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        # keys are scoped per client
+        self._post(view, ip='10.0.0.2')
+        self.assertEqual(self.calls, 2)
+
+    def test_different_body_with_same_key_is_rejected(self):
+        view = self._view()
+        self._post(view)
+        self.assertEqual(self._post(view, body='{"amount": 20}').status_code, 422)
+        self.assertEqual(self.calls, 1)
+
+    def test_errors_are_not_kept(self):
+        view = self._view(status=400)
+        self._post(view)
+        self._post(view)
+        self.assertEqual(self.calls, 2)
+
+    def test_concurrent_repeat_gets_409(self):
+        entered, release = threading.Event(), threading.Event()
+
+        @idempotent('test')
+        def slow_view(request):
+            entered.set()
+            release.wait(5)
+            return JsonResponse({'ok': True})
+
+        worker = threading.Thread(target=self._post, args=(slow_view,))
+        worker.start()
+        entered.wait(5)
+        try:
+            self.assertEqual(self._post(slow_view).status_code, 409)
+        finally:
+            release.set()
+            worker.join()
+        self.assertEqual(self._post(slow_view)['Idempotent-Replayed'], 'true')
+
+    def test_no_header_passes_through(self):
+        view = self._view()
+        for _ in range(2):
+            request = self.factory.post('/x/', data='{}', content_type='application/json')
+            request.user = AnonymousUser()
+            view(request)
+        self.assertEqual(self.calls, 2)
+
+
+class IdempotentInitiateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_double_submit_creates_one_payment(self):
+        from payments import tasks as payments_tasks
+        body = json.dumps({'phone_number': '254712345678', 'amount': 100})
+        with patch('payments.views.initiate._mpesa_api._simulate_enabled', return_value=False), \
+             patch('payments.views.initiate.initiate_stk_push') as mock_stk, \
+             patch('payments.views.initiate.get_access_token', return_value='fake_token'), \
+             patch.object(payments_tasks.dispatch_stk_push, 'apply_async') as mock_dispatch, \
+             patch.object(payments_tasks.poll_payment_status, 'delay'):
+            mock_stk.return_value = {'CheckoutRequestID': 'ws_CO_1', 'MerchantRequestID': 'm1', 'ResponseCode': '0'}
+            responses = [self.client.post(reverse('payments:payments-initiate'), data=body,
+                                          content_type='application/json', HTTP_IDEMPOTENCY_KEY='order-42')
+                         for _ in range(6)]
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertLessEqual(mock_stk.call_count + mock_dispatch.call_count, 1)
+        # replays do not spend the per-IP rate limit (4/min)
+        self.assertEqual({r.status_code for r in responses}, {responses[0].status_code})
+        self.assertEqual(len({r.content for r in responses}), 1)
@@ -0,0 +1,109 @@
+import threading
+from collections import defaultdict
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from payments.utils.metrics import REGISTRY, Registry
+from payments.utils.rate_limit import RateLimiter
+
+
+class _SharedHash:
+    """Just enough of a Redis client for two registries to share one hash."""
+
+    def __init__(self):
+        self.hashes = defaultdict(dict)
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def hincrbyfloat(self, key, field, amount):
+        self.hashes[key][field] = str(float(self.hashes[key].get(field, 0)) + amount)
+
+    def hset(self, key, field, value):
+        self.hashes[key][field] = value
+
+    def hgetall(self, key):
+        return dict(self.hashes[key])
+
+    def execute(self):
+        return []
+
+
+class RegistryTests(TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        registry = Registry(redis_url='', flush_interval=60)
+        latency = registry.histogram('latency_seconds', 'Latency', ('endpoint',), buckets=(0.1, 1.0))
+        latency.observe(0.05, endpoint='token')
+        latency.observe(0.5, endpoint='token')
+        text = registry.render()
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertIn('latency_seconds_bucket{endpoint="token",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{endpoint="token",le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{endpoint="token",le="+Inf"} 2', text)
+        self.assertIn('latency_seconds_count{endpoint="token"} 2', text)
+        with self.assertRaises(ValueError):
+            latency.observe(1.0)
+
+    def test_processes_aggregate_in_redis(self):
+        shared = _SharedHash()
+        web, worker = Registry(redis_url='redis://metrics', flush_interval=60), Registry(redis_url='redis://metrics',
+                                                                                        flush_interval=60)
+        web._client = worker._client = shared
+        for registry in (web, worker):
+            registry.counter('calls_total', 'Calls', ('result',)).inc(result='hit')
+        worker.flush()
+        # the scraping process sees the worker's flushed updates plus its own buffered ones
+        self.assertIn('calls_total{result="hit"} 2', web.render())
+
+    def test_updates_are_flushed_off_the_calling_thread(self):
+        registry = Registry(redis_url='', flush_interval=0.05)
+        flushed = threading.Event()
+        flushing_threads = []
+
+        def flush():
+            flushing_threads.append(threading.current_thread().name)
+            flushed.set()
+
+        with patch.object(registry, 'flush', side_effect=flush):
+            for _ in range(100):
+                registry.counter('calls_total', 'Calls').inc()
+            self.assertTrue(flushed.wait(5))
+        self.assertEqual(set(flushing_threads), {'metrics-flush'})
+
+    def test_process_gauge_is_read_at_flush(self):
+        registry = Registry(redis_url='', flush_interval=60)
+        depth = [3]
+        registry.process_gauge('queue_depth', 'Queue depth', lambda: depth[0])
+        self.assertIn('queue_depth 3', registry.render())
+        depth[0] = 0
+        self.assertIn('queue_depth 0', registry.render())
+
+
+@override_settings(METRICS_TOKEN='scrape-me', METRICS_REDIS_URL='', CELERY_BROKER_URL=None)
+class MetricsEndpointTests(TestCase):
+    def setUp(self):
+        REGISTRY.reset()
+
+    def test_requires_token_or_staff(self):
+        url = reverse('payments:metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape-me').status_code, 200)
+        staff = get_user_model().objects.create_user(username='ops', password='pw', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_rate_limiter_and_pipeline_series(self):
+        limiter = RateLimiter('metrics_test', requests_per_period=1, period_seconds=60, use_redis=False)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire(timeout=0))
+        resp = self.client.get(reverse('payments:metrics'), HTTP_AUTHORIZATION='Bearer scrape-me')
+        text = resp.content.decode()
+        self.assertIn('mpesa_rate_limit_wait_seconds_count{limiter="metrics_test"} 1', text)
+        self.assertIn('mpesa_rate_limit_rejections_total{limiter="metrics_test"} 1', text)
+        self.assertIn('payments_pending 0', text)
+        self.assertIn('payments_notification_queue_depth', text)
+        self.assertTrue(resp['Content-Type'].startswith('text/plain; version=0.0.4'))
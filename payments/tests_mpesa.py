@@ -1,9 +1,11 @@
 from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.urls import reverse
 from django.contrib.auth import get_user_model
 from unittest.mock import patch, Mock, MagicMock
 from decimal import Decimal
 import json
-from payments.models import Payment
+from payments.models import Payment, PaymentPayload
 from payments.utils.mpesa_api import (
     initiate_stk_push, 
     get_access_token,
@@ -286,3 +288,179 @@ class MPESAPaymentFlowTests(TestCase):
             self.assertIsNotNone(called_args[0])  # payment id
             # optional: ensure attempt parameters passed
             self.assertIn('attempts', mock_delay.call_args[1])
+
+
+class PaymentTransitionTests(TestCase):
+    """Conditional status transitions shared by the callback, pollers and reconcile."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='transition', password='pw')
+
+    def _payment(self, status='pending', **kwargs):
+        return Payment.objects.create(user=self.user, amount=Decimal('10.00'), phone_number='254712345678',
+                                      status=status, checkout_request_id='CK_T', **kwargs)
+
+    def test_transition_is_a_single_conditional_update(self):
+        payment = self._payment()
+        with self.assertNumQueries(1):
+            self.assertTrue(Payment.transition(payment.pk, 'success', mpesa_receipt_number='R1'))
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.mpesa_receipt_number), ('success', 'R1'))
+
+    def test_success_is_final(self):
+        payment = self._payment(status='success', mpesa_receipt_number='R1')
+        self.assertFalse(Payment.transition(payment.pk, 'failed', error_code='1032'))
+        self.assertFalse(payment.transition_to('pending', error_message='late poll'))
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.error_code, payment.error_message), ('success', None, None))
+
+    def test_failed_can_still_succeed(self):
+        payment = self._payment(status='failed')
+        self.assertTrue(payment.transition_to('success', mpesa_receipt_number='R2'))
+        self.assertEqual(payment.status, 'success')
+
+    def test_late_poll_does_not_overwrite_callback(self):
+        from payments import tasks as payments_tasks
+        payment = self._payment()
+        # the callback lands between the poll's read and its write
+        with patch.object(payments_tasks, 'query_transaction_status',
+                          side_effect=lambda *_, **__: Payment.transition(payment.pk, 'success', mpesa_receipt_number='R3')
+                          and {'ResultCode': 1037, 'ResultDesc': 'Timeout'}):
+            payments_tasks._poll_payment_status_sync(payment.pk)
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.mpesa_receipt_number, payment.error_code), ('success', 'R3', None))
+
+    def test_sync_poll_accepts_string_result_code(self):
+        from payments import tasks as payments_tasks
+        payment = self._payment()
+        # the query API sends ResultCode as a string
+        with patch.object(payments_tasks, 'query_transaction_status',
+                          return_value={'ResultCode': '0', 'ResultDesc': 'processed successfully'}):
+            payments_tasks._poll_payment_status_sync(payment.pk)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'success')
+
+    def test_duplicate_failure_callback_keeps_success(self):
+        payment = self._payment(status='success', mpesa_receipt_number='R4')
+        body = {'Body': {'stkCallback': {'CheckoutRequestID': 'CK_T', 'ResultCode': 1032, 'ResultDesc': 'Cancelled'}}}
+        response = self.client.post(reverse('payments:mpesa-callback'), data=json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'success')
+        self.assertEqual(payment.callback_raw_data, body)
+
+
+class PaymentPayloadTests(TestCase):
+    """Raw upstream payloads live in PaymentPayload, not on the payment row."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='payloads', password='pw')
+
+    def test_payloads_are_appended_and_read_lazily(self):
+        payment = Payment.objects.create(user=self.user, amount=Decimal('10.00'), phone_number='254712345678')
+        payment.record_payload({'ResponseCode': '0'}, kind='initiate')
+        payment.record_payload({'Body': {'stkCallback': {'ResultCode': 0}}})
+        self.assertEqual(payment.payloads.count(), 2)
+
+        fresh = Payment.objects.get(pk=payment.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(fresh.callback_raw_data, {'Body': {'stkCallback': {'ResultCode': 0}}})
+            # cached after the first access
+            fresh.callback_raw_data
+        self.assertEqual(PaymentPayload.latest_blobs([payment.pk], kind='initiate').keys(), {payment.pk})
+
+    def test_blob_is_compressed(self):
+        data = {'Body': {'stkCallback': {'ResultDesc': 'x' * 2000}}}
+        payment = Payment.objects.create(user=self.user, amount=Decimal('10.00'), phone_number='254712345678',
+                                         callback_raw_data=data)
+        stored = payment.payloads.get()
+        self.assertLess(len(stored.blob), len(json.dumps(data)) // 10)
+        self.assertEqual(stored.data, data)
+
+
+@override_settings(
+    MPESA_ASYNC_INITIATE=True,
+    MPESA_CONSUMER_KEY='test_key',
+    MPESA_CONSUMER_SECRET='test_secret',
+    MPESA_SHORTCODE='123456',
+    MPESA_PASSKEY='test_passkey',
+    MPESA_CALLBACK_URL='https://example.com/callback'
+)
+class AsyncInitiateTests(TestCase):
+    """Accept-then-dispatch initiate flow."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='asyncinit', password='pw')
+        cache.clear()
+
+    @override_settings(MPESA_ADMISSION_INTERVAL=20, MPESA_STK_PROMPT_LIFETIME=30)
+    def test_queues_beyond_budget_and_sheds_past_prompt_lifetime(self):
+        from payments import tasks as payments_tasks
+        from payments.utils import admission
+        responses = []
+        with patch('payments.views.initiate._mpesa_api._simulate_enabled', return_value=False), \
+             patch.object(admission, '_stk_admission', None), \
+             patch.object(payments_tasks.dispatch_stk_push, 'apply_async') as mock_dispatch:
+            for _ in range(3):
+                responses.append(self.client.post(reverse('payments:payments-initiate'), data=json.dumps({
+                    'phone_number': '254712345678',
+                    'amount': 100,
+                }), content_type='application/json', REMOTE_ADDR=f'10.0.0.{len(responses)}'))
+            first, second, third = responses
+            self.assertEqual((first.status_code, second.status_code), (202, 202))
+            # the second push is scheduled one interval later and reported as next in line
+            self.assertAlmostEqual(mock_dispatch.call_args_list[1].kwargs['countdown'], 20, delta=1)
+            self.assertEqual(second.json()['queue_position'], 1)
+            status = self.client.get(second.json()['status_url']).json()
+            self.assertEqual(status['queue_position'], 1)
+            self.assertLessEqual(status['eta_seconds'], 20)
+            # the third would wait ~40s, longer than the 30s prompt lifetime
+            self.assertEqual(third.status_code, 429)
+            self.assertEqual(third['Retry-After'], str(third.json()['retry_after']))
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_initiate_returns_202_without_calling_upstream(self):
+        from payments import tasks as payments_tasks
+        with patch('payments.views.initiate._mpesa_api._simulate_enabled', return_value=False), \
+             patch('payments.views.initiate.initiate_stk_push') as mock_stk, \
+             patch.object(payments_tasks.dispatch_stk_push, 'apply_async') as mock_dispatch:
+            resp = self.client.post(reverse('payments:payments-initiate'), data=json.dumps({
+                'phone_number': '254712345678',
+                'amount': 100,
+            }), content_type='application/json')
+        self.assertEqual(resp.status_code, 202)
+        body = resp.json()
+        self.assertFalse(mock_stk.called)
+        mock_dispatch.assert_called_once_with(args=(body['payment_id'],), countdown=0)
+        self.assertEqual(body['queue_position'], 0)
+        self.assertEqual(body['status_url'], reverse('payments:payments-status-api', args=[body['payment_id']]))
+
+        status = self.client.get(body['status_url']).json()
+        self.assertEqual((status['status'], status['dispatched']), ('PENDING', False))
+
+    def _payment(self, **kwargs):
+        return Payment.objects.create(user=self.user, amount=Decimal('100.00'), phone_number='254712345678', **kwargs)
+
+    def test_dispatch_sends_push_and_schedules_poll(self):
+        from payments import tasks as payments_tasks
+        payment = self._payment()
+        with patch.object(payments_tasks, 'initiate_stk_push',
+                          return_value={'ResponseCode': '0', 'CheckoutRequestID': 'CK_A', 'MerchantRequestID': 'MR_A'}) as mock_stk, \
+             patch.object(payments_tasks.poll_payment_status, 'delay') as mock_poll:
+            payments_tasks._dispatch_stk_push_sync(payment.pk)
+            # a redelivered dispatch never prompts the customer twice
+            payments_tasks._dispatch_stk_push_sync(payment.pk)
+        self.assertEqual(mock_stk.call_count, 1)
+        mock_poll.assert_called_once()
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.checkout_request_id), ('pending', 'CK_A'))
+        self.assertEqual(payment.payloads.get().kind, 'initiate')
+
+    def test_dispatch_failure_marks_payment_failed(self):
+        from payments import tasks as payments_tasks
+        payment = self._payment()
+        with patch.object(payments_tasks, 'initiate_stk_push', side_effect=RuntimeError('Daraja timeout')):
+            payments_tasks._dispatch_stk_push_sync(payment.pk)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'failed')
+        self.assertIn('Daraja timeout', payment.error_message)
@@ -1,8 +1,14 @@
+import smtplib
+import socketserver
+import threading
+import time
+
 from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 from unittest.mock import patch, Mock
 from payments.models import Payment
-from payments.utils.notifications import notify_payment_success
+from payments.utils import notifications
+from payments.utils.notifications import notify_payment_success, NotificationDispatcher, render_notifications
 
 
 class NotificationTests(TestCase):
@@ -36,3 +42,184 @@ class NotificationTests(TestCase):
                 mock_client.messages.create.assert_called()
             except Exception:
                 pass
+
+
+class NotificationTemplateTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username='tmpl', email='tmpl@example.com', password='pw')
+        self.payments = [
+            Payment.objects.create(user=self.user, amount=5, phone_number='0712345678', status='success',
+                                   mpesa_receipt_number=f'T&{i}')
+            for i in range(3)
+        ]
+        notifications.clear_template_cache()
+
+    def tearDown(self):
+        notifications.clear_template_cache()
+
+    def test_templates_compiled_once_per_channel(self):
+        with patch('payments.utils.notifications.get_template', wraps=notifications.get_template) as mock_get:
+            render_notifications('payment_success', 'email', self.payments)
+            render_notifications('payment_success', 'email', self.payments)
+            render_notifications('payment_success', 'sms', self.payments)
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_batch_render_per_channel(self):
+        emails = render_notifications('payment_success', 'email', self.payments)
+        sms = render_notifications('payment_success', 'sms', self.payments)
+        self.assertEqual(len(emails), 3)
+        self.assertIn(f'Payment {self.payments[1].pk}', emails[1])
+        # plain-text output: no HTML escaping of receipt numbers
+        self.assertIn('Receipt: T&1', emails[1])
+        self.assertTrue(sms[2].startswith('Payment of KES'))
+        self.assertIn('T&2', sms[2])
+
+    def test_missing_template_falls_back(self):
+        with patch.dict(notifications.NOTIFICATION_TEMPLATES, {('payment_success', 'email'): 'payments/email/missing.txt'}):
+            body = render_notifications('payment_success', 'email', self.payments[:1])[0]
+        self.assertIn('succeeded. Receipt: T&0', body)
+
+
+class _SMTPStubHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept mail from Django's SMTP backend."""
+
+    def _reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply('220 stub ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode(errors='replace').strip().upper()
+            if cmd.startswith('EHLO') or cmd.startswith('HELO'):
+                self._reply('250 stub')
+            elif cmd == 'DATA':
+                self._reply('354 end with .')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self._reply('250 queued')
+            elif cmd == 'QUIT':
+                self._reply('221 bye')
+                return
+            else:
+                # MAIL FROM, RCPT TO, RSET, NOOP
+                self._reply('250 ok')
+
+
+class _SMTPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SMTPStubHandler)
+        self.connections = 0
+        self.messages = 0
+
+
+class _FlakyConnection:
+    """Email connection that drops once before the `fail_at`-th message, like SMTP mid-batch."""
+
+    def __init__(self, fail_at):
+        self.fail_at = fail_at
+        self.delivered = []
+        self.failed = False
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send_messages(self, messages):
+        sent = 0
+        for message in messages:
+            if len(self.delivered) == self.fail_at and not self.failed:
+                self.failed = True
+                raise smtplib.SMTPServerDisconnected('connection unexpectedly closed')
+            self.delivered.append(message.to)
+            sent += 1
+        return sent
+
+
+class NotificationDispatcherTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username='dispatch', email='dispatch@example.com', password='pw')
+        self.payments = [
+            Payment.objects.create(user=self.user, amount=10 + i, phone_number='0712345678', status='success',
+                                   mpesa_receipt_number=f'R{i}')
+            for i in range(120)
+        ]
+        self.smtp = _SMTPStub()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.smtp.shutdown()
+        self.smtp.server_close()
+
+    def test_batched_throughput_over_one_smtp_connection(self):
+        port = self.smtp.server_address[1]
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                               EMAIL_HOST='127.0.0.1', EMAIL_PORT=port, EMAIL_USE_TLS=False):
+            dispatcher = NotificationDispatcher(batch_size=25, flush_interval=0.05)
+            started = time.monotonic()
+            for p in self.payments:
+                self.assertTrue(dispatcher.enqueue(p))
+            self.assertTrue(dispatcher.flush(timeout=30))
+            elapsed = time.monotonic() - started
+            dispatcher.stop()
+
+        self.assertEqual(self.smtp.messages, len(self.payments))
+        self.assertEqual(dispatcher.stats['emails_sent'], len(self.payments))
+        # every batch reused the same SMTP session
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertGreaterEqual(dispatcher.stats['batches'], len(self.payments) // 25)
+        self.assertLess(elapsed, 30)
+
+    def test_email_retry_reopens_connection(self):
+        dispatcher = NotificationDispatcher(batch_size=10, flush_interval=0.01, base_delay=0)
+        conn = Mock()
+        conn.send_messages.side_effect = [OSError('connection reset'), 1, 1, 1]
+        with patch('payments.utils.notifications.get_connection', return_value=conn) as mock_get_connection:
+            for p in self.payments[:3]:
+                dispatcher.enqueue(p)
+            dispatcher.flush(timeout=10)
+            dispatcher.stop()
+        self.assertEqual(dispatcher.stats['emails_sent'], 3)
+        self.assertEqual(mock_get_connection.call_count, 2)
+
+    def test_failure_midway_does_not_resend_delivered_emails(self):
+        User = get_user_model()
+        payments = [
+            Payment.objects.create(user=User.objects.create_user(username=f'mid{i}', email=f'mid{i}@example.com'),
+                                   amount=10, phone_number='0712345678', status='success', mpesa_receipt_number=f'M{i}')
+            for i in range(3)
+        ]
+        conn = _FlakyConnection(fail_at=1)
+        dispatcher = NotificationDispatcher(batch_size=10, flush_interval=0.01, base_delay=0)
+        with patch('payments.utils.notifications.get_connection', return_value=conn):
+            for p in payments:
+                dispatcher.enqueue(p)
+            dispatcher.flush(timeout=10)
+            dispatcher.stop()
+        # each customer exactly once (the admin copy goes to DEFAULT_FROM_EMAIL on every message)
+        delivered = sorted(recipients[0] for recipients in conn.delivered)
+        self.assertEqual(delivered, ['mid0@example.com', 'mid1@example.com', 'mid2@example.com'])
+        self.assertEqual(dispatcher.stats['emails_sent'], 3)
+        self.assertEqual(dispatcher.stats['failed'], 0)
+
+    @patch('payments.utils.notifications.TwilioClient')
+    def test_sms_uses_one_long_lived_client(self, mock_twilio):
+        with override_settings(TWILIO_ACCOUNT_SID='sid-dispatch', TWILIO_AUTH_TOKEN='token', TWILIO_FROM_NUMBER='+1000000000'):
+            dispatcher = NotificationDispatcher(batch_size=5, flush_interval=0.01)
+            for p in self.payments[:12]:
+                dispatcher.enqueue(p, via=('sms',))
+            dispatcher.flush(timeout=10)
+            dispatcher.stop()
+        mock_twilio.assert_called_once_with('sid-dispatch', 'token')
+        self.assertEqual(mock_twilio.return_value.messages.create.call_count, 12)
@@ -0,0 +1,148 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from payments.models import Payment
+from payments.utils.reconcile import ReconcileEngine, UpstreamVerifier, bulk_transition, parse_callback
+
+
+def _stk_callback(result_code, receipt=None):
+    stk = {'CheckoutRequestID': 'CK', 'ResultCode': result_code, 'ResultDesc': 'desc'}
+    if receipt:
+        stk['CallbackMetadata'] = {'Item': [{'Name': 'Amount', 'Value': 1}, {'Name': 'MpesaReceiptNumber', 'Value': receipt}]}
+    return {'Body': {'stkCallback': stk}}
+
+
+class ParseCallbackTests(TestCase):
+    def test_stk_success_with_receipt(self):
+        self.assertEqual(parse_callback(_stk_callback(0, 'R1')), (True, 'R1'))
+
+    def test_stk_failure(self):
+        self.assertEqual(parse_callback(_stk_callback(1032)), (False, None))
+
+    def test_json_string_and_legacy_response_code(self):
+        raw = json.dumps({'ResponseCode': '0', 'MpesaReceiptNumber': 'R2'})
+        self.assertEqual(parse_callback(raw), (True, 'R2'))
+
+    def test_unparsable(self):
+        self.assertEqual(parse_callback('{not json'), (False, None))
+
+
+class ReconcileEngineTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username='recon', password='pw')
+        self.ok = [
+            Payment.objects.create(user=self.user, amount=10, phone_number='254712345678', status='failed',
+                                   error_message='timeout', callback_raw_data=_stk_callback(0, f'R{i}'))
+            for i in range(5)
+        ]
+        self.bad = Payment.objects.create(user=self.user, amount=10, phone_number='254712345678', status='failed',
+                                          callback_raw_data=_stk_callback(1032))
+
+    def test_command_marks_successful_callbacks(self):
+        out = StringIO()
+        call_command('reconcile_payments', '--chunk-size', '2', stdout=out)
+        for p in self.ok:
+            p.refresh_from_db()
+            self.assertEqual(p.status, 'success')
+            self.assertIsNone(p.error_message)
+        self.assertTrue(self.ok[0].mpesa_receipt_number.startswith('R'))
+        self.bad.refresh_from_db()
+        self.assertEqual(self.bad.status, 'failed')
+        self.assertIn('marked 5 as success', out.getvalue())
+        self.assertIn('rows/sec', out.getvalue())
+
+    def test_dry_run_does_not_write(self):
+        call_command('reconcile_payments', '--dry-run', stdout=StringIO())
+        self.assertEqual(Payment.objects.filter(status='success').count(), 0)
+
+    def test_checkpoint_resumes_after_limit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'reconcile.json')
+            first = ReconcileEngine(chunk_size=2, limit=3, checkpoint=path).run()
+            self.assertFalse(first['complete'])
+            self.assertEqual(first['inspected'], 3)
+            self.assertTrue(os.path.exists(path))
+
+            second = ReconcileEngine(chunk_size=2, checkpoint=path).run()
+            self.assertTrue(second['complete'])
+            # only the rows after the checkpoint were inspected on the second run
+            self.assertEqual(second['inspected'], 3)
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(Payment.objects.filter(status='success').count(), 5)
+
+    def test_limit_covering_the_remaining_rows_completes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'reconcile.json')
+            summary = ReconcileEngine(chunk_size=2, limit=6, checkpoint=path).run()
+            self.assertEqual(summary['inspected'], 6)
+            self.assertTrue(summary['complete'])
+            self.assertFalse(os.path.exists(path))
+
+    def test_initiate_response_is_not_treated_as_a_callback(self):
+        accepted = Payment.objects.create(user=self.user, amount=10, phone_number='254712345678', status='failed',
+                                          checkout_request_id='CK_INIT')
+        # an accepted STK push ("ResponseCode": "0") says nothing about the payment outcome
+        accepted.record_payload({'ResponseCode': '0', 'CheckoutRequestID': 'CK_INIT'}, kind='initiate')
+        self.assertNotIn(accepted.pk, ReconcileEngine().queryset().values_list('pk', flat=True))
+        self.assertIn(accepted.pk, UpstreamVerifier().queryset().values_list('pk', flat=True))
+
+    def test_bulk_transition_skips_rows_settled_meanwhile(self):
+        stale = Payment.objects.get(pk=self.ok[0].pk)
+        fresh = Payment.objects.get(pk=self.ok[1].pk)
+        # a callback settled ok[0] after the chunk was read
+        Payment.objects.filter(pk=stale.pk).update(status='success', mpesa_receipt_number='CB')
+        stale.status = fresh.status = 'success'
+        stale.mpesa_receipt_number = fresh.mpesa_receipt_number = 'STALE'
+        self.assertEqual(bulk_transition([stale, fresh]), [fresh])
+        self.assertEqual(Payment.objects.get(pk=stale.pk).mpesa_receipt_number, 'CB')
+        self.assertEqual(Payment.objects.get(pk=fresh.pk).mpesa_receipt_number, 'STALE')
+
+
+class UpstreamVerifierTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username='verify', password='pw')
+
+    def _payment(self, checkout_id, status='pending', **kwargs):
+        return Payment.objects.create(user=self.user, amount=10, phone_number='254712345678',
+                                      status=status, checkout_request_id=checkout_id, **kwargs)
+
+    def test_verifies_pending_and_callbackless_failed_payments(self):
+        paid = self._payment('CK_PAID')
+        cancelled = self._payment('CK_CANCEL')
+        lost = self._payment('CK_LOST', status='failed')
+        still_processing = self._payment('CK_BUSY')
+        # failed payments with a stored callback are left to the callback reconcile pass
+        with_callback = self._payment('CK_CB', status='failed', callback_raw_data=_stk_callback(1032))
+
+        responses = {
+            'CK_PAID': {'ResultCode': '0', 'MpesaReceiptNumber': 'RX1'},
+            'CK_CANCEL': {'ResultCode': '1032', 'ResultDesc': 'Request cancelled by user'},
+            'CK_LOST': {'ResultCode': 0, 'MpesaReceiptNumber': 'RX2'},
+        }
+        queried = []
+
+        def fake_query(identifier):
+            queried.append(identifier)
+            if identifier not in responses:
+                raise RuntimeError('The transaction is being processed')
+            return responses[identifier]
+
+        result = UpstreamVerifier(workers=3, chunk_size=2, query=fake_query).run()
+
+        self.assertNotIn('CK_CB', queried)
+        self.assertEqual(result['verified'], 4)
+        self.assertEqual((result['success'], result['failed'], result['errors']), (2, 1, 1))
+        for p in (paid, cancelled, lost, still_processing, with_callback):
+            p.refresh_from_db()
+        self.assertEqual((paid.status, paid.mpesa_receipt_number), ('success', 'RX1'))
+        self.assertEqual((lost.status, lost.mpesa_receipt_number), ('success', 'RX2'))
+        self.assertEqual((cancelled.status, cancelled.error_code), ('failed', '1032'))
+        self.assertEqual(still_processing.status, 'pending')
+        self.assertEqual(with_callback.status, 'failed')
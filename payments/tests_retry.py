@@ -0,0 +1,94 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from payments.utils import retry as retry_module
+from payments.utils.rate_limit import RateLimiter
+from payments.utils.retry import DeadlineExceeded, deadline_scope, decorrelated_jitter, remaining_time, retry
+
+
+class _Clock:
+    """Fake monotonic clock advanced by the sleeps the retry loop takes."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class DeadlineRetryTests(SimpleTestCase):
+    def _run(self, use_tenacity, budget, fail_times=10, attempts=5):
+        clock = _Clock()
+        calls = []
+
+        with patch.object(retry_module, '_HAS_TENACITY', use_tenacity), \
+             patch.object(retry_module.time, 'monotonic', clock.monotonic), \
+             patch.object(retry_module.time, 'sleep', clock.sleep), \
+             patch('tenacity.nap.time.sleep', clock.sleep):
+            @retry(max_attempts=attempts, base_delay=1.0, max_delay=4.0, exceptions=(ConnectionError,))
+            def call(timeout=20):
+                calls.append((clock.now, timeout))
+                clock.now += 0.5
+                if len(calls) <= fail_times:
+                    raise ConnectionError('down')
+                return 'ok'
+
+            with deadline_scope(budget):
+                try:
+                    return call(), calls
+                except Exception as exc:
+                    return exc, calls
+
+    def test_attempts_that_cannot_finish_are_skipped(self):
+        for use_tenacity in (True, False):
+            with self.subTest(tenacity=use_tenacity):
+                result, calls = self._run(use_tenacity, budget=3.0)
+                self.assertIsInstance(result, Exception)
+                # every attempt started with at least a second of budget left
+                self.assertTrue(all(start <= 1002.0 for start, _ in calls))
+                self.assertLess(len(calls), 5)
+                # the timeout never outlives the deadline
+                self.assertTrue(all(timeout <= 1003.0 - start for start, timeout in calls))
+
+    def test_succeeds_within_budget(self):
+        for use_tenacity in (True, False):
+            with self.subTest(tenacity=use_tenacity):
+                result, calls = self._run(use_tenacity, budget=60, fail_times=1)
+                self.assertEqual(result, 'ok')
+                self.assertEqual(len(calls), 2)
+                self.assertEqual(calls[0][1], 20)
+
+    def test_expired_deadline_is_not_attempted(self):
+        @retry(max_attempts=3, exceptions=(ConnectionError,))
+        def call(timeout=5):
+            raise AssertionError('should not be called')
+
+        with deadline_scope(0):
+            with self.assertRaises(Exception) as ctx:
+                call()
+        self.assertNotIsInstance(ctx.exception, AssertionError)
+
+    def test_nested_scopes_only_shorten(self):
+        self.assertIsNone(remaining_time())
+        with deadline_scope(10):
+            with deadline_scope(60):
+                self.assertLessEqual(remaining_time(), 10)
+        self.assertIsNone(remaining_time())
+
+    def test_decorrelated_jitter_bounds(self):
+        sleeps = [decorrelated_jitter(2.0, 0.5, 4.0) for _ in range(200)]
+        self.assertTrue(all(0.5 <= s <= 4.0 for s in sleeps))
+        self.assertGreater(len(set(sleeps)), 1)
+
+    def test_rate_limit_wait_respects_deadline(self):
+        limiter = RateLimiter('deadline-test', requests_per_period=1, period_seconds=60, use_redis=False)
+        limiter.acquire()
+        with patch('payments.utils.rate_limit.get_mpesa_rate_limiter', return_value=limiter):
+            from payments.utils.rate_limit import wait_for_rate_limit
+            with deadline_scope(0.2):
+                with self.assertRaises(DeadlineExceeded):
+                    wait_for_rate_limit()
@@ -0,0 +1,97 @@
+import json
+import os
+import tempfile
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+
+from payments.utils import tracing
+
+
+class _Collector:
+    def __init__(self):
+        self.spans = []
+
+    def submit(self, span):
+        self.spans.append(span.as_dict())
+
+    def named(self, name):
+        return [s for s in self.spans if s['name'] == name]
+
+
+class TracingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.exported = _Collector()
+        patcher = patch.object(tracing, '_get_exporter', return_value=self.exported)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_children_share_the_trace(self):
+        with tracing.start_span('outer') as outer:
+            with tracing.start_span('inner') as inner:
+                self.assertEqual(tracing.parse_traceparent(tracing.current_traceparent())[:2],
+                                 (outer.trace_id, inner.span_id))
+        with self.assertRaises(ValueError), tracing.start_span('broken'):
+            raise ValueError('boom')
+        inner_span, outer_span, broken = self.exported.spans
+        self.assertEqual((inner_span['trace_id'], inner_span['parent_id']), (outer_span['trace_id'], outer_span['span_id']))
+        self.assertIsNone(outer_span['parent_id'])
+        self.assertEqual(broken['status'], 'error')
+        self.assertIsNone(tracing.parse_traceparent('00-zz-11-01'))
+
+    def test_context_travels_in_celery_headers(self):
+        headers = {}
+        with tracing.start_span('payments.initiate') as root:
+            tracing._on_publish(headers=headers)
+        task = SimpleNamespace(name='payments.tasks.poll_payment_status',
+                               request=SimpleNamespace(headers=headers, retries=2))
+        tracing._on_prerun(task_id='t-1', task=task)
+        self.assertEqual(tracing.current_span().trace_id, root.trace_id)
+        tracing._on_postrun(task_id='t-1', state='SUCCESS')
+        self.assertIsNone(tracing.current_span())
+        poll = self.exported.named('celery.poll_payment_status')[0]
+        self.assertEqual((poll['trace_id'], poll['parent_id']), (root.trace_id, root.span_id))
+        self.assertEqual(poll['attributes']['celery.retries'], 2)
+
+    def test_callback_joins_the_purchase_trace(self):
+        from payments import tasks as payments_tasks
+        body = json.dumps({'phone_number': '254712345678', 'amount': 100})
+        with patch('payments.views.initiate._mpesa_api._simulate_enabled', return_value=False), \
+             patch('payments.views.initiate.initiate_stk_push',
+                   return_value={'CheckoutRequestID': 'ws_CO_T1', 'MerchantRequestID': 'm1'}), \
+             patch('payments.views.initiate.get_access_token', return_value='fake_token'), \
+             patch.object(payments_tasks.poll_payment_status, 'delay'):
+            self.client.post(reverse('payments:payments-initiate'), data=body, content_type='application/json')
+        callback = {'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_T1', 'ResultCode': 0, 'ResultDesc': 'ok',
+                                             'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'R1'}]}}}}
+        self.client.post(reverse('payments:mpesa-callback'), data=json.dumps(callback), content_type='application/json')
+
+        initiate = self.exported.named('payments.initiate')[0]
+        settled = self.exported.named('payments.callback')[0]
+        self.assertEqual(initiate['attributes']['mpesa.checkout_id'], 'ws_CO_T1')
+        self.assertEqual((settled['trace_id'], settled['parent_id']), (initiate['trace_id'], initiate['span_id']))
+        self.assertEqual(settled['attributes']['payment.status'], 'success')
+        self.assertGreaterEqual(settled['attributes']['payment.push_to_settle_ms'], 0)
+
+    def test_jsonl_export_and_report(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        exporter = tracing.SpanExporter(kind='jsonl', path=path)
+        with patch.object(tracing, '_get_exporter', return_value=exporter):
+            with tracing.start_span('payments.initiate'):
+                tracing.set_attributes(**{'mpesa.checkout_id': 'ws_CO_R'})
+                with tracing.start_span('mpesa.stkpush'):
+                    pass
+        exporter.flush()
+        with open(path) as fh:
+            self.assertEqual(len(fh.readlines()), 2)
+        otlp = tracing.to_otlp([json.loads(line) for line in open(path)])
+        self.assertEqual(len(otlp['resourceSpans'][0]['scopeSpans'][0]['spans']), 2)
+        with patch('sys.stdout'):
+            call_command('trace_report', file=path, top=1)
@@ -3,6 +3,7 @@ app_name = 'payments'
 from django.urls import path
 from .views.callback import mpesa_callback
 from .views import status, webhook
+from .views.basic import callback_diagnostics_view, circuit_status, metrics
 from .views.initiate import initiate_payment
 from .views.status_api import payment_status
 from .views.simulate_callback import simulate_callback
@@ -11,7 +12,10 @@ from .views_history import payment_history, payment_detail, access_logs_api, his
 urlpatterns = [
     path('status/', status, name='payments-status'),
     path('webhook/', webhook, name='payments-webhook'),
+    path('circuit/', circuit_status, name='circuit-status'),
+    path('metrics/', metrics, name='metrics'),
     path('callback/', mpesa_callback, name='mpesa-callback'),
+    path('callback/diagnostics/', callback_diagnostics_view, name='callback-diagnostics'),
     path('initiate/', initiate_payment, name='payments-initiate'),
     path('status/<str:checkout_id>/', payment_status, name='payments-status-api'),
     path('simulate_callback/<str:checkout_id>/', simulate_callback, name='simulate-callback'),
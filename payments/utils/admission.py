@@ -0,0 +1,123 @@
+"""Admission queue for STK pushes.
+
+Instead of rejecting initiate requests once the M-Pesa budget is spent, each
+request is given a dispatch time on a virtual clock (GCRA): pushes are spaced
+exactly `interval` seconds apart, and a request arriving while the clock is
+ahead of real time queues behind the ones already admitted. The dispatcher
+task is scheduled for that time, so pushes leave at the allowed rate instead of
+piling onto the `RateLimiter`.
+
+A request is only shed when its wait would exceed `MPESA_STK_PROMPT_LIFETIME`:
+by then the customer would have given up on the prompt anyway.
+
+State lives in the Django cache (shared by all web workers when Redis backs
+it). The per-IP `rate_limit` on the initiate view still applies as an abuse guard.
+"""
+import logging
+import math
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """The estimated wait exceeds the STK prompt lifetime."""
+
+    def __init__(self, wait, retry_after):
+        super().__init__(f'estimated wait {wait:.0f}s exceeds the STK prompt lifetime')
+        self.wait = wait
+        self.retry_after = retry_after
+
+
+class AdmissionQueue:
+    def __init__(self, name='mpesa_stk', interval=None, max_wait=None, lock_timeout=2.0):
+        if interval is None:
+            interval = getattr(settings, 'MPESA_ADMISSION_INTERVAL', None)
+        if interval is None:
+            # pushes are spread over every configured Daraja credential
+            from payments.utils.mpesa_api import get_credential_pool
+            interval = 1.0 / (get_credential_pool().rate_per_second() or 1.0)
+        if max_wait is None:
+            max_wait = getattr(settings, 'MPESA_STK_PROMPT_LIFETIME', 60)
+        self.name = name
+        self.interval = float(interval)
+        self.max_wait = float(max_wait)
+        self.lock_timeout = lock_timeout
+        self._tat_key = f'admission:{name}:tat'
+        self._lock_key = f'admission:{name}:lock'
+
+    def _ticket_key(self, ticket_id):
+        return f'admission:{self.name}:ticket:{ticket_id}'
+
+    @contextmanager
+    def _locked(self):
+        # cache.add is atomic on Redis and locmem; short critical section only
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_timeout
+        acquired = False
+        while time.monotonic() < deadline:
+            if cache.add(self._lock_key, token, timeout=max(1, math.ceil(self.lock_timeout))):
+                acquired = True
+                break
+            time.sleep(0.005)
+        if not acquired:
+            logger.warning('admission: could not lock %s; admitting without it', self.name)
+        try:
+            yield
+        finally:
+            if acquired and cache.get(self._lock_key) == token:
+                cache.delete(self._lock_key)
+
+    def admit(self, now=None):
+        """Reserve the next dispatch slot; returns the wait in seconds (0 = dispatch now).
+
+        Raises `AdmissionRejected` when the wait would exceed `max_wait`.
+        """
+        now = time.time() if now is None else now
+        with self._locked():
+            tat = max(float(cache.get(self._tat_key) or 0), now)
+            wait = tat - now
+            if wait > self.max_wait:
+                raise AdmissionRejected(wait, retry_after=math.ceil(wait - self.max_wait))
+            new_tat = tat + self.interval
+            # expires once the queue has drained: an old clock is the same as none
+            cache.set(self._tat_key, new_tat, timeout=math.ceil(new_tat - now) + 1)
+        return wait
+
+    def record(self, ticket_id, wait, now=None):
+        """Remember when `ticket_id` (a payment id) is due, for `position()`."""
+        now = time.time() if now is None else now
+        cache.set(self._ticket_key(ticket_id), now + wait, timeout=math.ceil(wait) + 60)
+
+    def position(self, ticket_id, now=None):
+        """Return `(queue_position, eta_seconds)` for a queued ticket, or None once it is due."""
+        due = cache.get(self._ticket_key(ticket_id))
+        if due is None:
+            return None
+        now = time.time() if now is None else now
+        eta = due - now
+        if eta <= 0:
+            return None
+        # tickets are spaced `interval` apart, so this many are due before ours
+        return math.ceil(eta / self.interval), eta
+
+    def depth(self, now=None):
+        """Number of admitted requests still waiting for their slot."""
+        now = time.time() if now is None else now
+        tat = float(cache.get(self._tat_key) or 0)
+        return max(0, math.ceil((tat - now) / self.interval) - 1) if tat > now else 0
+
+
+_stk_admission = None
+
+
+def get_stk_admission_queue():
+    global _stk_admission
+    if _stk_admission is None:
+        _stk_admission = AdmissionQueue()
+    return _stk_admission
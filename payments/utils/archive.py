@@ -0,0 +1,137 @@
+"""Archive tier for settled payments.
+
+`archive_payments` moves settled payments (success/failed) that have not
+changed for `PAYMENT_ARCHIVE_AFTER_DAYS` days from `Payment` into
+`PaymentArchive`, one primary-key ordered batch per transaction. A batch is
+either moved completely or not at all, so an interrupted run is resumed by
+simply running the command again.
+
+The hot table therefore only holds recent and in-flight payments. Views that
+show a user's history read through to the archive with the helpers below.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from payments.models import Payment, PaymentArchive, PaymentPayload
+
+logger = logging.getLogger(__name__)
+
+SETTLED_STATUSES = ('success', 'failed')
+
+# Columns shared by Payment and PaymentArchive (what history/export rows need)
+ROW_FIELDS = ('id', 'amount', 'phone_number', 'account_ref', 'description', 'merchant_request_id',
+              'checkout_request_id', 'mpesa_receipt_number', 'status', 'created_at', 'updated_at')
+
+# Columns copied into the archive
+_COPY_FIELDS = ROW_FIELDS + ('user_id', 'error_code', 'error_message', 'credential_name')
+
+
+def archive_cutoff(days=None):
+    if days is None:
+        days = int(getattr(settings, 'PAYMENT_ARCHIVE_AFTER_DAYS', 180))
+    return timezone.now() - timedelta(days=days)
+
+
+def archive_candidates(cutoff, below_pk=None):
+    """Settled payments last updated before `cutoff` (and with a primary key below `below_pk`)."""
+    qs = Payment.objects.filter(status__in=SETTLED_STATUSES, updated_at__lt=cutoff)
+    if below_pk is not None:
+        qs = qs.filter(pk__lt=below_pk)
+    return qs
+
+
+def newest_payment_pk():
+    """Current highest Payment id.
+
+    That row is never archived: some databases (MySQL before 8.0) recompute the
+    auto-increment counter from MAX(id) on restart, and would then hand out an
+    id that already exists in the archive.
+    """
+    return Payment.objects.aggregate(top=Max('pk'))['top']
+
+
+def _archived_payloads(ids):
+    grouped = {}
+    rows = (PaymentPayload.objects.filter(payment_id__in=ids)
+            .order_by('payment_id', '-id')
+            .values_list('payment_id', 'kind', 'created_at', 'blob'))
+    for payment_id, kind, created_at, blob in rows:
+        grouped.setdefault(payment_id, []).append({
+            'kind': kind,
+            'created_at': created_at.isoformat(),
+            'data': PaymentPayload.decode(blob),
+        })
+    return {pk: PaymentPayload.encode(items) for pk, items in grouped.items()}
+
+
+def archive_batch(cutoff, batch_size=500, below_pk=None):
+    """Move one batch of candidates into the archive; returns the archived ids (empty when done)."""
+    with transaction.atomic():
+        ids = list(archive_candidates(cutoff, below_pk).select_for_update()
+                   .order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return []
+        rows = Payment.objects.filter(pk__in=ids).values(*_COPY_FIELDS)
+        payloads = _archived_payloads(ids)
+        now = timezone.now()
+        # no ignore_conflicts: an id already in the archive must roll the batch back,
+        # not be skipped and then deleted from the hot table
+        PaymentArchive.objects.bulk_create(
+            [PaymentArchive(archived_at=now, payloads_blob=payloads.get(row['id']), **row) for row in rows])
+        # cascades to PaymentPayload; access logs are kept (no FK constraint)
+        Payment.objects.filter(pk__in=ids).delete()
+    return ids
+
+
+# --- read-through helpers for views ---
+
+def get_payment(pk, **filters):
+    """Return the Payment with `pk`, or its archived copy; None if neither exists."""
+    payment = Payment.objects.filter(pk=pk, **filters).first()
+    if payment is None:
+        payment = PaymentArchive.objects.filter(pk=pk, **filters).first()
+    return payment
+
+
+class HistoryRow:
+    """Attribute access over a history row dict, so templates and exports treat both tiers alike."""
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def get_status_display(self):
+        return dict(Payment.STATUS_CHOICES).get(self.status, self.status)
+
+
+class PaymentHistory:
+    """Sequence over hot and archived payments combined with a single UNION ALL query.
+
+    Supports what `Paginator` and the exports need: `count()`, slicing and iteration.
+    """
+
+    def __init__(self, hot, archived, ordering=('-created_at',)):
+        # compound statements only allow ordering on the combined result
+        self.queryset = (hot.order_by().values(*ROW_FIELDS)
+                         .union(archived.order_by().values(*ROW_FIELDS), all=True)
+                         .order_by(*ordering))
+
+    def count(self):
+        return self.queryset.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        rows = self.queryset[key]
+        if isinstance(key, slice):
+            return [HistoryRow(row) for row in rows]
+        return HistoryRow(rows)
+
+    def __iter__(self):
+        for row in self.queryset.iterator():
+            yield HistoryRow(row)
@@ -0,0 +1,169 @@
+"""Single-pass decoder for M-Pesa STK callbacks.
+
+Callbacks reach us as a JSON body (sometimes labelled form-urlencoded), as a form
+post carrying the JSON in a `Body` field (or in its only field), and — from some
+relays — as plain form fields. The encoding is detected once from the content
+type and the first byte of the body, and the payload is parsed
+with orjson when it is installed (the stdlib `json` otherwise), straight from
+the raw bytes.
+
+The fields the payment flow needs are then read in one walk of the payload
+into a `CallbackRecord`: the `CallbackMetadata.Item` list is matched against a
+name -> field table instead of being scanned once per field. The callback view,
+`reconcile_payments` and the `find_failed_but_success` script all decode through
+here, so they agree on what a successful callback looks like.
+"""
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib parser
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+FORM_CONTENT_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+# CallbackMetadata item names (lower-cased) -> CallbackRecord field
+ITEM_FIELDS = {
+    'amount': 'amount',
+    'mpesareceiptnumber': 'receipt',
+    'mpesa_receipt_number': 'receipt',
+    'receiptnumber': 'receipt',
+    'transactionreceipt': 'receipt',
+    'phonenumber': 'phone',
+    'transactiondate': 'transaction_date',
+}
+
+
+def loads(raw):
+    """Parse JSON from `bytes` or `str` with the fastest available backend."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _as_int(value):
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_decimal(value):
+    if value is None:
+        return None
+    try:
+        return Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        return None
+
+
+class CallbackRecord:
+    """The typed fields of one callback; `data` keeps the parsed payload for auditing."""
+
+    __slots__ = ('data', 'checkout_id', 'merchant_request_id', 'result_code', 'result_desc',
+                 'response_code', 'receipt', 'amount', 'phone', 'transaction_date')
+
+    def __init__(self, data=None):
+        self.data = data
+        self.checkout_id = None
+        self.merchant_request_id = None
+        self.result_code = None
+        self.result_desc = None
+        # legacy top-level `ResponseCode` payloads (see reconcile.parse_callback)
+        self.response_code = None
+        self.receipt = None
+        self.amount = None
+        self.phone = None
+        self.transaction_date = None
+
+    @property
+    def success(self):
+        return self.result_code == 0
+
+    def __repr__(self):
+        return (f'CallbackRecord(checkout_id={self.checkout_id!r}, result_code={self.result_code!r}, '
+                f'receipt={self.receipt!r})')
+
+
+def decode(payload):
+    """Decode an already-read payload: a dict, or JSON as `str`/`bytes`.
+
+    Never raises; an unparsable payload gives a record whose `data` is None.
+    """
+    if isinstance(payload, (str, bytes, bytearray, memoryview)):
+        try:
+            payload = loads(bytes(payload) if isinstance(payload, memoryview) else payload) if payload else None
+        except (TypeError, ValueError):
+            payload = None
+    if not isinstance(payload, dict) or not payload:
+        return CallbackRecord()
+    return _extract(payload)
+
+
+def decode_request(request):
+    """Decode the callback carried by a Django request, detecting its encoding once.
+
+    A body that starts with `{` is JSON whatever the Content-Type says (relays
+    post JSON as form-urlencoded); otherwise form content types go through
+    `request.POST`.
+    """
+    content_type = (request.META.get('CONTENT_TYPE') or '').split(';', 1)[0].strip().lower()
+    body = request.body
+    if content_type not in FORM_CONTENT_TYPES or body.lstrip()[:1] == b'{':
+        return decode(body)
+    form = request.POST
+    if not form:
+        return CallbackRecord()
+    # JSON in the `Body` field, else in the first field, else the fields themselves
+    for raw in (form.get('Body'), next(iter(form.values()), None)):
+        if raw:
+            record = decode(raw)
+            if record.data is not None:
+                return record
+    return _extract({key: form.get(key) for key in form.keys()})
+
+
+def _extract(data):
+    record = CallbackRecord(data)
+    body = data.get('Body')
+    stk = body.get('stkCallback') if isinstance(body, dict) else None
+    if not isinstance(stk, dict):
+        # the stkCallback fields at the top level (relays, older sandboxes)
+        record.checkout_id = data.get('CheckoutRequestID') or data.get('checkout_request_id')
+        record.merchant_request_id = data.get('MerchantRequestID')
+        record.result_code = _as_int(data.get('ResultCode'))
+        record.result_desc = data.get('ResultDesc')
+        record.response_code = _as_int(data.get('ResponseCode', data.get('responseCode')))
+        record.receipt = data.get('MpesaReceiptNumber') or data.get('ReceiptNumber')
+        return record
+
+    record.checkout_id = stk.get('CheckoutRequestID')
+    record.merchant_request_id = stk.get('MerchantRequestID')
+    record.result_code = _as_int(stk.get('ResultCode'))
+    record.result_desc = stk.get('ResultDesc')
+    metadata = stk.get('CallbackMetadata')
+    items = metadata.get('Item') if isinstance(metadata, dict) else None
+    if not isinstance(items, list):
+        return record
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        name = str(item.get('Name') or '').lower()
+        field = ITEM_FIELDS.get(name) or ('receipt' if 'receipt' in name else None)
+        if field and getattr(record, field) is None:
+            setattr(record, field, item.get('Value'))
+    if record.receipt is None and len(items) > 1 and isinstance(items[1], dict):
+        # Daraja sends the receipt second; keep that as a last resort for renamed items
+        record.receipt = items[1].get('Value')
+    record.amount = _as_decimal(record.amount)
+    if record.phone is not None:
+        record.phone = str(record.phone)
+    return record
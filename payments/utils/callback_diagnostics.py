@@ -0,0 +1,130 @@
+"""Sampled diagnostics for the M-Pesa callback.
+
+The callback used to dump every request's headers, forwarding info and body to
+the log. Instead, a full diagnostic record (headers with secrets redacted,
+forwarding info, truncated body, outcome) is captured only for:
+
+* anomalies — no parseable payload, unknown checkout id, unreadable fields or a
+  failed update — which are what diagnostics are for;
+* a random CALLBACK_DIAGNOSTICS_SAMPLE_RATE share of normal callbacks;
+
+and never more than CALLBACK_DIAGNOSTICS_PER_MINUTE per process
+(CALLBACK_DIAGNOSTICS='all' captures everything, 'off' nothing). Records go to
+a ring buffer of CALLBACK_DIAGNOSTICS_BUFFER slots in the shared cache, so staff
+see captures from every web process at /payments/callback/diagnostics/.
+Nothing is formatted unless a record is captured.
+"""
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+ANOMALIES = frozenset({'no_payload', 'bad_fields', 'not_found', 'error'})
+REDACTED_HEADERS = frozenset({'authorization', 'cookie', 'proxy-authorization', 'x-api-key'})
+_SEQ_KEY = 'cbdiag:seq'
+_SLOT_KEY = 'cbdiag:slot:{}'
+
+
+class _Budget:
+    """Per-process token bucket: at most `per_minute` captures, refilled continuously."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._updated = time.monotonic()
+
+    def take(self, per_minute):
+        with self._lock:
+            now = time.monotonic()
+            if self._tokens is None:
+                self._tokens = float(per_minute)
+            self._tokens = min(float(per_minute), self._tokens + (now - self._updated) * per_minute / 60.0)
+            self._updated = now
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+
+_budget = _Budget()
+
+
+def _mode():
+    return (getattr(settings, 'CALLBACK_DIAGNOSTICS', 'sampled') or 'off').lower()
+
+
+def _buffer_size():
+    return max(1, int(getattr(settings, 'CALLBACK_DIAGNOSTICS_BUFFER', 100)))
+
+
+def should_capture(outcome):
+    mode = _mode()
+    if mode == 'all':
+        return True
+    if mode != 'sampled':
+        return False
+    if outcome not in ANOMALIES and random.random() >= float(getattr(settings, 'CALLBACK_DIAGNOSTICS_SAMPLE_RATE', 0.01)):
+        return False
+    return _budget.take(int(getattr(settings, 'CALLBACK_DIAGNOSTICS_PER_MINUTE', 6)))
+
+
+def _snapshot(request, outcome, checkout_id):
+    meta = request.META
+    try:
+        host = request.get_host()
+    except Exception:
+        host = meta.get('HTTP_HOST') or meta.get('SERVER_NAME')
+    try:
+        body = request.body.decode('utf-8', 'replace')
+    except Exception:
+        body = ''
+    limit = int(getattr(settings, 'CALLBACK_DIAGNOSTICS_BODY_CHARS', 2000))
+    return {
+        'at': time.time(),
+        'outcome': outcome,
+        'checkout_id': checkout_id,
+        'method': request.method,
+        'host': host,
+        'path': request.get_full_path(),
+        'remote_addr': meta.get('REMOTE_ADDR'),
+        'x_forwarded_for': meta.get('HTTP_X_FORWARDED_FOR'),
+        'x_forwarded_proto': meta.get('HTTP_X_FORWARDED_PROTO') or request.scheme,
+        'content_type': meta.get('CONTENT_TYPE'),
+        'headers': {k: ('<redacted>' if k.lower() in REDACTED_HEADERS else v) for k, v in request.headers.items()},
+        'body': body[:limit],
+        'body_truncated': len(body) > limit,
+    }
+
+
+def record(request, outcome, checkout_id=None):
+    """Capture a diagnostic record for this callback if it is sampled; returns whether it was."""
+    if not should_capture(outcome):
+        return False
+    try:
+        entry = _snapshot(request, outcome, checkout_id)
+        cache.add(_SEQ_KEY, 0, None)
+        seq = cache.incr(_SEQ_KEY)
+        entry['seq'] = seq
+        cache.set(_SLOT_KEY.format(seq % _buffer_size()), entry,
+                  int(getattr(settings, 'CALLBACK_DIAGNOSTICS_TTL', 86400)))
+    except Exception:
+        logger.debug('callback diagnostics: capture failed', exc_info=True)
+        return False
+    return True
+
+
+def recent(limit=None):
+    """Captured records, newest first."""
+    size = _buffer_size()
+    entries = [e for e in cache.get_many([_SLOT_KEY.format(i) for i in range(size)]).values() if e]
+    entries.sort(key=lambda e: e.get('seq', 0), reverse=True)
+    return entries[:limit] if limit else entries
+
+
+def clear():
+    cache.delete_many([_SEQ_KEY] + [_SLOT_KEY.format(i) for i in range(_buffer_size())])
@@ -0,0 +1,242 @@
+"""Probabilistic guard that lets the callback skip lookups for checkout ids we never issued.
+
+Every callback used to cost a `Payment` query, including junk and replays for
+ids that were never ours. A Bloom filter of the checkout ids issued in the last
+CHECKOUT_FILTER_WINDOW_DAYS is built from the database and stored in the shared
+cache; each process keeps an in-memory copy and re-checks the cache for a newer
+build every CHECKOUT_FILTER_REFRESH_SECONDS. The filter is rebuilt every
+CHECKOUT_FILTER_REBUILD_SECONDS by the `rebuild_checkout_filter` beat task; the
+first process that finds it missing or stale queues that task (or, without
+Celery, builds it in a background thread) and answers "maybe" until the new
+build is published, so no callback ever waits for the scan.
+
+Ids issued after a build are not in it, so each issued id is also written to a
+short-lived `checkout:issued:<id>` cache key that outlives the filter build it
+missed. `might_exist` therefore only answers False for an id that is in neither
+— one that is definitely unknown — and answers True whenever it cannot tell
+(no filter, cache errors, CHECKOUT_FILTER_ENABLED=0). A Bloom filter has false
+positives (CHECKOUT_FILTER_FP_RATE), never false negatives, so a false answer
+never drops a real callback.
+
+All of that relies on every web and Celery process sharing one cache: an id
+issued by a worker is only visible to the web process through it. The guard is
+therefore only active while the default cache is shared (Redis, memcached, the
+database cache, or TieredCache with Redis reachable); with the per-process
+local-memory cache, or while TieredCache has fallen back to L1, every id is a
+"maybe" and the callback looks the payment up as before.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.utils import timezone
+
+from payments.utils.metrics import CALLBACK_REJECTED
+
+logger = logging.getLogger(__name__)
+
+_FILTER_KEY = 'checkout_filter:bits'
+_VERSION_KEY = 'checkout_filter:built_at'
+_LOCK_KEY = 'checkout_filter:rebuild_lock'
+_ISSUED_KEY = 'checkout:issued:{}'
+# a requested build that has not published by then is requested again
+_REBUILD_LOCK_SECONDS = 120
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (double hashing of one blake2b digest)."""
+
+    __slots__ = ('size', 'hashes', 'bits')
+
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_rate):
+        """Optimal size and hash count for `capacity` items at false-positive rate `fp_rate`."""
+        capacity = max(1, int(capacity))
+        size = max(64, int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2))))
+        hashes = max(1, int(round(size / capacity * math.log(2))))
+        return cls(size, hashes)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+def _enabled():
+    return bool(getattr(settings, 'CHECKOUT_FILTER_ENABLED', True))
+
+
+def _rebuild_seconds():
+    return int(getattr(settings, 'CHECKOUT_FILTER_REBUILD_SECONDS', 300))
+
+
+def _refresh_seconds():
+    return float(getattr(settings, 'CHECKOUT_FILTER_REFRESH_SECONDS', 30))
+
+
+def _stale_seconds():
+    # a build older than this is not trusted: issued-id keys only cover this long
+    return 3 * _rebuild_seconds()
+
+
+def _issued_ttl():
+    return _stale_seconds() + int(_refresh_seconds()) + 60
+
+
+def cache_is_shared():
+    """Whether the default cache is one store for every process (and currently reachable)."""
+    backend = caches['default']
+    try:
+        from core.utils.tiered_cache import TieredCache
+    except ImportError:  # pragma: no cover - the tiered cache ships with core
+        TieredCache = None
+    if TieredCache is not None and isinstance(backend, TieredCache):
+        return backend.l2_available()
+    from django.core.cache.backends.db import DatabaseCache
+    from django.core.cache.backends.memcached import BaseMemcachedCache
+    from django.core.cache.backends.redis import RedisCache
+    return isinstance(backend, (RedisCache, BaseMemcachedCache, DatabaseCache))
+
+
+def mark_issued(checkout_id):
+    """Record a newly issued checkout id until the next filter build includes it."""
+    if not checkout_id or not _enabled():
+        return
+    try:
+        cache.set(_ISSUED_KEY.format(checkout_id), 1, _issued_ttl())
+    except Exception:
+        logger.debug('checkout filter: could not mark %s as issued', checkout_id, exc_info=True)
+
+
+def rebuild():
+    """Build the filter from the issued checkout ids in the window and publish it; returns the id count."""
+    from payments.models import Payment
+
+    since = timezone.now() - timedelta(days=int(getattr(settings, 'CHECKOUT_FILTER_WINDOW_DAYS', 30)))
+    started = time.time()
+    ids = list(Payment.objects.filter(created_at__gte=since, checkout_request_id__isnull=False)
+               .exclude(checkout_request_id='')
+               .values_list('checkout_request_id', flat=True).iterator(chunk_size=5000))
+    # headroom so ids issued before the next build keep the false-positive rate near target
+    bloom = BloomFilter.for_capacity(len(ids) * 1.25 + 1000,
+                                     float(getattr(settings, 'CHECKOUT_FILTER_FP_RATE', 0.001)))
+    for checkout_id in ids:
+        bloom.add(checkout_id)
+    timeout = _stale_seconds() * 2
+    # stamped with the query start: ids issued after it are covered by their issued keys
+    cache.set(_FILTER_KEY, {'size': bloom.size, 'hashes': bloom.hashes, 'bits': bytes(bloom.bits),
+                            'built_at': started}, timeout)
+    cache.set(_VERSION_KEY, started, timeout)
+    cache.delete(_LOCK_KEY)
+    _local.update(bloom, started)
+    logger.info('checkout filter: rebuilt with %d ids (%d bytes) in %.2fs', len(ids), len(bloom.bits),
+                time.time() - started)
+    return len(ids)
+
+
+class _LocalCopy:
+    """This process's copy of the shared filter."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bloom = None
+        self.built_at = None
+        self.checked = 0.0
+
+    def update(self, bloom, built_at):
+        with self._lock:
+            self.bloom, self.built_at, self.checked = bloom, built_at, time.monotonic()
+
+    def reset(self):
+        self.update(None, None)
+        self.checked = 0.0
+
+    def get(self):
+        """The current filter, or None when there is no usable one."""
+        if time.monotonic() - self.checked >= _refresh_seconds():
+            self._refresh()
+        if self.built_at is None or time.time() - self.built_at > _stale_seconds():
+            return None
+        return self.bloom
+
+    def _refresh(self):
+        try:
+            built_at = cache.get(_VERSION_KEY)
+            if built_at is not None and built_at == self.built_at:
+                self.checked = time.monotonic()
+                return
+            stored = cache.get(_FILTER_KEY) if built_at is not None else None
+            if stored and time.time() - stored['built_at'] <= _stale_seconds():
+                self.update(BloomFilter(stored['size'], stored['hashes'], stored['bits']), stored['built_at'])
+                return
+            # missing or stale: one process asks for a build, everyone answers "maybe" meanwhile
+            if cache.add(_LOCK_KEY, 1, _REBUILD_LOCK_SECONDS):
+                _request_rebuild()
+        except Exception:
+            logger.warning('checkout filter: refresh failed; callbacks fall back to lookups', exc_info=True)
+        self.update(None, None)
+
+
+def _rebuild_in_background():
+    from django.db import connection
+
+    try:
+        rebuild()
+    except Exception:
+        logger.exception('checkout filter: background rebuild failed')
+    finally:
+        connection.close()
+
+
+def _request_rebuild():
+    """Queue `rebuild_checkout_filter` on the maintenance queue; a daemon thread builds it without Celery."""
+    from payments.tasks import rebuild_checkout_filter
+
+    if hasattr(rebuild_checkout_filter, 'delay'):
+        try:
+            rebuild_checkout_filter.delay()
+            return
+        except Exception:
+            logger.warning('checkout filter: could not queue a rebuild; building in the background', exc_info=True)
+    threading.Thread(target=_rebuild_in_background, name='checkout-filter-rebuild', daemon=True).start()
+
+
+_local = _LocalCopy()
+
+
+def might_exist(checkout_id):
+    """False only if `checkout_id` was definitely never issued (in the window); counts those rejections."""
+    if not checkout_id or not _enabled() or not cache_is_shared():
+        return True
+    bloom = _local.get()
+    if bloom is None or checkout_id in bloom:
+        return True
+    try:
+        if cache.get(_ISSUED_KEY.format(checkout_id)):
+            return True
+    except Exception:
+        return True
+    if not cache_is_shared():
+        # the lookup fell back to this process's L1: a miss proves nothing
+        return True
+    CALLBACK_REJECTED.inc()
+    return False
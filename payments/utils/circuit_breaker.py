@@ -0,0 +1,176 @@
+"""Circuit breaker for upstream (Daraja) calls.
+
+While Daraja is healthy the circuit is *closed* and calls go through. After
+`failure_threshold` consecutive upstream failures it *opens*: calls fail fast with
+`CircuitOpenError` (no HTTP request, no retry backoff, no rate-limit slot) for
+`recovery_timeout` seconds. After that it is *half-open*: a single caller is let
+through as a probe. A successful probe closes the circuit, a failed one opens it again;
+a probe that never got an answer from upstream (a local error, an exhausted
+deadline) leaves it half-open for the next caller.
+
+State lives in the Django cache so every web and Celery worker sees the same
+circuit (use Redis when running more than one process). Transitions are counted
+per target state for the staff status endpoint.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+
+class CircuitOpenError(RuntimeError):
+    """The circuit is open; the call was not attempted."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f'circuit {name} is open; retry in {retry_after}s')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30, is_failure=None, is_response=None):
+        """
+        Args:
+            name: Identifier shared by all processes guarding the same upstream
+            failure_threshold: Consecutive failures that open the circuit
+            recovery_timeout: Seconds the circuit stays open before a probe is allowed
+            is_failure: Optional callable(exc) -> bool; exceptions it rejects (e.g. a
+                4xx caused by bad input) pass through without counting against upstream
+            is_response: Optional callable(exc) -> bool; whether a non-failure exception
+                carries an upstream answer (default: it has a `status_code`). Only those
+                close a half-open circuit.
+        """
+        self.name = name
+        self.failure_threshold = int(failure_threshold)
+        self.recovery_timeout = float(recovery_timeout)
+        self.is_failure = is_failure or (lambda exc: True)
+        self.is_response = is_response or (lambda exc: getattr(exc, 'status_code', None) is not None)
+        self._failures_key = f'circuit:{name}:failures'
+        self._opened_key = f'circuit:{name}:opened_at'
+        self._probe_key = f'circuit:{name}:probe'
+
+    def _count_key(self, state):
+        return f'circuit:{self.name}:transitions:{state}'
+
+    def _transition(self, state):
+        key = self._count_key(state)
+        try:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+        logger.warning('circuit %s -> %s', self.name, state)
+
+    def state(self, now=None):
+        opened_at = cache.get(self._opened_key)
+        if opened_at is None:
+            return CLOSED
+        now = time.time() if now is None else now
+        return OPEN if now - opened_at < self.recovery_timeout else HALF_OPEN
+
+    def open_for(self, now=None):
+        """Seconds until the circuit lets a probe through (0 when calls may go ahead)."""
+        opened_at = cache.get(self._opened_key)
+        if opened_at is None:
+            return 0
+        now = time.time() if now is None else now
+        remaining = self.recovery_timeout - (now - opened_at)
+        return max(1, int(remaining + 0.999)) if remaining > 0 else 0
+
+    def before_call(self, now=None):
+        """Raise `CircuitOpenError` unless the call may go ahead; returns True for a half-open probe."""
+        opened_at = cache.get(self._opened_key)
+        if opened_at is None:
+            return False
+        now = time.time() if now is None else now
+        retry_after = self.open_for(now)
+        if retry_after:
+            raise CircuitOpenError(self.name, retry_after=retry_after)
+        # only one caller probes; the marker expires in case the probe never reports back
+        if not cache.add(self._probe_key, now, timeout=max(1, int(self.recovery_timeout))):
+            raise CircuitOpenError(self.name, retry_after=max(1, int(self.recovery_timeout)))
+        self._transition(HALF_OPEN)
+        return True
+
+    def record_success(self, probe=False):
+        if probe or cache.get(self._opened_key) is not None:
+            cache.delete_many([self._opened_key, self._probe_key, self._failures_key])
+            self._transition(CLOSED)
+        elif cache.get(self._failures_key):
+            cache.delete(self._failures_key)
+
+    def release_probe(self):
+        """Give up the half-open probe without a verdict, so the next caller probes instead."""
+        cache.delete(self._probe_key)
+
+    def record_failure(self, probe=False, now=None):
+        now = time.time() if now is None else now
+        if probe:
+            self._open(now)
+            return
+        try:
+            cache.add(self._failures_key, 0, timeout=None)
+            failures = cache.incr(self._failures_key)
+        except ValueError:
+            cache.set(self._failures_key, 1, timeout=None)
+            failures = 1
+        if failures >= self.failure_threshold and cache.get(self._opened_key) is None:
+            self._open(now)
+
+    def _open(self, now):
+        cache.set(self._opened_key, now, timeout=None)
+        cache.delete_many([self._probe_key, self._failures_key])
+        self._transition(OPEN)
+
+    @contextmanager
+    def guard(self):
+        """Run the body under the breaker: fail fast while open, record the outcome otherwise."""
+        probe = self.before_call()
+        try:
+            yield
+        except Exception as exc:
+            if self.is_failure(exc):
+                self.record_failure(probe=probe)
+            elif probe and self.is_response(exc):
+                # upstream answered; it is back
+                self.record_success(probe=True)
+            elif probe:
+                # nothing reached upstream (token, deadline, local bug): no evidence either way
+                self.release_probe()
+            raise
+        else:
+            self.record_success(probe=probe)
+
+    def __call__(self, fn):
+        """Use the breaker as a decorator."""
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.guard():
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def stats(self):
+        counts = cache.get_many([self._count_key(s) for s in STATES])
+        return {
+            'name': self.name,
+            'state': self.state(),
+            'consecutive_failures': cache.get(self._failures_key) or 0,
+            'opened_at': cache.get(self._opened_key),
+            'failure_threshold': self.failure_threshold,
+            'recovery_timeout': self.recovery_timeout,
+            'transitions': {s: counts.get(self._count_key(s), 0) for s in STATES},
+        }
+
+    def reset(self):
+        cache.delete_many([self._opened_key, self._probe_key, self._failures_key]
+                          + [self._count_key(s) for s in STATES])
+
@@ -0,0 +1,145 @@
+"""Pool of Daraja credential sets (consumer key/secret + shortcode/passkey).
+
+Each Daraja app is rate limited on its own, so one set of credentials caps the
+whole system at `MPESA_RATE_LIMIT_REQUESTS` per period. With several apps configured,
+every credential keeps its own OAuth token and `RateLimiter` budget and STK pushes are
+spread across them by available headroom, so throughput grows with the pool.
+
+Credentials come from `settings.MPESA_CREDENTIALS` (a list of dicts) or, failing that,
+the `mpesa_credentials` list in the local `accounts.json`:
+
+    {"name": "app2", "consumer_key": "...", "consumer_secret": "...",
+     "shortcode": "...", "passkey": "...", "rate_limit_requests": 4}
+
+Without either, the pool holds a single `default` credential read from the
+`MPESA_CONSUMER_KEY`/`MPESA_SHORTCODE`/... settings, which is also what payments
+without a recorded credential are queried with.
+"""
+import logging
+import random
+import threading
+
+from django.conf import settings
+
+from .rate_limit import RateLimiter, get_mpesa_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CREDENTIAL = 'default'
+
+_SETTING_NAMES = {
+    'consumer_key': 'MPESA_CONSUMER_KEY',
+    'consumer_secret': 'MPESA_CONSUMER_SECRET',
+    'shortcode': 'MPESA_SHORTCODE',
+    'passkey': 'MPESA_PASSKEY',
+}
+
+
+class DarajaCredential:
+    """One Daraja app: its secrets, OAuth token cache and rate-limit budget."""
+
+    def __init__(self, name, consumer_key=None, consumer_secret=None, shortcode=None, passkey=None,
+                 rate_limit_requests=None, rate_limit_period=None, limiter=None, token_cache=None, token_lock=None):
+        self.name = name
+        self._values = {
+            'consumer_key': consumer_key,
+            'consumer_secret': consumer_secret,
+            'shortcode': shortcode,
+            'passkey': passkey,
+        }
+        if limiter is None:
+            requests = int(rate_limit_requests or getattr(settings, 'MPESA_RATE_LIMIT_REQUESTS', 4))
+            period = int(rate_limit_period or getattr(settings, 'MPESA_RATE_LIMIT_PERIOD', 60))
+            limiter = RateLimiter(f'mpesa_api:{name}', requests_per_period=requests, period_seconds=period)
+        self.limiter = limiter
+        self.token_cache = token_cache if token_cache is not None else {'token': None, 'expiry': 0.0}
+        self.token_lock = token_lock or threading.Lock()
+
+    def _get(self, field):
+        # unset fields fall back to settings, read at call time (override_settings friendly)
+        value = self._values[field]
+        return value if value is not None else getattr(settings, _SETTING_NAMES[field], None)
+
+    @property
+    def consumer_key(self):
+        return self._get('consumer_key')
+
+    @property
+    def consumer_secret(self):
+        return self._get('consumer_secret')
+
+    @property
+    def shortcode(self):
+        return self._get('shortcode')
+
+    @property
+    def passkey(self):
+        return self._get('passkey')
+
+    def headroom(self):
+        return self.limiter.headroom()
+
+    def __repr__(self):
+        return f'<DarajaCredential {self.name}>'
+
+
+class CredentialPool:
+    def __init__(self, credentials, fallback):
+        self.credentials = list(credentials) or [fallback]
+        self.fallback = fallback
+        self._by_name = {c.name: c for c in self.credentials}
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def get(self, name):
+        """Credential called `name`; unknown or empty names get the settings credential."""
+        if isinstance(name, DarajaCredential):
+            return name
+        return self._by_name.get(name) or self.fallback
+
+    def pick(self):
+        """Credential with the most rate-limit headroom right now (random among ties)."""
+        if len(self.credentials) == 1:
+            return self.credentials[0]
+        scored = [(c.headroom(), c) for c in self.credentials]
+        best = max(score for score, _ in scored)
+        return random.choice([c for score, c in scored if score == best])
+
+    def rate_per_second(self):
+        """Aggregate sustained request rate of the pool."""
+        return sum(c.limiter.rate_per_second() for c in self.credentials)
+
+
+def _configured_credentials():
+    configured = getattr(settings, 'MPESA_CREDENTIALS', None)
+    if not configured:
+        try:
+            from core.utils.accounts import load_accounts
+            configured = load_accounts().get('mpesa_credentials')
+        except FileNotFoundError:
+            configured = None
+        except Exception:
+            logger.exception('credentials: could not read mpesa_credentials from accounts.json')
+            configured = None
+    return configured or []
+
+
+def build_pool(configured=None, token_cache=None, token_lock=None):
+    """Build the pool; the settings credential reuses the module-level token cache and limiter."""
+    fallback = DarajaCredential(DEFAULT_CREDENTIAL, limiter=get_mpesa_rate_limiter(),
+                                token_cache=token_cache, token_lock=token_lock)
+    credentials = []
+    for entry in configured if configured is not None else _configured_credentials():
+        entry = dict(entry)
+        name = entry.pop('name', None)
+        if not name or any(c.name == name for c in credentials):
+            logger.error('credentials: skipping entry with a missing or duplicate name: %r', name)
+            continue
+        try:
+            credentials.append(fallback if name == DEFAULT_CREDENTIAL and not entry else DarajaCredential(name, **entry))
+        except TypeError as exc:
+            logger.error('credentials: invalid entry %s: %s', name, exc)
+    if credentials:
+        logger.info('credentials: %d Daraja credential sets configured', len(credentials))
+    return CredentialPool(credentials, fallback)
@@ -0,0 +1,367 @@
+"""Local stand-in for the Daraja API, for offline load and failure testing.
+
+Unlike `MPESA_SIMULATE` (which short-circuits `mpesa_api` with instant canned
+answers), this is a real HTTP server the unmodified client talks to. Point
+`MPESA_BASE_URL` at it and the whole stack runs against it:
+
+    python manage.py daraja_simulator --port 8090 --latency lognormal:300,0.5 \\
+        --error-rate 0.02 --callback-url http://127.0.0.1:8000/payments/callback/
+    MPESA_BASE_URL=http://127.0.0.1:8090 python manage.py runserver
+
+It serves the endpoints `mpesa_api` uses, with Daraja's response shapes:
+
+- `GET  /oauth/v1/generate`          OAuth token (Basic auth with any key/secret)
+- `POST /mpesa/stkpush/v1/processrequest`   STK push; the outcome is decided up front
+  and its callback is POSTed to the CallBackURL after a random delay
+- `POST /mpesa/stkpushquery/v1/query`       "being processed" until the customer
+  has "answered", then the outcome
+- `GET  /simulator/stats`                   request/outcome counters (JSON)
+
+Latency, error and timeout rates, per-consumer-key rate limits, callback delay and
+the mix of outcomes (0 success, 1 insufficient funds, 1032 cancelled, 1037 timed
+out) are configurable through `SimulatorConfig`.
+"""
+import base64
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+try:
+    import requests
+except Exception:  # requests may not be installed in this environment
+    requests = None
+
+logger = logging.getLogger(__name__)
+
+RESULT_DESCRIPTIONS = {
+    0: 'The service request is processed successfully.',
+    1: 'The balance is insufficient for the transaction.',
+    1032: 'Request cancelled by user.',
+    1037: 'DS timeout user cannot be reached.',
+}
+
+PROCESSING_ERROR = ('500.001.1001', 'The transaction is being processed')
+
+
+def parse_latency(spec):
+    """Parse a latency spec into a sampler returning seconds.
+
+    `fixed:MS`, `uniform:MIN_MS,MAX_MS`, `lognormal:MEDIAN_MS,SIGMA` or `none`.
+    """
+    kind, _, args = (spec or 'none').partition(':')
+    values = [float(v) for v in args.split(',') if v.strip()]
+    if kind == 'none':
+        return lambda: 0.0
+    if kind == 'fixed' and len(values) == 1:
+        return lambda: values[0] / 1000.0
+    if kind == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1]) / 1000.0
+    if kind == 'lognormal' and len(values) == 2:
+        mu = math.log(values[0] / 1000.0)
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f'invalid latency spec: {spec!r}')
+
+
+def parse_outcomes(spec):
+    """Parse `0=0.8,1032=0.1,...` into a {result_code: weight} dict."""
+    outcomes = {}
+    for part in (spec or '').split(','):
+        if part.strip():
+            code, _, weight = part.partition('=')
+            outcomes[int(code)] = float(weight)
+    if not outcomes or sum(outcomes.values()) <= 0:
+        raise ValueError(f'invalid outcome spec: {spec!r}')
+    return outcomes
+
+
+class SimulatorConfig:
+    def __init__(self, latency='uniform:50,200', error_rate=0.0, timeout_rate=0.0, timeout_seconds=30.0,
+                 rate_limit=5, rate_period=60.0, callback_delay=(2.0, 8.0), outcomes=None,
+                 callback_url=None, token_ttl=3599):
+        """
+        Args:
+            latency: Latency spec for every API response (see `parse_latency`)
+            error_rate: Fraction of API calls answered with a 500 error
+            timeout_rate: Fraction of API calls held for `timeout_seconds` (the client times out)
+            rate_limit: Requests per consumer key per `rate_period` seconds (0 = unlimited)
+            callback_delay: (min, max) seconds before the STK callback is delivered
+            outcomes: {result_code: weight} for STK pushes (default mostly success)
+            callback_url: Deliver callbacks here instead of the request's CallBackURL
+        """
+        self.latency = parse_latency(latency) if isinstance(latency, str) else latency
+        self.error_rate = float(error_rate)
+        self.timeout_rate = float(timeout_rate)
+        self.timeout_seconds = float(timeout_seconds)
+        self.rate_limit = int(rate_limit)
+        self.rate_period = float(rate_period)
+        self.callback_delay = tuple(callback_delay)
+        self.outcomes = outcomes or {0: 0.85, 1032: 0.08, 1037: 0.05, 1: 0.02}
+        self.callback_url = callback_url
+        self.token_ttl = int(token_ttl)
+
+
+class DarajaSimulator:
+    """Simulator state: tokens, per-key rate windows, transactions and counters."""
+
+    def __init__(self, config=None, deliver=None):
+        self.config = config or SimulatorConfig()
+        # deliver(url, payload) posts a callback; replaceable for tests
+        self.deliver = deliver or self._post_callback
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._windows = {}
+        self._transactions = {}
+        self._timers = []
+        self.server = None
+
+    # --- state helpers (thread-safe) ---
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def issue_token(self, consumer_key):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._tokens[token] = consumer_key
+        return token
+
+    def key_for_token(self, token):
+        with self._lock:
+            return self._tokens.get(token)
+
+    def allow(self, consumer_key, now=None):
+        """Sliding-window rate limit per consumer key."""
+        if not self.config.rate_limit:
+            return True
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            window = self._windows.setdefault(consumer_key, deque())
+            while window and window[0] <= now - self.config.rate_period:
+                window.popleft()
+            if len(window) >= self.config.rate_limit:
+                return False
+            window.append(now)
+            return True
+
+    def create_transaction(self, payload):
+        checkout_id = f"ws_CO_{datetime.utcnow():%d%m%Y%H%M%S}{uuid.uuid4().hex[:10]}"
+        merchant_id = f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1"
+        codes, weights = zip(*self.config.outcomes.items())
+        result_code = random.choices(codes, weights=weights)[0]
+        delay = random.uniform(*self.config.callback_delay)
+        txn = {
+            'checkout_id': checkout_id,
+            'merchant_id': merchant_id,
+            'result_code': result_code,
+            'amount': payload.get('Amount'),
+            'phone': payload.get('PhoneNumber'),
+            'callback_url': self.config.callback_url or payload.get('CallBackURL'),
+            'answered_at': time.monotonic() + delay,
+            'receipt': f"SIM{uuid.uuid4().hex[:7].upper()}" if result_code == 0 else None,
+        }
+        with self._lock:
+            self._transactions[checkout_id] = txn
+            self.stats[f'outcome_{result_code}'] += 1
+        if txn['callback_url']:
+            timer = threading.Timer(delay, self._send_callback, args=(txn,))
+            timer.daemon = True
+            timer.start()
+            with self._lock:
+                if len(self._timers) > 1000:
+                    self._timers = [t for t in self._timers if t.is_alive()]
+                self._timers.append(timer)
+        return txn
+
+    def transaction(self, checkout_id):
+        with self._lock:
+            return self._transactions.get(checkout_id)
+
+    # --- callbacks ---
+
+    def callback_payload(self, txn):
+        callback = {
+            'MerchantRequestID': txn['merchant_id'],
+            'CheckoutRequestID': txn['checkout_id'],
+            'ResultCode': txn['result_code'],
+            'ResultDesc': RESULT_DESCRIPTIONS.get(txn['result_code'], 'Failed'),
+        }
+        if txn['result_code'] == 0:
+            callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': txn['amount']},
+                {'Name': 'MpesaReceiptNumber', 'Value': txn['receipt']},
+                {'Name': 'TransactionDate', 'Value': int(datetime.now().strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': txn['phone']},
+            ]}
+        return {'Body': {'stkCallback': callback}}
+
+    def _send_callback(self, txn):
+        try:
+            self.deliver(txn['callback_url'], self.callback_payload(txn))
+            self._count('callbacks_delivered')
+        except Exception as exc:
+            self._count('callbacks_failed')
+            logger.warning('simulator: callback for %s to %s failed: %s', txn['checkout_id'], txn['callback_url'], exc)
+
+    @staticmethod
+    def _post_callback(url, payload):
+        if requests is None:
+            raise RuntimeError("The 'requests' package is required to deliver callbacks")
+        requests.post(url, json=payload, timeout=10).raise_for_status()
+
+    # --- server lifecycle ---
+
+    def serve(self, host='127.0.0.1', port=8090):
+        """Create the HTTP server (port 0 picks a free port); call `serve_forever()` or `start()`."""
+        simulator = self
+
+        class Handler(_DarajaHandler):
+            sim = simulator
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        return self.server
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve in a background thread; returns the base URL."""
+        server = self.serve(host, port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f'http://{server.server_address[0]}:{server.server_address[1]}'
+
+    def stop(self):
+        with self._lock:
+            timers, self._timers = self._timers, []
+        for timer in timers:
+            timer.cancel()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class _DarajaHandler(BaseHTTPRequestHandler):
+    sim = None  # set on the per-server subclass
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('simulator: ' + format, *args)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, code, message):
+        self._send(status, {'requestId': uuid.uuid4().hex[:12], 'errorCode': code, 'errorMessage': message})
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return None
+
+    def _consumer_key(self):
+        auth = self.headers.get('Authorization') or ''
+        scheme, _, value = auth.partition(' ')
+        if scheme == 'Bearer':
+            return self.sim.key_for_token(value.strip())
+        return None
+
+    def _faults(self, consumer_key):
+        """Apply latency, injected faults and rate limiting; returns True when a response was sent."""
+        sim = self.sim
+        time.sleep(sim.config.latency())
+        roll = random.random()
+        if roll < sim.config.timeout_rate:
+            sim._count('timeouts')
+            time.sleep(sim.config.timeout_seconds)
+            self.close_connection = True
+            return True
+        if roll < sim.config.timeout_rate + sim.config.error_rate:
+            sim._count('errors')
+            self._error(500, '500.003.02', 'System is busy. Please try again in few minutes.')
+            return True
+        if consumer_key is not None and not sim.allow(consumer_key):
+            sim._count('rate_limited')
+            self._error(429, '500.003.03', 'Quota Violation: too many requests')
+            return True
+        return False
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/simulator/stats':
+            with self.sim._lock:
+                return self._send(200, dict(self.sim.stats))
+        if path != '/oauth/v1/generate':
+            return self._error(404, '404.001.01', 'Resource not found')
+        self.sim._count('token_requests')
+        scheme, _, value = (self.headers.get('Authorization') or '').partition(' ')
+        try:
+            consumer_key = base64.b64decode(value).decode('utf-8').split(':', 1)[0] if scheme == 'Basic' else ''
+        except Exception:
+            consumer_key = ''
+        if not consumer_key:
+            return self._error(400, '400.008.01', 'Invalid Authentication passed')
+        if self._faults(None):
+            return None
+        return self._send(200, {'access_token': self.sim.issue_token(consumer_key),
+                                'expires_in': str(self.sim.config.token_ttl)})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        consumer_key = self._consumer_key()
+        payload = self._read_json()
+        if path not in ('/mpesa/stkpush/v1/processrequest', '/mpesa/stkpushquery/v1/query'):
+            return self._error(404, '404.001.01', 'Resource not found')
+        self.sim._count('stk_push_requests' if path.endswith('processrequest') else 'query_requests')
+        if consumer_key is None:
+            return self._error(401, '404.001.03', 'Invalid Access Token')
+        if payload is None:
+            return self._error(400, '400.002.02', 'Bad Request - Invalid JSON')
+        if self._faults(consumer_key):
+            return None
+        if path.endswith('processrequest'):
+            return self._stk_push(payload)
+        return self._query(payload)
+
+    def _stk_push(self, payload):
+        missing = [f for f in ('BusinessShortCode', 'Password', 'Amount', 'PhoneNumber', 'CallBackURL') if not payload.get(f)]
+        if missing:
+            return self._error(400, '400.002.02', f'Bad Request - Invalid {missing[0]}')
+        txn = self.sim.create_transaction(payload)
+        return self._send(200, {
+            'MerchantRequestID': txn['merchant_id'],
+            'CheckoutRequestID': txn['checkout_id'],
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        })
+
+    def _query(self, payload):
+        txn = self.sim.transaction(payload.get('CheckoutRequestID') or payload.get('Identifier'))
+        if txn is None:
+            return self._error(400, '400.002.02', 'Bad Request - Invalid CheckoutRequestID')
+        if time.monotonic() < txn['answered_at']:
+            # what Daraja answers while the customer has not responded yet
+            return self._error(500, *PROCESSING_ERROR)
+        return self._send(200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': txn['merchant_id'],
+            'CheckoutRequestID': txn['checkout_id'],
+            'ResultCode': str(txn['result_code']),
+            'ResultDesc': RESULT_DESCRIPTIONS.get(txn['result_code'], 'Failed'),
+        })
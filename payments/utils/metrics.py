@@ -0,0 +1,407 @@
+"""Prometheus-style metrics for the payments pipeline, aggregated across processes.
+
+Counters and histograms are kept in one Redis hash (METRICS_REDIS_URL, else the
+Celery broker, like `RateLimiter`), so every gunicorn and Celery worker adds
+into the same series and any process can serve the scrape. Each process buffers
+its updates in memory and a background thread flushes them in one pipeline every
+METRICS_FLUSH_INTERVAL seconds (also after every Celery task and at exit);
+observing is a dict update on the hot path and never waits on Redis. Without Redis the registry is process-local.
+
+Gauges come in two kinds:
+
+* `gauge_callback`: evaluated by the scraping process (e.g. pending payments,
+  counted in the database);
+* `process_gauge`: evaluated by every process when it flushes and summed over
+  the processes that flushed within METRICS_GAUGE_STALE_SECONDS (e.g. the
+  in-process notification queue).
+
+`render()` produces the Prometheus text exposition format served by
+`/payments/metrics/`.
+"""
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+try:
+    import redis
+    from redis.exceptions import RedisError
+    _HAS_REDIS = True
+except Exception:
+    redis = None
+    _HAS_REDIS = False
+    RedisError = Exception
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_REDIS_KEY = 'metrics:payments'
+_REDIS_GAUGES_KEY = 'metrics:payments:gauges'
+_REDIS_RETRY_SECONDS = 30.0
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    inner = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+    return f'{name}{{{inner}}}'
+
+
+def _format(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _labels(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple((k, labels[k]) for k in self.labelnames)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.registry._add({_series(self.name, self._labels(labels)): amount})
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        base = self._labels(labels)
+        updates = {
+            _series(f'{self.name}_sum', base): value,
+            _series(f'{self.name}_count', base): 1,
+            _series(f'{self.name}_bucket', base + (('le', '+Inf'),)): 1,
+        }
+        for bound in self.buckets:
+            if value <= bound:
+                updates[_series(f'{self.name}_bucket', base + (('le', _format(bound)),))] = 1
+        self.registry._add(updates)
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self, redis_url=None, flush_interval=None):
+        """
+        Args:
+            redis_url: Redis to aggregate in ('' for process-local; None to read settings)
+            flush_interval: Seconds between flushes (None to read METRICS_FLUSH_INTERVAL)
+        """
+        self._redis_url = redis_url
+        self._flush_interval = flush_interval
+        self._metrics = {}
+        self._callbacks = {}
+        self._process_gauges = {}
+        self._lock = threading.Lock()
+        self._buffer = defaultdict(float)
+        self._local = defaultdict(float)  # aggregated values when there is no Redis
+        self._client = None
+        self._redis_retry_at = 0.0
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+
+    @property
+    def _process(self):
+        # read on every flush: gunicorn forks workers after the module is imported
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    # --- registration ---
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name, documentation, fn):
+        """Gauge computed by the scraping process; `fn(values)` gets the counter values and returns a number."""
+        self._callbacks[name] = (documentation, fn)
+
+    def process_gauge(self, name, documentation, fn):
+        """Per-process gauge, summed over live processes; `fn` returns this process's value."""
+        self._process_gauges[name] = (documentation, fn)
+
+    # --- storage ---
+
+    def _url(self):
+        url = self._redis_url
+        if url is None:
+            url = getattr(settings, 'METRICS_REDIS_URL', '') or getattr(settings, 'CELERY_BROKER_URL', '') or ''
+        return url if _HAS_REDIS and url.startswith(('redis://', 'rediss://')) else None
+
+    def _uses_redis(self):
+        return self._url() is not None
+
+    def _redis(self):
+        if self._client is not None:
+            return self._client
+        url = self._url()
+        if url is None or time.monotonic() < self._redis_retry_at:
+            return None
+        try:
+            client = redis.from_url(url, decode_responses=True, socket_timeout=1.0, socket_connect_timeout=1.0)
+            client.ping()
+        except Exception as exc:
+            logger.warning('metrics: Redis unavailable, buffering locally for %ss: %s', _REDIS_RETRY_SECONDS, exc)
+            self._redis_retry_at = time.monotonic() + _REDIS_RETRY_SECONDS
+            return None
+        self._client = client
+        return client
+
+    def _add(self, updates):
+        with self._lock:
+            for series, amount in updates.items():
+                self._buffer[series] += amount
+        self._start_flusher()
+
+    def _interval(self):
+        interval = self._flush_interval
+        if interval is None:
+            interval = float(getattr(settings, 'METRICS_FLUSH_INTERVAL', 1.0))
+        return max(0.01, interval)
+
+    def _start_flusher(self):
+        # started on first use, so each forked gunicorn worker gets its own
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._flusher_lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._run_flusher, name='metrics-flush', daemon=True)
+                self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self._interval())
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('metrics: background flush failed')
+
+    def flush(self):
+        """Push buffered updates (and this process's gauges) to the shared store."""
+        with self._lock:
+            pending, self._buffer = self._buffer, defaultdict(float)
+        gauges = {}
+        for name, (_, fn) in self._process_gauges.items():
+            try:
+                gauges[name] = float(fn())
+            except Exception:
+                logger.exception('metrics: process gauge %s failed', name)
+
+        if not self._uses_redis():
+            with self._lock:
+                for series, amount in pending.items():
+                    self._local[series] += amount
+                for name, value in gauges.items():
+                    self._local[f'{name}\x00{self._process}'] = value
+            return True
+
+        client = self._redis()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                for series, amount in pending.items():
+                    pipe.hincrbyfloat(_REDIS_KEY, series, amount)
+                now = time.time()
+                for name, value in gauges.items():
+                    pipe.hset(_REDIS_GAUGES_KEY, f'{name}\x00{self._process}', f'{value}|{now}')
+                pipe.execute()
+                return True
+            except RedisError as exc:
+                logger.warning('metrics: flush to Redis failed, will retry: %s', exc)
+                self._client = None
+                self._redis_retry_at = time.monotonic() + _REDIS_RETRY_SECONDS
+        # keep the updates for the next attempt; the series set is bounded so the buffer is too
+        with self._lock:
+            for series, amount in pending.items():
+                self._buffer[series] += amount
+        return False
+
+    def snapshot(self):
+        """Current value of every series, including this process's unflushed updates."""
+        self.flush()
+        stale = float(getattr(settings, 'METRICS_GAUGE_STALE_SECONDS', 60))
+        gauges = defaultdict(float)
+        if not self._uses_redis():
+            with self._lock:
+                values = {}
+                for series, value in self._local.items():
+                    if '\x00' in series:
+                        gauges[series.split('\x00', 1)[0]] += value
+                    else:
+                        values[series] = value
+            return values, dict(gauges)
+
+        values = defaultdict(float)
+        client = self._redis()
+        if client is not None:
+            try:
+                for series, value in client.hgetall(_REDIS_KEY).items():
+                    values[series] += float(value)
+                now = time.time()
+                dead = []
+                for field, raw in client.hgetall(_REDIS_GAUGES_KEY).items():
+                    value, _, stamp = raw.partition('|')
+                    if now - float(stamp or 0) > stale:
+                        dead.append(field)
+                    else:
+                        gauges[field.split('\x00', 1)[0]] += float(value)
+                if dead:
+                    client.hdel(_REDIS_GAUGES_KEY, *dead)
+            except RedisError as exc:
+                logger.warning('metrics: reading from Redis failed: %s', exc)
+        with self._lock:
+            for series, amount in self._buffer.items():
+                values[series] += amount
+        return dict(values), dict(gauges)
+
+    def reset(self):
+        """Drop every recorded value (tests, or after changing bucket boundaries)."""
+        with self._lock:
+            self._buffer.clear()
+            self._local.clear()
+        client = self._redis() if self._uses_redis() else None
+        if client is not None:
+            try:
+                client.delete(_REDIS_KEY, _REDIS_GAUGES_KEY)
+            except RedisError:
+                pass
+
+    # --- exposition ---
+
+    def render(self):
+        values, gauges = self.snapshot()
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            prefixes = (name,) if metric.kind == 'counter' else (f'{name}_bucket', f'{name}_sum', f'{name}_count')
+            for series in sorted(s for s in values if s.split('{', 1)[0] in prefixes):
+                lines.append(f'{series} {_format(values[series])}')
+        for name, (documentation, _) in sorted(self._process_gauges.items()):
+            lines += [f'# HELP {name} {documentation}', f'# TYPE {name} gauge', f'{name} {_format(gauges.get(name, 0))}']
+        for name, (documentation, fn) in sorted(self._callbacks.items()):
+            try:
+                value = fn(values)
+            except Exception:
+                logger.exception('metrics: gauge %s failed', name)
+                continue
+            if value is None:
+                continue
+            lines += [f'# HELP {name} {documentation}', f'# TYPE {name} gauge', f'{name} {_format(value)}']
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+atexit.register(REGISTRY.flush)
+
+try:
+    from celery.signals import task_postrun
+
+    @task_postrun.connect(weak=False)
+    def _flush_after_task(**kwargs):
+        REGISTRY.flush()
+except Exception:  # pragma: no cover - celery is optional here
+    pass
+
+
+# --- payments pipeline metrics ---
+
+MPESA_REQUEST_SECONDS = REGISTRY.histogram(
+    'mpesa_request_duration_seconds', 'Daraja HTTP request latency by endpoint and status',
+    ('endpoint', 'status'))
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.histogram(
+    'mpesa_rate_limit_wait_seconds', 'Time spent waiting for a rate-limit slot', ('limiter',),
+    buckets=(0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0))
+RATE_LIMIT_REJECTIONS = REGISTRY.counter(
+    'mpesa_rate_limit_rejections_total', 'Rate-limit acquisitions that gave up without a slot', ('limiter',))
+TOKEN_CACHE = REGISTRY.counter(
+    'mpesa_token_cache_total', 'Access token lookups served from the cache (hit) or fetched (miss)', ('result',))
+POLL_ATTEMPTS = REGISTRY.histogram(
+    'payments_poll_attempts', 'Status poll attempts per payment when polling stops', ('outcome',),
+    buckets=(1, 2, 3, 5, 8, 13, 21, 40))
+CALLBACK_SECONDS = REGISTRY.histogram(
+    'payments_callback_duration_seconds', 'M-Pesa callback processing latency')
+CALLBACK_REJECTED = REGISTRY.counter(
+    'payments_callback_unknown_checkout_total', 'Callbacks acknowledged without a lookup: checkout id never issued')
+
+
+def daraja_endpoint(url):
+    if '/oauth/' in url:
+        return 'token'
+    if 'stkpushquery' in url:
+        return 'query'
+    if 'stkpush' in url:
+        return 'stkpush'
+    return 'other'
+
+
+def observe_mpesa_request(url, seconds, status):
+    MPESA_REQUEST_SECONDS.observe(seconds, endpoint=daraja_endpoint(url), status=str(status))
+
+
+def _pending_payments(values):
+    from payments.models import Payment
+    return Payment.objects.filter(status='pending').count()
+
+
+def _token_hit_ratio(values):
+    hits = values.get(_series('mpesa_token_cache_total', (('result', 'hit'),)), 0)
+    misses = values.get(_series('mpesa_token_cache_total', (('result', 'miss'),)), 0)
+    return hits / (hits + misses) if hits + misses else None
+
+
+def _notification_queue_depth():
+    from payments.utils.notifications import _dispatcher
+    return _dispatcher.qsize() if _dispatcher is not None else 0
+
+
+REGISTRY.gauge_callback('payments_pending', 'Payments waiting for a final status', _pending_payments)
+REGISTRY.gauge_callback('mpesa_token_cache_hit_ratio', 'Share of access token lookups served from the cache',
+                        _token_hit_ratio)
+REGISTRY.process_gauge('payments_notification_queue_depth', 'Notifications queued for sending, over all processes',
+                       _notification_queue_depth)
@@ -6,6 +6,7 @@ import logging
 import json
 import time
 import threading
+from contextlib import contextmanager
 
 try:
     import requests
@@ -17,8 +18,18 @@ except Exception:  # requests may not be installed in this environment
     _ConnectionError = Exception
     _Timeout = Exception
 
+try:
+    from tenacity import RetryError as _RetryError
+except Exception:
+    class _RetryError(Exception):
+        pass
+
 from .retry import retry
 from .rate_limit import wait_for_rate_limit
+from .circuit_breaker import CircuitBreaker, CircuitOpenError  # noqa: F401 (re-exported for callers)
+from .credentials import build_pool
+from .metrics import TOKEN_CACHE, daraja_endpoint, observe_mpesa_request
+from .tracing import start_span
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +39,14 @@ class MPesaAuthError(RuntimeError):
     pass
 
 
+class MPesaHTTPError(RuntimeError):
+    """Raised when Daraja answers with an HTTP error status (kept a RuntimeError for existing callers)."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
 # Define which exceptions should be considered 'network' and retriable
 _retry_network_exceptions = ( _ConnectionError, _Timeout ) if requests is not None else (Exception,)
 
@@ -51,6 +70,10 @@ def _redact_headers(headers):
 
 
 def _base_url():
+    # MPESA_BASE_URL points the client elsewhere, e.g. at the local Daraja simulator
+    override = getattr(settings, 'MPESA_BASE_URL', None)
+    if override:
+        return override.rstrip('/')
     return "https://api.safaricom.co.ke" if getattr(settings, 'MPESA_ENV', 'sandbox') == "production" else "https://sandbox.safaricom.co.ke"
 
 
@@ -75,8 +98,62 @@ def _redact_sensitive(d: dict) -> dict:
     return redacted
 
 
-@retry(max_attempts=3, base_delay=0.5, exceptions=_retry_network_exceptions)
+def _is_upstream_failure(exc):
+    """Whether `exc` means Daraja itself is unhealthy (counts against the circuit breaker).
+
+    Network errors (after retries) and 5xx responses do; 4xx answers such as an invalid
+    phone number, a WAF block or a 429 are Daraja working as intended and do not. Nor
+    does the 500 a status query gets while the customer has not answered the prompt yet.
+    """
+    if isinstance(exc, (_RetryError,) + tuple(_retry_network_exceptions)):
+        return True
+    status = getattr(exc, 'status_code', None)
+    if status is not None and status >= 500:
+        return _PROCESSING_ERROR_CODE not in str(exc)
+    return False
+
+
+# errorCode of Daraja's "The transaction is being processed" answer to a status query
+_PROCESSING_ERROR_CODE = '500.001.1001'
+
+_daraja_breaker = None
+
+
+def get_daraja_breaker():
+    """Circuit breaker shared by every Daraja call (state lives in the Django cache)."""
+    global _daraja_breaker
+    if _daraja_breaker is None:
+        _daraja_breaker = CircuitBreaker(
+            'daraja',
+            failure_threshold=int(getattr(settings, 'MPESA_CIRCUIT_FAILURE_THRESHOLD', 5)),
+            recovery_timeout=float(getattr(settings, 'MPESA_CIRCUIT_RECOVERY_SECONDS', 30)),
+            is_failure=_is_upstream_failure,
+        )
+    return _daraja_breaker
+
+
+@contextmanager
+def _observed_call(method, url):
+    """One Daraja HTTP attempt: a trace span plus the latency histogram (set `call['status']`)."""
+    call = {'status': 'error'}
+    started = time.perf_counter()
+    with start_span(f'mpesa.{daraja_endpoint(url)}', **{'http.method': method, 'http.url': url.split('?', 1)[0]}) as span:
+        try:
+            yield call
+        finally:
+            observe_mpesa_request(url, time.perf_counter() - started, call['status'])
+            if span is not None:
+                span.set_attribute('http.status_code', call['status'])
+
+
 def _http_get(url, headers=None, timeout=15):
+    """GET through the Daraja circuit breaker: fails fast with `CircuitOpenError` while it is open."""
+    with get_daraja_breaker().guard():
+        return _http_get_with_retry(url, headers=headers, timeout=timeout)
+
+
+@retry(max_attempts=3, base_delay=0.5, exceptions=_retry_network_exceptions)
+def _http_get_with_retry(url, headers=None, timeout=15):
     """HTTP GET with sane default headers to reduce Incapsula/WAF blocks.
 
     - Adds a browser-like User-Agent and Accept headers
@@ -113,7 +190,9 @@ def _http_get(url, headers=None, timeout=15):
         safe_headers.update(headers)
 
     try:
-        resp = requests.get(url, headers=safe_headers, timeout=timeout)
+        with _observed_call('GET', url) as call:
+            resp = requests.get(url, headers=safe_headers, timeout=timeout)
+            call['status'] = resp.status_code
     except Exception as e:
         logger.exception("HTTP GET to %s failed (network/error): %s", url, str(e))
         raise
@@ -129,10 +208,10 @@ def _http_get(url, headers=None, timeout=15):
         safe_h = _redact_headers(safe_headers)
         if 'incapsula' in lower or 'access denied' in lower or 'blocked' in lower:
             logger.error("MPESA HTTP GET blocked by WAF/Incapsula: url=%s status=%s headers=%s", url, resp.status_code, safe_h)
-            raise RuntimeError(f"HTTP GET {url} returned 403: blocked by WAF/Incapsula")
+            raise MPesaHTTPError(f"HTTP GET {url} returned 403: blocked by WAF/Incapsula", 403)
         # Generic 403
         logger.error("MPESA HTTP GET returned 403: url=%s headers=%s body=%s", url, safe_h, (body or '')[:500])
-        raise RuntimeError(f"HTTP GET {url} returned 403: {body[:500] if body else 'no body'}")
+        raise MPesaHTTPError(f"HTTP GET {url} returned 403: {body[:500] if body else 'no body'}", 403)
 
     try:
         resp.raise_for_status()
@@ -146,33 +225,43 @@ def _http_get(url, headers=None, timeout=15):
         safe_h = _redact_headers(safe_headers)
         logger.error("MPESA HTTP GET error: url=%s status=%s body=%s headers=%s", url, resp.status_code, short_body, safe_h)
         # Non-network HTTP errors are considered unretriable here (return fast)
-        raise RuntimeError(f"HTTP GET {url} returned {resp.status_code}: {short_body}") from e
+        raise MPesaHTTPError(f"HTTP GET {url} returned {resp.status_code}: {short_body}", resp.status_code) from e
 
     return resp
 
 
-def _http_post(url, payload=None, headers=None, timeout=20):
+def _http_post(url, payload=None, headers=None, timeout=20, limiter=None):
     """Send a JSON POST. `payload` is used to avoid shadowing the json module.
     
     Rate-limit errors (429) are NOT retried here—instead, they bubble up to the caller
     (poll_payment_status) which can apply backoff at the task level.
     Network errors are retried with exponential backoff.
     
-    Rate limiting is applied BEFORE the request to respect M-Pesa sandbox limits.
+    Rate limiting is applied BEFORE the request to respect M-Pesa sandbox limits, on
+    `limiter` (the calling credential's budget) or the global limiter. While the
+    Daraja circuit breaker is open this fails fast with `CircuitOpenError`,
+    without waiting for a rate-limit slot.
     """
     if requests is None:
         raise RuntimeError("The 'requests' package is required to call MPESA APIs")
-    
+
+    with get_daraja_breaker().guard():
+        return _http_post_guarded(url, payload=payload, headers=headers, timeout=timeout, limiter=limiter)
+
+
+def _http_post_guarded(url, payload=None, headers=None, timeout=20, limiter=None):
     # Apply rate limiting before making the request
     logger.debug("_http_post: waiting for rate limit slot before POST to %s", url)
-    wait_for_rate_limit()
+    wait_for_rate_limit(limiter)
     logger.debug("_http_post: rate limit slot acquired, proceeding with POST to %s", url)
     
     # Helper for retrying network-level errors (not 429 rate limits)
     @retry(max_attempts=3, base_delay=0.5, exceptions=_retry_network_exceptions)
-    def _post_with_retry():
+    def _post_with_retry(timeout=timeout):
         try:
-            resp = requests.post(url, json=payload, headers=headers, timeout=timeout)
+            with _observed_call('POST', url) as call:
+                resp = requests.post(url, json=payload, headers=headers, timeout=timeout)
+                call['status'] = resp.status_code
         except Exception as e:
             # Network-level error
             logger.exception("HTTP POST to %s failed (network/error): %s", url, str(e))
@@ -200,7 +289,8 @@ def _http_post(url, payload=None, headers=None, timeout=20):
         safe_headers = _redact_headers(headers)
         logger.error("MPESA HTTP POST error: url=%s status=%s body=%s payload=%s headers=%s", url, resp.status_code, short_body, redacted_payload, safe_headers)
         # safe to use json.dumps here because `json` refers to the module
-        raise RuntimeError(f"HTTP POST {url} returned {resp.status_code}: {short_body} | payload: {json.dumps(redacted_payload)}") from e
+        raise MPesaHTTPError(f"HTTP POST {url} returned {resp.status_code}: {short_body} | payload: {json.dumps(redacted_payload)}",
+                             resp.status_code) from e
     return resp
 
 
@@ -211,12 +301,32 @@ _token_cache = {
 }
 _token_lock = threading.Lock()
 
+_credential_pool = None
+
+
+def get_credential_pool():
+    """Configured Daraja credentials; the settings credential shares `_token_cache`."""
+    global _credential_pool
+    if _credential_pool is None:
+        _credential_pool = build_pool(token_cache=_token_cache, token_lock=_token_lock)
+    return _credential_pool
+
+
+def pick_credential():
+    """Credential with the most rate-limit headroom, for a new STK push."""
+    return get_credential_pool().pick()
+
+
+def _resolve_credential(credential):
+    # a DarajaCredential, a credential name (e.g. Payment.credential_name) or None for the settings one
+    return get_credential_pool().get(credential)
+
 
 def _current_time():
     return time.time()
 
 
-def get_access_token():
+def get_access_token(credential=None):
     # If simulation is enabled, return a dummy token to allow offline testing
     if _simulate_enabled():
         return 'SIMULATED_TOKEN'
@@ -224,25 +334,32 @@ def get_access_token():
     if requests is None:
         raise RuntimeError("The 'requests' package is required to call MPESA APIs")
 
+    credential = _resolve_credential(credential)
+    token_cache, token_lock = credential.token_cache, credential.token_lock
+
     # Fast-path: return cached token if valid
     try:
-        with _token_lock:
-            token = _token_cache.get('token')
-            expiry = _token_cache.get('expiry', 0)
+        with token_lock:
+            token = token_cache.get('token')
+            expiry = token_cache.get('expiry', 0)
             if token and _current_time() < expiry:
+                TOKEN_CACHE.inc(result='hit')
                 return token
     except Exception:
         # Fail-safe: if locking or cache read fails, proceed to fetch a new token
         pass
+    TOKEN_CACHE.inc(result='miss')
 
     # Fetch a fresh token from MPESA OAuth
-    key = settings.MPESA_CONSUMER_KEY
-    secret = settings.MPESA_CONSUMER_SECRET
+    key = credential.consumer_key
+    secret = credential.consumer_secret
     auth = base64.b64encode(f"{key}:{secret}".encode()).decode()
     url = f"{_base_url()}/oauth/v1/generate?grant_type=client_credentials"
 
     try:
         resp = _http_get(url, headers={"Authorization": f"Basic {auth}"})
+    except CircuitOpenError:
+        raise
     except RuntimeError as e:
         # Surface a specific auth error so callers can choose a fallback (e.g., simulate)
         logger.error("Failed to fetch MPESA access token: %s", str(e))
@@ -268,9 +385,9 @@ def get_access_token():
 
     # Store in cache
     try:
-        with _token_lock:
-            _token_cache['token'] = token
-            _token_cache['expiry'] = expiry_ts
+        with token_lock:
+            token_cache['token'] = token
+            token_cache['expiry'] = expiry_ts
     except Exception:
         # best-effort caching; ignore cache failures
         pass
@@ -307,7 +424,11 @@ def _normalize_msisdn(msisdn: str) -> str:
     return s
 
 
-def initiate_stk_push(phone_number, amount, account_ref, description):
+def initiate_stk_push(phone_number, amount, account_ref, description, credential=None):
+    """Send an STK push with `credential` (default: the one with the most headroom).
+
+    Record the credential's name on the payment: status queries must use the same one.
+    """
     # Development simulation: if enabled, return a fake successful response
     if _simulate_enabled():
         ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
@@ -326,10 +447,11 @@ def initiate_stk_push(phone_number, amount, account_ref, description):
     # Normalize phone number to expected MSISDN format
     phone_number = _normalize_msisdn(phone_number)
 
-    access_token = get_access_token()
+    credential = _resolve_credential(credential) if credential is not None else pick_credential()
+    access_token = get_access_token(credential)
     timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    shortcode = settings.MPESA_SHORTCODE
-    password = _stk_password(shortcode, settings.MPESA_PASSKEY, timestamp)
+    shortcode = credential.shortcode
+    password = _stk_password(shortcode, credential.passkey, timestamp)
 
     payload = {
         "BusinessShortCode": shortcode,
@@ -347,7 +469,7 @@ def initiate_stk_push(phone_number, amount, account_ref, description):
 
     url = f"{_base_url()}/mpesa/stkpush/v1/processrequest"
     headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    resp = _http_post(url, payload=payload, headers=headers)
+    resp = _http_post(url, payload=payload, headers=headers, limiter=credential.limiter)
     try:
         return resp.json()
     except Exception:
@@ -357,10 +479,12 @@ def initiate_stk_push(phone_number, amount, account_ref, description):
         raise RuntimeError('Invalid JSON response from STK push')
 
 
-def query_transaction_status(identifier):
+def query_transaction_status(identifier, credential=None):
     """Query transaction status by CheckoutRequestID or MerchantRequestID.
 
-    Returns the MPESA API JSON response or raises RuntimeError if requests missing.
+    `credential` must be the one the push was sent with (name or object; None for the
+    settings credential). Returns the MPESA API JSON response or raises RuntimeError
+    if requests missing.
     """
     # Support simulation for query too
     if _simulate_enabled():
@@ -370,8 +494,9 @@ def query_transaction_status(identifier):
     if requests is None:
         raise RuntimeError("The 'requests' package is required to call MPESA APIs")
 
-    access_token = get_access_token()
-    shortcode = settings.MPESA_SHORTCODE
+    credential = _resolve_credential(credential)
+    access_token = get_access_token(credential)
+    shortcode = credential.shortcode
     payload = {
         "BusinessShortCode": shortcode,
         "Identifier": identifier,
@@ -379,7 +504,7 @@ def query_transaction_status(identifier):
 
     url = f"{_base_url()}/mpesa/stkpushquery/v1/query"
     headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    resp = _http_post(url, payload=payload, headers=headers)
+    resp = _http_post(url, payload=payload, headers=headers, limiter=credential.limiter)
     try:
         return resp.json()
     except Exception:
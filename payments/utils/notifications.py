@@ -1,12 +1,143 @@
-from django.core.mail import send_mail
+"""Payment notifications (email and SMS).
+
+`notify_payment_success` sends synchronously and is kept for callers that need
+the outcome immediately. Hot paths should use `enqueue_payment_success`, which
+hands the notification to a process-wide `NotificationDispatcher`: a background
+thread that drains the queue in batches, sends all emails of a batch over one
+reused SMTP connection and SMS through one long-lived Twilio client, retrying
+failed sends with exponential backoff.
+
+Message templates are looked up and compiled once per process (see
+`get_notification_template`), with one variant per channel, and
+`render_notifications` renders a whole batch against a single context.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+from django.core.mail import send_mail, get_connection, EmailMessage
 from django.conf import settings
-from django.template.loader import render_to_string
+from django.template import Context
+from django.template.loader import get_template
+
+from .retry import retry
 
 try:
     from twilio.rest import Client as TwilioClient
 except Exception:
     TwilioClient = None
 
+logger = logging.getLogger(__name__)
+
+
+def _subject(payment):
+    return f"Payment successful: {payment.amount}"
+
+
+# Template per (notification, channel). Plain-text variants, rendered without HTML autoescaping.
+NOTIFICATION_TEMPLATES = {
+    ('payment_success', 'email'): 'payments/email/payment_success.txt',
+    ('payment_success', 'sms'): 'payments/sms/payment_success.txt',
+}
+
+# Compiled templates, filled on first use. None records a template that failed to load.
+_compiled_templates = {}
+_templates_lock = threading.Lock()
+
+
+def _fallback_body(kind, channel, payment):
+    if channel == 'sms':
+        return f"Payment of KES {payment.amount} received. M-Pesa receipt: {payment.mpesa_receipt_number}. Thank you."
+    return f"Payment {payment.pk} for {payment.amount} succeeded. Receipt: {payment.mpesa_receipt_number}\nUser: {payment.user}\nPhone: {payment.phone_number}"
+
+
+def get_notification_template(kind, channel):
+    """Return the compiled template for a notification/channel pair, loading it once per process."""
+    key = (kind, channel)
+    try:
+        return _compiled_templates[key]
+    except KeyError:
+        pass
+    with _templates_lock:
+        if key not in _compiled_templates:
+            compiled = None
+            name = NOTIFICATION_TEMPLATES.get(key)
+            if name:
+                try:
+                    # keep the engine-level Template so batches can share one Context
+                    compiled = get_template(name).template
+                except Exception:
+                    logger.exception('notifications: could not load template %s', name)
+            _compiled_templates[key] = compiled
+        return _compiled_templates[key]
+
+
+def clear_template_cache():
+    """Forget compiled templates (e.g. after editing them in a long-running shell)."""
+    with _templates_lock:
+        _compiled_templates.clear()
+
+
+def render_notifications(kind, channel, payments):
+    """Render one message per payment in a single pass over a shared context."""
+    template = get_notification_template(kind, channel)
+    if template is None:
+        return [_fallback_body(kind, channel, p) for p in payments]
+    context = Context(autoescape=False)
+    bodies = []
+    for payment in payments:
+        with context.push(payment=payment):
+            try:
+                bodies.append(template.render(context))
+            except Exception:
+                logger.exception('notifications: failed to render %s/%s for payment %s', kind, channel, payment.pk)
+                bodies.append(_fallback_body(kind, channel, payment))
+    return bodies
+
+
+def render_notification(kind, channel, payment):
+    return render_notifications(kind, channel, [payment])[0]
+
+
+def _render_body(payment, channel='email'):
+    return render_notification('payment_success', channel, payment)
+
+
+def _email_recipients(payment):
+    """Return `(from_email, recipients)`: the user's email plus the configured admin email."""
+    recipients = []
+    if getattr(payment.user, 'email', None):
+        recipients.append(payment.user.email)
+    admin_email = getattr(settings, 'DEFAULT_FROM_EMAIL', None)
+    if admin_email:
+        recipients.append(admin_email)
+    return admin_email or 'noreply@example.com', recipients
+
+
+def _twilio_settings():
+    account_sid = getattr(settings, 'TWILIO_ACCOUNT_SID', None)
+    auth_token = getattr(settings, 'TWILIO_AUTH_TOKEN', None)
+    from_number = getattr(settings, 'TWILIO_FROM_NUMBER', None)
+    return account_sid, auth_token, from_number
+
+
+# Twilio clients are thread-safe and hold an HTTP session; keep one per credential pair
+_twilio_clients = {}
+_twilio_lock = threading.Lock()
+
+
+def _get_twilio_client(account_sid, auth_token):
+    key = (TwilioClient, account_sid, auth_token)
+    with _twilio_lock:
+        client = _twilio_clients.get(key)
+        if client is None:
+            client = TwilioClient(account_sid, auth_token)
+            _twilio_clients[key] = client
+        return client
+
 
 def notify_payment_success(payment, via=('email',)):
     """Notify stakeholders of a successful payment.
@@ -17,37 +148,273 @@ def notify_payment_success(payment, via=('email',)):
     """
     messages = []
 
-    subject = f"Payment successful: {payment.amount}"
-    # try to render template
-    try:
-        body = render_to_string('payments/email/payment_success.txt', {'payment': payment})
-    except Exception:
-        body = f"Payment {payment.pk} for {payment.amount} succeeded. Receipt: {payment.mpesa_receipt_number}\nUser: {payment.user}\nPhone: {payment.phone_number}"
+    subject = _subject(payment)
 
     if 'email' in via:
         # send to the user email and a configured admin email
-        recipients = []
-        if getattr(payment.user, 'email', None):
-            recipients.append(payment.user.email)
-        admin_email = getattr(settings, 'DEFAULT_FROM_EMAIL', None)
-        if admin_email:
-            recipients.append(admin_email)
+        from_email, recipients = _email_recipients(payment)
         if recipients:
-            send_mail(subject, body, admin_email or 'noreply@example.com', recipients, fail_silently=True)
+            send_mail(subject, _render_body(payment, 'email'), from_email, recipients, fail_silently=True)
             messages.append(('email', recipients))
 
     if 'sms' in via and TwilioClient is not None:
-        account_sid = getattr(settings, 'TWILIO_ACCOUNT_SID', None)
-        auth_token = getattr(settings, 'TWILIO_AUTH_TOKEN', None)
-        from_number = getattr(settings, 'TWILIO_FROM_NUMBER', None)
+        account_sid, auth_token, from_number = _twilio_settings()
         to_number = payment.phone_number
         if account_sid and auth_token and from_number and to_number:
             try:
-                client = TwilioClient(account_sid, auth_token)
-                client.messages.create(body=body, from_=from_number, to=to_number)
+                client = _get_twilio_client(account_sid, auth_token)
+                client.messages.create(body=_render_body(payment, 'sms'), from_=from_number, to=to_number)
                 messages.append(('sms', to_number))
             except Exception:
                 # don't raise in notification
                 pass
 
     return messages
+
+
+class _UserSnapshot(SimpleNamespace):
+    def __str__(self):
+        return self.display
+
+
+def _snapshot(payment):
+    """Copy what the templates need off a Payment so the dispatcher thread never touches the DB."""
+    user = payment.user
+    return SimpleNamespace(
+        pk=payment.pk,
+        id=payment.pk,
+        amount=payment.amount,
+        mpesa_receipt_number=payment.mpesa_receipt_number,
+        phone_number=payment.phone_number,
+        user=_UserSnapshot(
+            username=getattr(user, 'username', ''),
+            email=getattr(user, 'email', None),
+            get_full_name=user.get_full_name() if hasattr(user, 'get_full_name') else '',
+            display=str(user),
+        ),
+    )
+
+
+class NotificationDispatcher:
+    """Queue notifications and send them in batches from a background thread.
+
+    Args:
+        batch_size: Maximum notifications drained per batch
+        flush_interval: Seconds to wait for a batch to fill before sending what is queued
+        max_queue: Queue bound; `enqueue` drops (and logs) notifications beyond it
+        max_attempts: Send attempts per batch (email) or message (SMS)
+        base_delay: First retry delay in seconds, doubled on every attempt
+        idle_timeout: Close the SMTP connection after this many idle seconds
+    """
+
+    def __init__(self, batch_size=50, flush_interval=0.5, max_queue=10000, max_attempts=3, base_delay=0.5,
+                 idle_timeout=30.0):
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.idle_timeout = idle_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._connection = None
+        self._last_send = 0.0
+        self.stats = {'enqueued': 0, 'dropped': 0, 'emails_sent': 0, 'sms_sent': 0, 'failed': 0, 'batches': 0}
+
+    # -- public API -------------------------------------------------------
+
+    def enqueue(self, payment, via=('email',)):
+        """Queue a success notification without blocking. Returns False if the queue is full."""
+        self.start()
+        try:
+            self._queue.put_nowait((_snapshot(payment), tuple(via)))
+        except queue.Full:
+            self.stats['dropped'] += 1
+            logger.error('notifications: queue full, dropping notification for payment %s', payment.pk)
+            return False
+        self.stats['enqueued'] += 1
+        return True
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='notification-dispatcher', daemon=True)
+            self._thread.start()
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been sent (or given up on)."""
+        if timeout is None:
+            self._queue.join()
+            return True
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout=5.0):
+        """Send what is queued, then stop the worker thread and close the SMTP connection."""
+        if self._thread is None:
+            return
+        self.flush(timeout)
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    # -- worker -----------------------------------------------------------
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                batch = self._next_batch()
+                if not batch:
+                    self._close_if_idle()
+                    continue
+                try:
+                    self._send_batch(batch)
+                except Exception:
+                    logger.exception('notifications: batch of %s failed', len(batch))
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+        finally:
+            self._close_connection()
+
+    def _next_batch(self):
+        try:
+            first = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _send_batch(self, batch):
+        self.stats['batches'] += 1
+        email_payments = [p for p, via in batch if 'email' in via]
+        sms_payments = [p for p, via in batch if 'sms' in via and p.phone_number]
+
+        emails = []
+        for payment, body in zip(email_payments, render_notifications('payment_success', 'email', email_payments)):
+            from_email, recipients = _email_recipients(payment)
+            if recipients:
+                emails.append(EmailMessage(_subject(payment), body, from_email, recipients))
+
+        if emails:
+            self._send_emails(emails)
+        if sms_payments:
+            bodies = render_notifications('payment_success', 'sms', sms_payments)
+            self._send_sms(list(zip(sms_payments, bodies)))
+        self._last_send = time.monotonic()
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = get_connection(fail_silently=False)
+            self._connection.open()
+        return self._connection
+
+    def _close_connection(self):
+        conn, self._connection = self._connection, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                logger.debug('notifications: error closing email connection', exc_info=True)
+
+    def _close_if_idle(self):
+        if self._connection is not None and time.monotonic() - self._last_send > self.idle_timeout:
+            self._close_connection()
+
+    def _send_emails(self, emails):
+        # one message per attempt over the shared connection: a batch that fails partway
+        # would otherwise resend the messages the server already accepted
+        @retry(max_attempts=self.max_attempts, base_delay=self.base_delay)
+        def _send(message):
+            try:
+                return self._get_connection().send_messages([message])
+            except Exception:
+                # the server may have dropped the connection; reopen on the next attempt
+                self._close_connection()
+                raise
+
+        for message in emails:
+            try:
+                self.stats['emails_sent'] += _send(message) or 0
+            except Exception:
+                self.stats['failed'] += 1
+                logger.exception('notifications: giving up on email to %s', ', '.join(message.to))
+
+    def _send_sms(self, messages):
+        if TwilioClient is None:
+            return
+        account_sid, auth_token, from_number = _twilio_settings()
+        if not (account_sid and auth_token and from_number):
+            return
+        client = _get_twilio_client(account_sid, auth_token)
+
+        @retry(max_attempts=self.max_attempts, base_delay=self.base_delay)
+        def _send(body, to_number):
+            return client.messages.create(body=body, from_=from_number, to=to_number)
+
+        for payment, body in messages:
+            try:
+                _send(body, payment.phone_number)
+                self.stats['sms_sent'] += 1
+            except Exception:
+                self.stats['failed'] += 1
+                logger.exception('notifications: giving up on SMS for payment %s', payment.pk)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_notification_dispatcher():
+    """Get or create the process-wide notification dispatcher."""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = NotificationDispatcher(
+                    batch_size=int(getattr(settings, 'NOTIFICATION_BATCH_SIZE', 50)),
+                    flush_interval=float(getattr(settings, 'NOTIFICATION_FLUSH_INTERVAL', 0.5)),
+                    max_queue=int(getattr(settings, 'NOTIFICATION_MAX_QUEUE', 10000)),
+                )
+                atexit.register(_dispatcher.stop)
+    return _dispatcher
+
+
+def enqueue_payment_success(payment, via=('email',)):
+    """Queue a payment success notification for batched, non-blocking delivery.
+
+    With NOTIFICATION_BACKEND='celery' it goes to the `send_payment_notification`
+    task on the notifications queue instead, falling back to the in-process
+    dispatcher if the broker cannot take it.
+    """
+    if getattr(settings, 'NOTIFICATION_BACKEND', 'thread') == 'celery':
+        from payments.tasks import send_payment_notification
+        if hasattr(send_payment_notification, 'delay'):
+            try:
+                send_payment_notification.delay(payment.pk, list(via))
+                return True
+            except Exception:
+                logger.exception('notifications: could not queue task for payment %s; sending in-process', payment.pk)
+    return get_notification_dispatcher().enqueue(payment, via=via)
@@ -7,8 +7,13 @@ fallback to in-memory rate limiting for single-process environments.
 """
 import time
 import logging
+import threading
+import uuid
 from django.conf import settings
 
+from .metrics import RATE_LIMIT_REJECTIONS, RATE_LIMIT_WAIT_SECONDS
+from .retry import DeadlineExceeded, remaining_time
+
 logger = logging.getLogger(__name__)
 
 # Try to import Redis for distributed rate limiting
@@ -21,6 +26,21 @@ except Exception:
     RedisError = Exception
 
 
+# Trim the window, count it and claim a slot in one step: with separate round trips
+# concurrent callers (e.g. the reconcile verify pool) could all see a free slot.
+# KEYS[1] window; ARGV: window start, now, limit, member, expiry seconds
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+local count = redis.call('ZCARD', KEYS[1])
+if count < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    return {1, count + 1}
+end
+return {0, count}
+"""
+
+
 class RateLimiter:
     """Rate limiter that respects M-Pesa sandbox limits: ~5 requests per 60 seconds."""
     
@@ -37,6 +57,10 @@ class RateLimiter:
         self.period_seconds = period_seconds
         self.use_redis = use_redis and _HAS_REDIS
         self.redis_client = None
+        self._acquire_script = None
+        # Guards the in-memory window so concurrent callers (e.g. thread pools) share one budget
+        self._lock = threading.Lock()
+        self._requests = []
         
         if self.use_redis:
             try:
@@ -45,6 +69,7 @@ class RateLimiter:
                 if broker_url and broker_url.startswith('redis://'):
                     self.redis_client = redis.from_url(broker_url, decode_responses=True)
                     self.redis_client.ping()
+                    self._acquire_script = self.redis_client.register_script(_ACQUIRE_SCRIPT)
                     logger.info("RateLimiter: using Redis for distributed rate limiting")
                 else:
                     logger.warning("RateLimiter: CELERY_BROKER_URL not set to Redis, falling back to in-memory")
@@ -63,10 +88,16 @@ class RateLimiter:
         Returns:
             True if acquired, False if timeout exceeded
         """
+        start = time.perf_counter()
         if self.use_redis:
-            return self._acquire_redis(timeout)
+            acquired = self._acquire_redis(timeout)
         else:
-            return self._acquire_memory(timeout)
+            acquired = self._acquire_memory(timeout)
+        if acquired:
+            RATE_LIMIT_WAIT_SECONDS.observe(time.perf_counter() - start, limiter=self.name)
+        else:
+            RATE_LIMIT_REJECTIONS.inc(limiter=self.name)
+        return acquired
     
     def _acquire_redis(self, timeout):
         """Distributed rate limit using Redis with sliding window."""
@@ -74,26 +105,19 @@ class RateLimiter:
             return self._acquire_memory(timeout)
         
         key = f"ratelimit:{self.name}"
-        now = time.time()
-        window_start = now - self.period_seconds
         
         start_time = time.time()
         while True:
+            now = time.time()
+            window_start = now - self.period_seconds
             try:
-                pipe = self.redis_client.pipeline()
-                # Remove old entries outside the window
-                pipe.zremrangebyscore(key, 0, window_start)
-                # Count current requests in window
-                pipe.zcard(key)
-                results = pipe.execute()
-                count = results[1]
-                
-                if count < self.requests_per_period:
-                    # Add current request timestamp
-                    self.redis_client.zadd(key, {str(now): now})
-                    # Set expiry to period_seconds so old keys auto-clean
-                    self.redis_client.expire(key, self.period_seconds + 1)
-                    logger.debug("RateLimiter: acquired (Redis) - %d/%d requests in window", count + 1, self.requests_per_period)
+                # unique member: two callers with the same timestamp must both count
+                member = f'{now}:{uuid.uuid4().hex}'
+                acquired, count = self._acquire_script(
+                    keys=[key], args=[repr(window_start), repr(now), self.requests_per_period, member,
+                                      int(self.period_seconds) + 1])
+                if acquired:
+                    logger.debug("RateLimiter: acquired (Redis) - %d/%d requests in window", count, self.requests_per_period)
                     return True
                 
                 # Rate limit exceeded, check timeout
@@ -115,39 +139,53 @@ class RateLimiter:
     
     def _acquire_memory(self, timeout):
         """In-memory rate limit (single process only, not distributed)."""
-        # Using a simple circular buffer approach
-        if not hasattr(self, '_requests'):
-            self._requests = []
-        
-        now = time.time()
-        window_start = now - self.period_seconds
-        
-        # Remove old entries
-        self._requests = [t for t in self._requests if t > window_start]
-        
         start_time = time.time()
-        while len(self._requests) >= self.requests_per_period:
+        while True:
+            # Check and claim under the lock; sleep outside it so other threads can proceed
+            with self._lock:
+                now = time.time()
+                window_start = now - self.period_seconds
+                # Remove old entries
+                self._requests = [t for t in self._requests if t > window_start]
+                if len(self._requests) < self.requests_per_period:
+                    self._requests.append(now)
+                    logger.debug("RateLimiter: acquired (memory) - %d/%d requests in window", len(self._requests), self.requests_per_period)
+                    return True
+                # Oldest request in window
+                oldest = self._requests[0]
+                in_window = len(self._requests)
+
             if timeout == 0:
-                logger.debug("RateLimiter: rate limited (memory) - %d/%d requests", len(self._requests), self.requests_per_period)
+                logger.debug("RateLimiter: rate limited (memory) - %d/%d requests", in_window, self.requests_per_period)
                 return False
-            
-            if timeout > 0 and (time.time() - start_time) >= timeout:
+
+            elapsed = time.time() - start_time
+            if timeout > 0 and elapsed >= timeout:
                 logger.debug("RateLimiter: timeout exceeded (memory)")
                 return False
-            
-            # Oldest request in window
-            oldest = self._requests[0] if self._requests else now
+
             sleep_time = max(0.1, oldest + self.period_seconds - now)
             if timeout > 0:
-                sleep_time = min(sleep_time, timeout - (time.time() - start_time))
+                sleep_time = min(sleep_time, timeout - elapsed)
             time.sleep(sleep_time)
-            now = time.time()
-            window_start = now - self.period_seconds
-            self._requests = [t for t in self._requests if t > window_start]
-        
-        self._requests.append(now)
-        logger.debug("RateLimiter: acquired (memory) - %d/%d requests in window", len(self._requests), self.requests_per_period)
-        return True
+
+    def headroom(self):
+        """Requests that could be made right now without waiting (for load balancing)."""
+        now = time.time()
+        window_start = now - self.period_seconds
+        if self.use_redis and self.redis_client:
+            try:
+                used = self.redis_client.zcount(f"ratelimit:{self.name}", window_start, '+inf')
+                return max(0, self.requests_per_period - used)
+            except RedisError as e:
+                logger.warning("RateLimiter: Redis error reading headroom: %s", str(e))
+        with self._lock:
+            used = sum(1 for t in self._requests if t > window_start)
+        return max(0, self.requests_per_period - used)
+
+    def rate_per_second(self):
+        """Sustained number of requests per second this limiter allows."""
+        return self.requests_per_period / float(self.period_seconds or 1)
 
 
 # Global rate limiter instance for M-Pesa API
@@ -166,11 +204,18 @@ def get_mpesa_rate_limiter():
     return _mpesa_rate_limiter
 
 
-def wait_for_rate_limit():
-    """Block until a rate limit slot is available."""
-    limiter = get_mpesa_rate_limiter()
-    # Wait indefinitely (negative timeout means infinite)
-    acquired = limiter.acquire(timeout=-1)
+def wait_for_rate_limit(limiter=None):
+    """Block until a slot is available on `limiter` (default: the global M-Pesa limiter).
+
+    Inside a `deadline_scope` the wait is bounded by the remaining time and
+    `DeadlineExceeded` is raised when no slot frees up before it.
+    """
+    limiter = limiter or get_mpesa_rate_limiter()
+    remaining = remaining_time()
+    # Without a deadline wait indefinitely (negative timeout means infinite)
+    acquired = limiter.acquire(timeout=-1 if remaining is None else max(0.0, remaining))
     if not acquired:
+        if remaining is not None:
+            raise DeadlineExceeded('no M-Pesa rate limit slot before the deadline')
         logger.error("RateLimiter: failed to acquire slot (should not happen with infinite timeout)")
     return acquired
@@ -0,0 +1,366 @@
+"""Chunked reconcile engine used by the `reconcile_payments` management command.
+
+Failed payments are read in primary-key order, one chunk at a time, loading only
+the columns needed to decide the outcome. The latest stored callback of each
+payment (a compressed `PaymentPayload`) is fetched for the whole chunk in one
+query, then decompressed and parsed in a small worker pool, and every chunk is
+written back with a single `bulk_update`, so a large backlog costs a handful of
+queries per chunk instead of one save per row.
+
+Progress can be checkpointed to a JSON file (the last primary key processed) so
+an interrupted run picks up where it stopped.
+
+`UpstreamVerifier` covers payments that have no stored callback to go on: it
+asks Daraja for their status through a bounded thread pool. Every query still
+goes through the shared `RateLimiter`, so the pool simply keeps the budget busy
+instead of spending it one call at a time.
+"""
+import concurrent.futures
+import json
+import logging
+import os
+import time
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from payments.models import Payment, PaymentPayload
+from payments.utils import callback_decoder, mpesa_api
+from payments.utils.errors import MPESA_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Payments with at least one stored upstream callback
+HAS_CALLBACK = Exists(PaymentPayload.objects.filter(payment=OuterRef('pk'), kind='callback'))
+
+# Columns written back when a payment is reconciled as successful
+UPDATE_FIELDS = ['status', 'mpesa_receipt_number', 'error_code', 'error_message', 'updated_at']
+
+
+def bulk_transition(objs, batch_size=None):
+    """`bulk_update` payments whose `status` was set to a new value, honouring `Payment.TRANSITIONS`.
+
+    The target rows are locked with SELECT ... FOR UPDATE and only those still in
+    an allowed source status are written, so a callback that settled a payment
+    while the chunk was being processed is never overwritten. Returns the
+    objects that were actually written.
+    """
+    by_target = {}
+    for obj in objs:
+        by_target.setdefault(obj.status, []).append(obj.pk)
+    with transaction.atomic():
+        allowed = set()
+        for status, ids in by_target.items():
+            allowed.update(Payment.objects.select_for_update()
+                           .filter(pk__in=ids, status__in=Payment.TRANSITIONS[status])
+                           .values_list('pk', flat=True))
+        applied = [obj for obj in objs if obj.pk in allowed]
+        if applied:
+            Payment.objects.bulk_update(applied, UPDATE_FIELDS, batch_size=batch_size)
+    return applied
+
+
+def parse_callback(data):
+    """Return `(success, receipt)` for a stored callback payload.
+
+    Understands the STK `Body.stkCallback` shape as well as the older top-level
+    `ResponseCode` style. Unparsable payloads are reported as not successful.
+    """
+    record = callback_decoder.decode(data)
+    if record.success:
+        return True, record.receipt
+    if record.response_code == 0 and record.result_code is None:
+        return True, record.receipt
+    return False, None
+
+
+def _parse_blob(blob):
+    """Decompress a `PaymentPayload` blob and parse it (runs in the worker pool)."""
+    if blob is None:
+        return False, None
+    try:
+        raw = PaymentPayload.decompress(blob)
+    except Exception:
+        return False, None
+    # the decoder parses the decompressed bytes directly
+    return parse_callback(raw)
+
+
+class ReconcileEngine:
+    """Reconcile failed payments whose stored callback shows a success.
+
+    Args:
+        chunk_size: Rows read (and bulk-updated) per round trip
+        workers: Size of the callback parsing pool (0 or 1 parses inline)
+        dry_run: Inspect only, never write
+        limit: Stop after inspecting this many payments (0 = all)
+        checkpoint: Optional path of a JSON file used to resume interrupted runs
+        progress: Optional callable receiving a progress line per chunk
+    """
+
+    def __init__(self, chunk_size=500, workers=4, dry_run=False, limit=0, checkpoint=None, progress=None):
+        self.chunk_size = max(1, int(chunk_size))
+        self.workers = max(0, int(workers))
+        self.dry_run = dry_run
+        self.limit = max(0, int(limit or 0))
+        self.checkpoint = checkpoint
+        self.progress = progress
+
+    def queryset(self):
+        return Payment.objects.filter(HAS_CALLBACK, status='failed')
+
+    def load_checkpoint(self):
+        """Return the last processed primary key recorded in the checkpoint file (0 if none)."""
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return 0
+        try:
+            with open(self.checkpoint, 'r', encoding='utf-8') as f:
+                return int(json.load(f).get('last_pk') or 0)
+        except Exception:
+            logger.warning('reconcile: ignoring unreadable checkpoint %s', self.checkpoint)
+            return 0
+
+    def save_checkpoint(self, last_pk, inspected, fixed):
+        if not self.checkpoint:
+            return
+        tmp = f'{self.checkpoint}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'last_pk': last_pk, 'inspected': inspected, 'fixed': fixed}, f)
+        # atomic replace so a crash never leaves a half-written checkpoint behind
+        os.replace(tmp, self.checkpoint)
+
+    def clear_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def _parse_chunk(self, pool, chunk):
+        blobs = PaymentPayload.latest_blobs([p.pk for p in chunk], kind='callback')
+        payloads = [blobs.get(p.pk) for p in chunk]
+        if pool is None:
+            return [_parse_blob(b) for b in payloads]
+        return list(pool.map(_parse_blob, payloads))
+
+    def _apply(self, matches):
+        """Write a chunk of reconciled payments back with one bulk UPDATE; returns the written payments."""
+        now = timezone.now()
+        objs = []
+        for p, receipt in matches:
+            p.status = 'success'
+            if receipt:
+                p.mpesa_receipt_number = receipt
+            p.error_code = None
+            p.error_message = None
+            # bulk_update bypasses auto_now, so stamp it explicitly
+            p.updated_at = now
+            objs.append(p)
+        return bulk_transition(objs, batch_size=self.chunk_size)
+
+    def run(self):
+        """Process every matching payment and return a summary dict."""
+        last_pk = self.load_checkpoint()
+        inspected = 0
+        fixed = []
+        started = time.monotonic()
+        limit_reached = False
+
+        base = self.queryset().order_by('pk').only('id', 'status', 'mpesa_receipt_number')
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        try:
+            while True:
+                size = self.chunk_size
+                if self.limit:
+                    size = min(size, self.limit - inspected)
+                    if size <= 0:
+                        # a limit that exactly covers the remaining rows still finishes the run
+                        limit_reached = base.filter(pk__gt=last_pk).exists()
+                        break
+                chunk = list(base.filter(pk__gt=last_pk)[:size].iterator(chunk_size=size))
+                if not chunk:
+                    break
+
+                results = self._parse_chunk(pool, chunk)
+                matches = [(p, receipt) for p, (ok, receipt) in zip(chunk, results) if ok]
+                if matches and not self.dry_run:
+                    written = {p.pk for p in self._apply(matches)}
+                    matches = [(p, receipt) for p, receipt in matches if p.pk in written]
+
+                fixed.extend((p.id, receipt) for p, receipt in matches)
+                inspected += len(chunk)
+                last_pk = chunk[-1].pk
+                if not self.dry_run:
+                    self.save_checkpoint(last_pk, inspected, len(fixed))
+
+                if self.progress:
+                    elapsed = time.monotonic() - started
+                    rate = inspected / elapsed if elapsed > 0 else 0.0
+                    self.progress(f'... inspected {inspected} (last id={last_pk}), matched {len(fixed)}, {rate:.0f} rows/sec')
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+        # A complete, applied run leaves nothing to resume
+        if not self.dry_run and not limit_reached:
+            self.clear_checkpoint()
+
+        elapsed = time.monotonic() - started
+        return {
+            'inspected': inspected,
+            'fixed': fixed,
+            'last_pk': last_pk,
+            'elapsed': elapsed,
+            'rows_per_sec': inspected / elapsed if elapsed > 0 else 0.0,
+            'complete': not limit_reached,
+        }
+
+
+def _format_eta(seconds):
+    seconds = int(max(0, seconds))
+    hours, rem = divmod(seconds, 3600)
+    minutes, secs = divmod(rem, 60)
+    return f'{hours:d}:{minutes:02d}:{secs:02d}'
+
+
+def classify_query_result(result):
+    """Map a transaction-status query response to `(status, receipt, error_code, error_message)`.
+
+    `status` is 'success', 'failed' or None when the response is not definitive
+    (still processing, unexpected shape, unparsable ResultCode).
+    """
+    if not isinstance(result, dict):
+        return None, None, None, None
+    rc_raw = result.get('ResultCode')
+    try:
+        rc = int(str(rc_raw).strip()) if rc_raw is not None else None
+    except (TypeError, ValueError):
+        return None, None, None, None
+    if rc is None:
+        return None, None, None, None
+    if rc == 0:
+        return 'success', result.get('MpesaReceiptNumber') or result.get('ReceiptNumber'), None, None
+    return 'failed', None, str(rc), MPESA_ERRORS.get(str(rc), result.get('ResultDesc'))
+
+
+class UpstreamVerifier:
+    """Re-verify pending payments, and failed ones without a callback, against Daraja.
+
+    Args:
+        workers: Maximum number of concurrent status queries
+        chunk_size: Payments loaded (and bulk-updated) per round trip
+        dry_run: Query upstream but never write
+        limit: Stop after verifying this many payments (0 = all)
+        progress: Optional callable receiving progress/ETA lines
+        query: Status query callable (defaults to `mpesa_api.query_transaction_status`)
+    """
+
+    # Emit a progress line at most this often (seconds)
+    progress_interval = 5.0
+
+    def __init__(self, workers=4, chunk_size=200, dry_run=False, limit=0, progress=None, query=None):
+        self.workers = max(1, int(workers))
+        self.chunk_size = max(1, int(chunk_size))
+        self.dry_run = dry_run
+        self.limit = max(0, int(limit or 0))
+        self.progress = progress
+        self.query = query or mpesa_api.query_transaction_status
+        # the default query must use the credential each push went out with
+        self._per_credential = query is None
+
+    def queryset(self):
+        has_identifier = Q(checkout_request_id__isnull=False) | Q(merchant_request_id__isnull=False)
+        candidates = Q(status='pending') | (Q(status='failed') & ~HAS_CALLBACK)
+        return Payment.objects.filter(candidates).filter(has_identifier)
+
+    def _verify_one(self, payment):
+        try:
+            identifier = payment.checkout_request_id or payment.merchant_request_id
+            if self._per_credential:
+                result = self.query(identifier, credential=payment.credential_name)
+            else:
+                result = self.query(identifier)
+        except Exception as exc:
+            logger.warning('reconcile: upstream query failed for payment %s: %s', payment.pk, exc)
+            return payment, None, None, None, None
+        return (payment, *classify_query_result(result))
+
+    def _apply(self, changes):
+        now = timezone.now()
+        objs = []
+        for p, status, receipt, error_code, error_message in changes:
+            p.status = status
+            if receipt:
+                p.mpesa_receipt_number = receipt
+            p.error_code = error_code
+            p.error_message = error_message
+            p.updated_at = now
+            objs.append(p)
+        return bulk_transition(objs, batch_size=self.chunk_size)
+
+    def run(self):
+        """Verify every candidate and return a summary dict."""
+        total = self.queryset().count()
+        if self.limit:
+            total = min(total, self.limit)
+
+        limiter_rate = mpesa_api.get_credential_pool().rate_per_second()
+        if self.progress and total:
+            self.progress(f'{total} payments to verify; rate limit allows ~{limiter_rate:.2f} queries/sec '
+                          f'(best case {_format_eta(total / (limiter_rate or 1))})')
+        base = self.queryset().order_by('pk').only(
+            'id', 'status', 'checkout_request_id', 'merchant_request_id', 'mpesa_receipt_number', 'credential_name')
+
+        counts = {'verified': 0, 'success': 0, 'failed': 0, 'unchanged': 0, 'errors': 0}
+        changed = []
+        last_pk = 0
+        started = time.monotonic()
+        last_report = started
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while counts['verified'] < total:
+                size = min(self.chunk_size, total - counts['verified'])
+                chunk = list(base.filter(pk__gt=last_pk)[:size].iterator(chunk_size=size))
+                if not chunk:
+                    break
+                last_pk = chunk[-1].pk
+
+                changes = []
+                for payment, status, receipt, error_code, error_message in pool.map(self._verify_one, chunk):
+                    counts['verified'] += 1
+                    if status is None:
+                        counts['errors'] += 1
+                    elif status == payment.status:
+                        # failed stays failed: nothing to write
+                        counts['unchanged'] += 1
+                    else:
+                        counts[status] += 1
+                        changes.append((payment, status, receipt, error_code, error_message))
+
+                    now = time.monotonic()
+                    if self.progress and (now - last_report >= self.progress_interval or counts['verified'] == total):
+                        last_report = now
+                        elapsed = now - started
+                        rate = counts['verified'] / elapsed if elapsed > 0 else 0.0
+                        remaining = total - counts['verified']
+                        # Until throughput is observed, assume the limiter's sustained rate
+                        eta = remaining / (rate or limiter_rate or 1)
+                        self.progress(f"... verified {counts['verified']}/{total} ({rate:.2f}/sec), "
+                                      f"success={counts['success']} failed={counts['failed']} "
+                                      f"errors={counts['errors']}, ETA {_format_eta(eta)}")
+
+                if changes and not self.dry_run:
+                    written = {p.pk for p in self._apply(changes)}
+                    for change in changes:
+                        if change[0].pk not in written:
+                            # settled by a callback while we were asking upstream
+                            counts[change[1]] -= 1
+                            counts['unchanged'] += 1
+                    changes = [c for c in changes if c[0].pk in written]
+                changed.extend((p.id, status, receipt) for p, status, receipt, _, _ in changes)
+
+        elapsed = time.monotonic() - started
+        counts.update({
+            'total': total,
+            'changed': changed,
+            'elapsed': elapsed,
+        })
+        return counts
@@ -1,40 +1,158 @@
 """Retry helpers with optional tenacity support.
 
-Provides a `retry` decorator that retries on Exception with exponential backoff.
+Provides a `retry` decorator that retries on Exception with decorrelated-jitter backoff.
 If `tenacity` is installed, uses it; otherwise uses a simple custom implementation.
+
+Retries respect a deadline: the caller sets a total time budget with
+`deadline_scope(seconds)` (e.g. the remaining request time or a task's soft time
+limit) and every retried call inside it stops retrying when the next attempt could not
+finish in time. Its `timeout` argument is also clamped to the time that is left.
 """
-import time
+import contextvars
 import functools
+import inspect
+import random
+import time
+from contextlib import contextmanager
 
 try:
-    from tenacity import retry as tenacity_retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+    from tenacity import Retrying, retry_if_exception_type
     _HAS_TENACITY = True
 except Exception:
     _HAS_TENACITY = False
 
+# Absolute time.monotonic() deadline for the current request/task, or None
+_deadline = contextvars.ContextVar('retry_deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The caller's time budget ran out before the call could be attempted."""
+
+
+@contextmanager
+def deadline_scope(seconds):
+    """Bound all retried calls inside the block to `seconds` from now.
+
+    Nested scopes can only shorten the deadline; `None` leaves it unchanged.
+    """
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + max(0.0, float(seconds))
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time():
+    """Seconds left before the current deadline, or None when there is none."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def decorrelated_jitter(previous, base_delay, max_delay):
+    """Next backoff: random between `base_delay` and 3x the previous sleep, capped at `max_delay`.
+
+    Spreads retries from many workers apart instead of hitting the upstream in lockstep.
+    """
+    return min(max_delay, random.uniform(base_delay, max(base_delay, previous * 3)))
+
 
-def retry(max_attempts=3, base_delay=0.5, exceptions=(Exception,)):
-    if _HAS_TENACITY:
-        def decorator(fn):
-            return tenacity_retry(
-                stop=stop_after_attempt(max_attempts),
-                wait=wait_exponential(multiplier=base_delay),
-                retry=retry_if_exception_type(exceptions),
-            )(fn)
-        return decorator
+class _Budget:
+    """Attempt/deadline bookkeeping shared by the tenacity and fallback implementations."""
 
+    def __init__(self, max_attempts, base_delay, max_delay, min_attempt_time, deadline):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_attempt_time = min_attempt_time
+        self.deadline = deadline
+        self._planned = {}
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def next_sleep(self, attempt, previous):
+        # stop and wait both ask for it; draw the jitter once per attempt
+        if attempt not in self._planned:
+            self._planned[attempt] = decorrelated_jitter(previous or self.base_delay, self.base_delay, self.max_delay)
+        return self._planned[attempt]
+
+    def should_stop(self, attempt, previous):
+        if attempt >= self.max_attempts:
+            return True
+        remaining = self.remaining()
+        # skip an attempt that could not finish before the deadline anyway
+        return remaining is not None and remaining - self.next_sleep(attempt, previous) < self.min_attempt_time
+
+    def clamp(self, kwargs, timeout_arg, default_timeout):
+        remaining = self.remaining()
+        if remaining is None:
+            return kwargs
+        if remaining <= 0:
+            raise DeadlineExceeded('deadline reached before the call could be attempted')
+        if timeout_arg:
+            timeout = kwargs.get(timeout_arg, default_timeout)
+            kwargs = dict(kwargs, **{timeout_arg: remaining if timeout is None else min(timeout, remaining)})
+        return kwargs
+
+
+def retry(max_attempts=3, base_delay=0.5, exceptions=(Exception,), max_delay=8.0,
+          deadline=None, min_attempt_time=1.0, timeout_arg='timeout'):
+    """Retry `exceptions` up to `max_attempts` times with decorrelated jitter.
+
+    Args:
+        deadline: Optional per-call budget in seconds, combined with any `deadline_scope`
+        min_attempt_time: Attempts with less time than this left are not started
+        timeout_arg: Keyword argument of the wrapped function clamped to the remaining time
+    """
     def decorator(fn):
+        try:
+            param = inspect.signature(fn).parameters.get(timeout_arg) if timeout_arg else None
+        except (TypeError, ValueError):
+            param = None
+        clamp_arg = timeout_arg if param is not None else None
+        default_timeout = param.default if param is not None and param.default is not inspect.Parameter.empty else None
+
+        def _budget():
+            limit = _deadline.get()
+            if deadline is not None:
+                own = time.monotonic() + deadline
+                limit = own if limit is None else min(limit, own)
+            return _Budget(max_attempts, base_delay, max_delay, min_attempt_time, limit)
+
+        if _HAS_TENACITY:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                budget = _budget()
+
+                def _previous(retry_state):
+                    return retry_state.next_action.sleep if retry_state.next_action else None
+
+                def _attempt(*a, **kw):
+                    return fn(*a, **budget.clamp(kw, clamp_arg, default_timeout))
+
+                return Retrying(
+                    stop=lambda rs: budget.should_stop(rs.attempt_number, _previous(rs)),
+                    wait=lambda rs: budget.next_sleep(rs.attempt_number, _previous(rs)),
+                    retry=retry_if_exception_type(exceptions),
+                )(_attempt, *args, **kwargs)
+            return wrapper
+
         @functools.wraps(fn)
         def wrapper(*args, **kwargs):
-            delay = base_delay
+            budget = _budget()
+            delay = None
             for attempt in range(1, max_attempts + 1):
                 try:
-                    return fn(*args, **kwargs)
-                except exceptions as e:
-                    if attempt == max_attempts:
+                    return fn(*args, **budget.clamp(kwargs, clamp_arg, default_timeout))
+                except exceptions:
+                    if budget.should_stop(attempt, delay):
                         raise
+                    delay = budget.next_sleep(attempt, delay)
                     time.sleep(delay)
-                    delay *= 2
         return wrapper
     return decorator
-
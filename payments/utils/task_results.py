@@ -0,0 +1,64 @@
+"""Pruning of stored Celery task results.
+
+Most tasks run with `ignore_result` (CELERY_TASK_IGNORE_RESULT), so only the
+maintenance jobs that an operator may want to inspect store a result. With the
+django-celery-results database backend those rows still pile up, and Celery's
+own daily `backend_cleanup` deletes them in a single statement. The
+`prune_task_results` beat task trims them instead, in bounded batches of primary
+keys, so no delete holds locks on the table for long. With the Redis backend,
+results simply expire after CELERY_RESULT_EXPIRES and there is nothing to prune.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def result_model():
+    """The django-celery-results `TaskResult` model, or None when that app is not installed."""
+    if not apps.is_installed('django_celery_results'):
+        return None
+    return apps.get_model('django_celery_results', 'TaskResult')
+
+
+def delete_in_batches(queryset, batch_size=1000, max_batches=None, pause=0.0):
+    """Delete the rows of `queryset` `batch_size` primary keys at a time; returns how many went."""
+    deleted = 0
+    batches = 0
+    model = queryset.model
+    while max_batches is None or batches < max_batches:
+        ids = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted += model.objects.filter(pk__in=ids).delete()[0]
+        batches += 1
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def prune(older_than_seconds=None, batch_size=None, max_batches=None):
+    """Delete stored task results finished more than `older_than_seconds` ago (CELERY_RESULT_EXPIRES).
+
+    Returns the number of rows deleted, or None when results are not kept in the database.
+    """
+    model = result_model()
+    if model is None:
+        return None
+    if older_than_seconds is None:
+        older_than_seconds = int(getattr(settings, 'CELERY_RESULT_EXPIRES', 86400) or 86400)
+    if batch_size is None:
+        batch_size = int(getattr(settings, 'TASK_RESULT_PRUNE_BATCH_SIZE', 1000))
+    if max_batches is None:
+        max_batches = int(getattr(settings, 'TASK_RESULT_PRUNE_MAX_BATCHES', 100)) or None
+    cutoff = timezone.now() - timedelta(seconds=older_than_seconds)
+    deleted = delete_in_batches(model.objects.filter(date_done__lt=cutoff), batch_size=max(1, int(batch_size)),
+                                max_batches=max_batches)
+    if deleted:
+        logger.info('task results: pruned %d rows finished before %s', deleted, cutoff.isoformat())
+    return deleted
@@ -0,0 +1,412 @@
+"""Lifecycle tracing for purchases: initiate -> STK push -> polls -> callback.
+
+Spans carry W3C trace context (`traceparent`), so one purchase is one trace:
+
+* `start_span` opens a span under the current one (a ContextVar), or a new
+  trace; `traced` does the same for a whole view.
+* Celery: the current context travels in a `traceparent` task header
+  (`before_task_publish`), and each task execution — including every poll
+  retry — runs in a child span (`task_prerun`/`task_postrun`).
+* Callbacks carry no headers, so `bind_checkout` remembers the trace and push
+  time per CheckoutRequestID in the cache; the callback span is re-parented onto
+  that trace with `correlate_checkout`, and `record_settled` stamps the
+  push-to-settle latency on the settling span (and the metrics histogram).
+
+Finished, sampled spans are exported in batches from a background thread to a
+JSONL file (TRACING_EXPORTER='jsonl', TRACING_FILE) or an OTLP/HTTP collector
+(TRACING_EXPORTER='otlp', TRACING_OTLP_ENDPOINT). `manage.py trace_report`
+summarises a JSONL file.
+"""
+import atexit
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    import requests
+except Exception:
+    requests = None
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('trace_span', default=None)
+
+PUSH_TO_SETTLE_SECONDS = REGISTRY.histogram(
+    'payments_push_to_settle_seconds', 'Time from STK push to the final payment status', ('status', 'via'),
+    buckets=(1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300))
+
+
+def _enabled():
+    return getattr(settings, 'TRACING_ENABLED', True)
+
+
+def _new_id(nbytes):
+    return f'{random.getrandbits(nbytes * 8):0{nbytes * 2}x}'
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'sampled', 'attributes', 'start', 'end', 'status',
+                 '_started')
+
+    def __init__(self, name, trace_id, parent_id=None, sampled=True, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.end = None
+        self.status = 'ok'
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def adopt(self, traceparent):
+        """Move this span under a remote parent (e.g. the trace that pushed this checkout)."""
+        parsed = parse_traceparent(traceparent)
+        if parsed:
+            self.trace_id, self.parent_id, self.sampled = parsed
+
+    def finish(self):
+        self.end = self.start + (time.perf_counter() - self._started)
+        if self.sampled:
+            _get_exporter().submit(self)
+
+    @property
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-{"01" if self.sampled else "00"}'
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': round((self.end - self.start) * 1000, 3) if self.end else None,
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+def parse_traceparent(value):
+    """`(trace_id, parent_span_id, sampled)` from a W3C traceparent, or None."""
+    try:
+        version, trace_id, span_id, flags = value.strip().split('-')
+        int(trace_id, 16), int(span_id, 16)
+    except (AttributeError, ValueError):
+        return None
+    if len(trace_id) != 32 or len(span_id) != 16 or trace_id == '0' * 32:
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+def current_span():
+    return _current.get()
+
+
+def current_traceparent():
+    span = _current.get()
+    return span.traceparent if span is not None else None
+
+
+def _make_span(name, parent=None, attributes=None):
+    """A span under `parent` (traceparent), else under the current span, else a new sampled-or-not trace."""
+    parsed = parse_traceparent(parent) if parent else None
+    if parsed:
+        trace_id, parent_id, sampled = parsed
+        return Span(name, trace_id, parent_id, sampled, attributes)
+    outer = _current.get()
+    if outer is not None:
+        return Span(name, outer.trace_id, outer.span_id, outer.sampled, attributes)
+    sampled = random.random() < float(getattr(settings, 'TRACING_SAMPLE_RATE', 1.0))
+    return Span(name, _new_id(16), None, sampled, attributes)
+
+
+@contextmanager
+def start_span(name, parent=None, **attributes):
+    """Run the block in a new span; yields the span (None when tracing is off)."""
+    if not _enabled():
+        yield None
+        return
+    span = _make_span(name, parent, attributes)
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as exc:
+        span.status = 'error'
+        span.set_attribute('error', f'{type(exc).__name__}: {exc}'[:500])
+        raise
+    finally:
+        _current.reset(token)
+        span.finish()
+
+
+def traced(name):
+    """Decorator: run a view in a span named `name`, recording the response status."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with start_span(name, **{'http.method': request.method, 'http.path': request.path}) as span:
+                response = view(request, *args, **kwargs)
+                if span is not None:
+                    span.set_attribute('http.status_code', response.status_code)
+                    if response.status_code >= 500:
+                        span.status = 'error'
+                return response
+        return wrapper
+    return decorator
+
+
+def set_attributes(**attributes):
+    span = _current.get()
+    if span is not None:
+        span.attributes.update(attributes)
+
+
+# --- checkout correlation ---
+
+def _checkout_key(checkout_id):
+    return f'trace:checkout:{checkout_id}'
+
+
+def bind_checkout(checkout_id, payment_id=None):
+    """Remember the current trace and the push time for callbacks and polls of `checkout_id`."""
+    span = _current.get()
+    if span is None or not checkout_id:
+        return
+    span.attributes.update({'mpesa.checkout_id': checkout_id, 'payment.id': payment_id})
+    try:
+        cache.set(_checkout_key(checkout_id), {'traceparent': span.traceparent, 'pushed_at': time.time()},
+                  int(getattr(settings, 'TRACING_CHECKOUT_TTL', 86400)))
+    except Exception:
+        logger.debug('tracing: could not bind checkout %s', checkout_id, exc_info=True)
+
+
+def _binding(checkout_id):
+    try:
+        return cache.get(_checkout_key(checkout_id)) if checkout_id else None
+    except Exception:
+        return None
+
+
+def correlate_checkout(checkout_id):
+    """Re-parent the current span onto the trace that pushed `checkout_id` (for the callback)."""
+    span = _current.get()
+    if span is None or not checkout_id:
+        return
+    span.set_attribute('mpesa.checkout_id', checkout_id)
+    binding = _binding(checkout_id)
+    if binding and span.parent_id is None:
+        span.adopt(binding['traceparent'])
+
+
+def record_settled(checkout_id, status, via):
+    """Record push-to-settle latency when a payment reaches its final status."""
+    binding = _binding(checkout_id)
+    if not binding:
+        return None
+    seconds = max(0.0, time.time() - binding['pushed_at'])
+    PUSH_TO_SETTLE_SECONDS.observe(seconds, status=status, via=via)
+    set_attributes(**{'payment.status': status, 'payment.push_to_settle_ms': round(seconds * 1000, 1)})
+    return seconds
+
+
+# --- Celery propagation ---
+
+_task_spans = {}
+
+
+def _on_publish(headers=None, **kwargs):
+    traceparent = current_traceparent()
+    if traceparent and headers is not None:
+        headers['traceparent'] = traceparent
+
+
+def _on_prerun(task_id=None, task=None, **kwargs):
+    if not _enabled() or task is None:
+        return
+    request = getattr(task, 'request', None)
+    parent = getattr(request, 'traceparent', None) or (getattr(request, 'headers', None) or {}).get('traceparent')
+    span = _make_span(f'celery.{task.name.rsplit(".", 1)[-1]}', parent,
+                      {'celery.task_id': task_id, 'celery.retries': getattr(request, 'retries', 0)})
+    _task_spans[task_id] = (span, _current.set(span))
+
+
+def _on_postrun(task_id=None, state=None, **kwargs):
+    entry = _task_spans.pop(task_id, None)
+    if entry is None:
+        return
+    span, token = entry
+    try:
+        _current.reset(token)
+    except ValueError:
+        _current.set(None)
+    span.set_attribute('celery.state', state)
+    if state == 'FAILURE':
+        span.status = 'error'
+    span.finish()
+
+
+try:
+    from celery.signals import before_task_publish, task_postrun, task_prerun
+
+    before_task_publish.connect(_on_publish, weak=False)
+    task_prerun.connect(_on_prerun, weak=False)
+    task_postrun.connect(_on_postrun, weak=False)
+except Exception:  # pragma: no cover - celery is optional here
+    pass
+
+
+# --- export ---
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def to_otlp(spans, service_name='payments'):
+    """OTLP/HTTP JSON body for a batch of finished spans."""
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [{
+                'traceId': s['trace_id'],
+                'spanId': s['span_id'],
+                'parentSpanId': s['parent_id'] or '',
+                'name': s['name'],
+                'kind': 1,
+                'startTimeUnixNano': str(int(s['start'] * 1e9)),
+                'endTimeUnixNano': str(int((s['start'] + (s['duration_ms'] or 0) / 1000) * 1e9)),
+                'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in s['attributes'].items() if v is not None],
+                'status': {'code': 2 if s['status'] == 'error' else 1},
+            } for s in spans],
+        }],
+    }]}
+
+
+class SpanExporter:
+    """Ship finished spans in batches from a background thread.
+
+    Args:
+        kind: 'jsonl', 'otlp' or '' (drop spans)
+        path: JSONL file for kind='jsonl'
+        endpoint: OTLP/HTTP traces URL for kind='otlp' (e.g. http://collector:4318/v1/traces)
+        interval: Seconds between batches
+        max_queue: Spans beyond this are dropped (counted in `dropped`)
+    """
+
+    def __init__(self, kind='', path=None, endpoint=None, interval=1.0, max_queue=10000, batch_size=512):
+        self.kind = kind
+        self.path = path
+        self.endpoint = endpoint
+        self.interval = interval
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def submit(self, span):
+        if not self.kind:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(span.as_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        """Export everything queued so far."""
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            try:
+                self._export(batch)
+            except Exception as exc:
+                logger.warning('tracing: exporting %s spans failed: %s', len(batch), exc)
+
+    def _export(self, batch):
+        if self.kind == 'jsonl':
+            with self._write_lock, open(self.path, 'a', encoding='utf-8') as fh:
+                fh.writelines(json.dumps(span, default=str) + '\n' for span in batch)
+        elif self.kind == 'otlp':
+            if requests is None:
+                raise RuntimeError("the 'requests' package is required for OTLP export")
+            service = getattr(settings, 'TRACING_SERVICE_NAME', 'payments')
+            resp = requests.post(self.endpoint, json=to_otlp(batch, service), timeout=5)
+            resp.raise_for_status()
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def _get_exporter():
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                kind = (getattr(settings, 'TRACING_EXPORTER', '') or '').lower()
+                _exporter = SpanExporter(
+                    kind=kind if kind in ('jsonl', 'otlp') else '',
+                    path=getattr(settings, 'TRACING_FILE', '') or os.path.join(str(settings.BASE_DIR), 'traces.jsonl'),
+                    endpoint=getattr(settings, 'TRACING_OTLP_ENDPOINT', '') or 'http://127.0.0.1:4318/v1/traces',
+                    interval=float(getattr(settings, 'TRACING_EXPORT_INTERVAL', 1.0)),
+                )
+                atexit.register(_exporter.flush)
+    return _exporter
+
+
+class TraceContextFilter(logging.Filter):
+    """Logging filter adding `trace_id`/`span_id` to records, for correlating log lines with traces."""
+
+    def filter(self, record):
+        span = _current.get()
+        record.trace_id = span.trace_id if span is not None else '-'
+        record.span_id = span.span_id if span is not None else '-'
+        return True
@@ -1,6 +1,14 @@
-from django.http import JsonResponse
+import hmac
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 
+from payments.utils import callback_diagnostics
+from payments.utils.metrics import REGISTRY
+from payments.utils.mpesa_api import get_daraja_breaker
+
 
 def status(request):
     return JsonResponse({'status': 'payments app is alive'})
@@ -13,3 +21,31 @@ def webhook(request):
         return JsonResponse({'received': True})
     return JsonResponse({'error': 'invalid method'}, status=405)
 
+
+
+@staff_member_required
+def circuit_status(request):
+    """Staff-only: state and transition counts of the Daraja circuit breaker."""
+    return JsonResponse(get_daraja_breaker().stats())
+
+
+@staff_member_required
+def callback_diagnostics_view(request):
+    """Staff-only: recent sampled/anomalous M-Pesa callbacks with headers and body (`?limit=`)."""
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 50)), 1000))
+    except ValueError:
+        limit = 50
+    entries = callback_diagnostics.recent(limit)
+    return JsonResponse({'count': len(entries), 'mode': callback_diagnostics._mode(), 'entries': entries})
+
+
+def metrics(request):
+    """Prometheus scrape endpoint: staff sessions, or `Authorization: Bearer <METRICS_TOKEN>`."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    authorized = bool(token) and hmac.compare_digest(auth, f'Bearer {token}')
+    user = getattr(request, 'user', None)
+    if not (authorized or (user is not None and user.is_active and user.is_staff)):
+        return HttpResponseForbidden('metrics require a staff session or the metrics token')
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
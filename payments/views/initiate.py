@@ -4,6 +4,7 @@ from decimal import Decimal, InvalidOperation
 import logging
 from django.views.decorators.http import require_POST
 from django.http import JsonResponse
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.utils import timezone
@@ -12,8 +13,13 @@ from payments.utils.mpesa_api import initiate_stk_push, get_access_token
 import os
 from payments.models import Payment
 from payments.utils import mpesa_api as _mpesa_api
-from payments.tasks import poll_payment_status
+from payments.tasks import dispatch_stk_push, poll_payment_status
+from payments.utils.admission import AdmissionRejected, get_stk_admission_queue
+from payments.utils.circuit_breaker import CircuitOpenError
+from payments.utils.retry import DeadlineExceeded, deadline_scope
 from core.utils.permissions import rate_limit
+from payments.decorators import idempotent
+from payments.utils import tracing
 
 # Import requests exceptions if available
 try:
@@ -33,9 +39,26 @@ except Exception:
 logger = logging.getLogger(__name__)
 
 
+def _async_initiate_enabled():
+    """Async initiate needs MPESA_ASYNC_INITIATE and a Celery worker to dispatch to."""
+    return bool(getattr(settings, 'MPESA_ASYNC_INITIATE', False)) and hasattr(dispatch_stk_push, 'delay')
+
+
+def _upstream_unavailable(retry_after):
+    response = JsonResponse({
+        'success': False,
+        'message': 'M-Pesa is temporarily unavailable, please retry shortly',
+        'retry_after': retry_after,
+    }, status=503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
 @csrf_exempt
 @require_POST
+@idempotent('mpesa_initiate')
 @rate_limit('mpesa_initiate', limit=4, period=60)
+@tracing.traced('payments.initiate')
 def initiate_payment(request):
     payment = None
     try:
@@ -108,6 +131,32 @@ def initiate_payment(request):
                     'hint': 'Set the missing settings as environment variables or enable simulation (MPESA_SIMULATE=1)'
                 }, status=500)
 
+        # Daraja is known to be down: answer at once instead of creating a payment that cannot be pushed
+        if not simulate:
+            retry_after = _mpesa_api.get_daraja_breaker().open_for()
+            if retry_after:
+                return _upstream_unavailable(retry_after)
+
+        # Async mode: hand the STK push to a dispatcher worker and answer right away, so a
+        # slow Daraja never holds a web worker. The client follows the status endpoint.
+        use_async = not simulate and _async_initiate_enabled()
+        wait = 0
+        if use_async:
+            # Queue behind earlier pushes at the allowed rate; only shed when the wait
+            # would outlast the STK prompt itself.
+            admission = get_stk_admission_queue()
+            try:
+                wait = admission.admit()
+            except AdmissionRejected as exc:
+                logger.warning('initiate_payment: shedding STK push, %s', exc)
+                busy = JsonResponse({
+                    'success': False,
+                    'message': 'M-Pesa is busy right now, please retry shortly',
+                    'retry_after': exc.retry_after,
+                }, status=429)
+                busy['Retry-After'] = str(exc.retry_after)
+                return busy
+
         payment = Payment.objects.create(
             user=user,
             amount=amount,
@@ -117,13 +166,37 @@ def initiate_payment(request):
             status='pending',
         )
 
+        tracing.set_attributes(**{'payment.id': payment.id, 'payment.async': use_async})
+        if use_async:
+            try:
+                dispatch_stk_push.apply_async(args=(payment.id,), countdown=wait)
+            except Exception as exc:
+                logger.exception('Failed to enqueue dispatch_stk_push for payment %s', payment.id)
+                payment.transition_to('failed', error_message=f'Could not queue STK push: {exc}'[:1000])
+                return JsonResponse({'success': False, 'message': 'Payment service busy, please retry'}, status=503)
+            admission.record(payment.id, wait)
+            queued = admission.position(payment.id)
+            return JsonResponse({
+                'success': True,
+                'payment_id': payment.id,
+                'status': 'PENDING',
+                'status_url': reverse('payments:payments-status-api', args=[payment.id]),
+                'queue_position': queued[0] if queued else 0,
+                'eta_seconds': round(queued[1]) if queued else 0,
+            }, status=202)
+
         try:
-            resp = initiate_stk_push(phone, amount, account_ref, description)
-        except (_RetryError, _RequestException) as exc:
+            # bound token fetch, rate-limit wait and retries by what is left of the request budget
+            with deadline_scope(getattr(settings, 'MPESA_REQUEST_DEADLINE_SECONDS', 25)):
+                # spread pushes over the configured Daraja apps by rate-limit headroom
+                credential = None if simulate else _mpesa_api.pick_credential()
+                resp = initiate_stk_push(phone, amount, account_ref, description, credential=credential)
+        except CircuitOpenError as exc:
+            payment.transition_to('failed', error_message=str(exc))
+            return _upstream_unavailable(exc.retry_after)
+        except (_RetryError, _RequestException, DeadlineExceeded) as exc:
             # Upstream/network error while calling MPESA
-            payment.status = 'failed'
-            payment.error_message = str(exc)
-            payment.save()
+            payment.transition_to('failed', error_message=str(exc))
             logger.exception('MPESA upstream request failed')
             return JsonResponse({
                 'success': False,
@@ -131,9 +204,7 @@ def initiate_payment(request):
                 'error': str(exc)
             }, status=502)
         except Exception as exc:
-            payment.status = 'failed'
-            payment.error_message = str(exc)
-            payment.save()
+            payment.transition_to('failed', error_message=str(exc))
             logger.exception('Failed to initiate STK push')
             return JsonResponse({'success': False, 'message': 'failed to initiate', 'error': str(exc)}, status=500)
 
@@ -147,8 +218,11 @@ def initiate_payment(request):
 
         if checkout_id:
             payment.checkout_request_id = checkout_id
+            tracing.bind_checkout(checkout_id, payment.id)
         if merchant_req_id:
             payment.merchant_request_id = merchant_req_id
+        if credential is not None:
+            payment.credential_name = credential.name
 
         # Ensure raw_response is serializable
         raw = resp
@@ -157,34 +231,27 @@ def initiate_payment(request):
         except Exception:
             raw = repr(resp)
 
-        payment.callback_raw_data = raw if isinstance(raw, (dict, list, type(None))) else None
-        payment.save()
+        payment.save(update_fields=['checkout_request_id', 'merchant_request_id', 'credential_name', 'updated_at'])
+        payment.record_payload(raw if isinstance(raw, (dict, list)) else None, kind='initiate')
 
         # If we are running in simulation mode, mark the payment as successful immediately
         try:
             if simulate:
                 # Create a simulated callback-like record and update payment
                 sim_receipt = f"SIMREC{timezone.now().strftime('%Y%m%d%H%M%S')}"
-                try:
-                    # attach a small callback payload for audit
-                    payment.callback_raw_data = {
-                        'Body': {
-                            'stkCallback': {
-                                'CheckoutRequestID': checkout_id,
-                                'ResultCode': 0,
-                                'ResultDesc': 'Simulation - processed successfully',
-                                'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': sim_receipt}]}
-                            }
+                # attach a small callback payload for audit
+                sim_callback = {
+                    'Body': {
+                        'stkCallback': {
+                            'CheckoutRequestID': checkout_id,
+                            'ResultCode': 0,
+                            'ResultDesc': 'Simulation - processed successfully',
+                            'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': sim_receipt}]}
                         }
                     }
-                except Exception:
-                    payment.callback_raw_data = payment.callback_raw_data
-                payment.status = 'success'
-                payment.mpesa_receipt_number = sim_receipt
-                payment.error_code = None
-                payment.error_message = None
-                payment.updated_at = timezone.now()
-                payment.save()
+                }
+                payment.record_payload(sim_callback)
+                payment.transition_to('success', mpesa_receipt_number=sim_receipt, error_code=None, error_message=None)
         except Exception:
             # If simulation post-processing fails, do not prevent returning the normal response
             logger.exception('Failed to apply simulated success for payment')
@@ -193,7 +260,7 @@ def initiate_payment(request):
         if not simulate:
             try:
                 # This will raise RuntimeError on HTTP error; we catch and handle below
-                get_access_token()
+                get_access_token(credential)
             except Exception as exc:
                 # Check for 403-like responses in the error message and treat as dev-only condition
                 err_text = str(exc).lower()
@@ -203,7 +270,7 @@ def initiate_payment(request):
                 if force_sim:
                     try:
                         sim_receipt = f"SIMREC{timezone.now().strftime('%Y%m%d%H%M%S')}"
-                        payment.callback_raw_data = {
+                        sim_callback = {
                             'Body': {
                                 'stkCallback': {
                                     'CheckoutRequestID': checkout_id,
@@ -213,20 +280,18 @@ def initiate_payment(request):
                                 }
                             }
                         }
-                        payment.status = 'success'
-                        payment.mpesa_receipt_number = sim_receipt
-                        payment.error_code = None
-                        payment.error_message = f"Autofallback to simulation due to token error: {err_text}"[:1000]
-                        payment.updated_at = timezone.now()
-                        payment.save()
+                        payment.record_payload(sim_callback)
+                        payment.transition_to(
+                            'success',
+                            mpesa_receipt_number=sim_receipt,
+                            error_code=None,
+                            error_message=f"Autofallback to simulation due to token error: {err_text}"[:1000],
+                        )
                         logger.info('Applied dev fallback simulation for payment %s after token failure', getattr(payment, 'id', '<unknown>'))
                     except Exception:
                         logger.exception('Failed to apply dev fallback simulation for payment %s', getattr(payment, 'id', '<unknown>'))
                 else:
-                    payment.status = 'failed'
-                    payment.error_message = f"Failed to fetch MPESA access token: {err_text}"
-                    payment.updated_at = timezone.now()
-                    payment.save()
+                    payment.transition_to('failed', error_message=f"Failed to fetch MPESA access token: {err_text}")
                     return JsonResponse({
                         'success': False,
                         'message': 'Failed to fetch MPESA access token',
@@ -258,9 +323,7 @@ def initiate_payment(request):
         logger.exception('Unhandled error in initiate_payment')
         if payment is not None:
             try:
-                payment.status = 'failed'
-                payment.error_message = str(exc)
-                payment.save()
+                payment.transition_to('failed', error_message=str(exc))
             except Exception:
                 logger.exception('Failed to persist payment failure')
         return JsonResponse({'success': False, 'message': 'internal server error', 'error': str(exc)}, status=500)
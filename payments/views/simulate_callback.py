@@ -38,18 +38,15 @@ def simulate_callback(request, checkout_id):
 
     # Update payment model similarly to real callback
     try:
-        payment.callback_raw_data = payload
-        payment.status = 'success'
         # extract the simulated receipt
         try:
             items = payload['Body']['stkCallback']['CallbackMetadata']['Item']
-            payment.mpesa_receipt_number = items[0].get('Value')
+            receipt = items[0].get('Value')
         except Exception:
-            payment.mpesa_receipt_number = None
-        payment.error_code = None
-        payment.error_message = None
-        payment.updated_at = timezone.now()
-        payment.save()
+            receipt = None
+        payment.record_payload(payload)
+        if not payment.transition_to('success', mpesa_receipt_number=receipt, error_code=None, error_message=None):
+            return JsonResponse({'success': False, 'message': f'Payment is already {payment.status}'}, status=409)
     except Exception as exc:
         return JsonResponse({'success': False, 'message': 'Failed to update payment', 'error': str(exc)}, status=500)
 
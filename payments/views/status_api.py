@@ -1,5 +1,6 @@
 from django.http import JsonResponse
 from payments.models import Payment
+from payments.utils.admission import get_stk_admission_queue
 
 
 def payment_status(request, checkout_id):
@@ -29,11 +30,19 @@ def payment_status(request, checkout_id):
     else:
         status = 'PENDING'
 
-    return JsonResponse({
+    data = {
         'success': True,
         'status': status,
         'receipt': payment.mpesa_receipt_number,
         'error': payment.error_message,
         'payment_id': payment.id,
         'checkout_request_id': payment.checkout_request_id,
-    })
+        # False while an async-initiated payment is still waiting for its STK push to be sent
+        'dispatched': bool(payment.checkout_request_id or payment.merchant_request_id),
+    }
+    if status == 'PENDING' and not data['dispatched']:
+        # still in the admission queue: place in line (1 = next) and seconds until the push is sent
+        queued = get_stk_admission_queue().position(payment.id)
+        if queued:
+            data['queue_position'], data['eta_seconds'] = queued[0], round(queued[1])
+    return JsonResponse(data)
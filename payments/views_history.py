@@ -1,9 +1,10 @@
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
-from payments.models import Payment, PaymentAccessLog
+from payments.models import Payment, PaymentAccessLog, PaymentArchive
+from payments.utils.archive import PaymentHistory, get_payment
 from django.core.paginator import Paginator
 from django.db.models import Q
-from django.http import HttpResponse, JsonResponse, FileResponse
+from django.http import Http404, HttpResponse, JsonResponse, FileResponse
 from django.conf import settings
 import csv
 from datetime import datetime, timedelta
@@ -36,8 +37,45 @@ except Exception:
 
 @login_required
 def payment_history(request):
-    """Payment history with search, filters, sorting, pagination and CSV/PDF export."""
-    payments = Payment.objects.filter(user=request.user).order_by("-created_at")
+    """Payment history with search, filters, sorting, pagination and CSV/PDF export.
+
+    Archived payments (see `archive_payments`) are included transparently.
+    """
+    ordering = _history_ordering(request)
+    payments = _filter_history(request, Payment.objects.filter(user=request.user)).order_by(*ordering)
+    archived = PaymentArchive.objects.filter(user=request.user)
+    if archived.exists():
+        payments = PaymentHistory(payments, _filter_history(request, archived), ordering)
+
+    # EXPORT CSV
+    if request.GET.get("export") == "csv":
+        return export_payments_csv(payments)
+
+    # EXPORT PDF (fallback to CSV if reportlab not installed)
+    if request.GET.get("export") == "pdf":
+        if _HAS_REPORTLAB:
+            return export_payments_pdf(payments)
+        else:
+            # fallback: return CSV with a message header
+            resp = export_payments_csv(payments)
+            resp["X-Export-Fallback"] = "reportlab-missing"
+            return resp
+
+    # PAGINATION
+    paginator = Paginator(payments, 12)
+    page = request.GET.get("page")
+    payments_page = paginator.get_page(page)
+
+    ctx = {
+        "payments": payments_page,
+        "request": request,
+    }
+    return render(request, "frontend/payments_history.html", ctx)
+
+
+def _filter_history(request, base):
+    """Apply the history search and filters to `base` (a Payment or PaymentArchive queryset)."""
+    payments = base
 
     # SEARCH
     q = (request.GET.get("q") or '').strip()
@@ -98,8 +136,7 @@ def payment_history(request):
                     | Q(account_ref__icontains=q)
                 )
                 # Use base queryset for loose search to keep behavior predictable
-                base_qs = Payment.objects.filter(user=request.user)
-                payments = base_qs.filter(loose_filters).order_by('-created_at')
+                payments = base.filter(loose_filters)
 
     # STATUS FILTER
     status = request.GET.get("status")
@@ -123,41 +160,16 @@ def payment_history(request):
         except Exception:
             pass
 
-    # SORTING
-    sort = request.GET.get("sort")
-    if sort == "amount":
-        payments = payments.order_by("amount")
-    elif sort == "-amount":
-        payments = payments.order_by("-amount")
-    elif sort == "date":
-        payments = payments.order_by("created_at")
-    elif sort == "-date":
-        payments = payments.order_by("-created_at")
+    return payments
 
-    # EXPORT CSV
-    if request.GET.get("export") == "csv":
-        return export_payments_csv(payments)
 
-    # EXPORT PDF (fallback to CSV if reportlab not installed)
-    if request.GET.get("export") == "pdf":
-        if _HAS_REPORTLAB:
-            return export_payments_pdf(payments)
-        else:
-            # fallback: return CSV with a message header
-            resp = export_payments_csv(payments)
-            resp["X-Export-Fallback"] = "reportlab-missing"
-            return resp
-
-    # PAGINATION
-    paginator = Paginator(payments, 12)
-    page = request.GET.get("page")
-    payments_page = paginator.get_page(page)
-
-    ctx = {
-        "payments": payments_page,
-        "request": request,
-    }
-    return render(request, "frontend/payments_history.html", ctx)
+def _history_ordering(request):
+    sort = request.GET.get("sort")
+    return {
+        "amount": ("amount",),
+        "-amount": ("-amount",),
+        "date": ("created_at",),
+    }.get(sort, ("-created_at",))
 
 
 def export_payments_csv(queryset):
@@ -216,14 +228,17 @@ def export_payments_pdf(queryset):
 @login_required
 @audit_and_require_payment_view('pk')
 def payment_detail(request, pk: int):
-    payment = get_object_or_404(Payment, pk=pk)
+    payment = get_payment(pk)
+    if payment is None:
+        raise Http404('Payment not found')
     return render(request, 'frontend/payment_detail.html', {'payment': payment})
 
 
 @staff_member_required
 def access_logs_api(request):
     # Staff-only JSON endpoint with filtering and pagination for access logs
-    qs = PaymentAccessLog.objects.select_related('user', 'payment').all().order_by('-created_at')
+    # only payment_id is used: the payment itself may have been archived
+    qs = PaymentAccessLog.objects.select_related('user').all().order_by('-created_at')
 
     # Filters
     user_q = request.GET.get('user')
@@ -300,11 +315,15 @@ def history_timeseries(request):
     end = now().date()
     start = end - timedelta(days=29)  # inclusive 30 days
 
-    qs = Payment.objects.filter(user=request.user, created_at__date__gte=start, created_at__date__lte=end)
-    qs = qs.annotate(day=TruncDate('created_at')).values('day').annotate(total=Sum('amount'), count=Count('id')).order_by('day')
-
-    # build map day -> totals
-    data_map = {entry['day'].isoformat(): {'total': float(entry['total'] or 0), 'count': entry['count']} for entry in qs}
+    # build map day -> totals, over both the hot table and the archive
+    data_map = {}
+    for model in (Payment, PaymentArchive):
+        qs = model.objects.filter(user=request.user, created_at__date__gte=start, created_at__date__lte=end)
+        qs = qs.annotate(day=TruncDate('created_at')).values('day').annotate(total=Sum('amount'), count=Count('id')).order_by('day')
+        for entry in qs:
+            day = data_map.setdefault(entry['day'].isoformat(), {'total': 0.0, 'count': 0})
+            day['total'] += float(entry['total'] or 0)
+            day['count'] += entry['count']
 
     labels = []
     totals = []
@@ -331,7 +350,7 @@ def download_receipt(request, pk: int):
     In production, replace with real receipt generation (WeasyPrint/reportlab).
     """
     # For safety, only allow owner or staff (decorator enforces this)
-    payment = get_object_or_404(Payment, pk=pk, user=request.user)
+    payment = get_payment(pk, user=request.user)
     if not payment:
         return HttpResponse('Receipt not available', status=404)
 